@@ -0,0 +1,456 @@
+# benchmark.py
+"""
+Performance benchmarks for the model, data pipeline and generation loops.
+
+Usage: python benchmark.py <name>     (run without a name to list benchmarks)
+"""
+import sys
+import time
+import torch
+import torch.nn.functional as F
+from model import GPTMiniModel
+from bundle import load_model, model_architecture
+from generation import CHAT_STOP_STRINGS, IncrementalDecoder, StopSequenceMatcher, generate_batch, stream_generate
+from tokenizer import CharTokenizer, load_tokenizer, tokenizer_path
+import config
+
+
+def build_model(vocabulary_size=65):
+    """Randomly initialised model with the architecture from config.py"""
+    torch.manual_seed(0)
+    model = GPTMiniModel(**model_architecture(vocabulary_size)).to(config.device)
+    model.eval()
+    return model
+
+
+def benchmark_kv_cache(new_tokens=None, prompt_length=16):
+    """Per-token decode latency with and without the KV cache as the reply grows"""
+    model = build_model()
+    new_tokens = new_tokens or config.block_size - prompt_length
+    buckets = 4
+    prompt = torch.randint(0, 65, (1, prompt_length), device=config.device)
+
+    def uncached():
+        context = prompt
+        timings = []
+        with torch.no_grad():
+            for _ in range(new_tokens):
+                start = time.perf_counter()
+                logits = model(context[:, -config.block_size:])[:, -1, :]
+                next_token = torch.multinomial(F.softmax(logits, dim=-1), num_samples=1)
+                timings.append(time.perf_counter() - start)
+                context = torch.cat((context, next_token), dim=1)
+        return timings
+
+    def cached():
+        decoder = IncrementalDecoder(model)
+        logits = decoder.prefill(prompt)
+        timings = []
+        for _ in range(new_tokens):
+            start = time.perf_counter()
+            next_token = torch.multinomial(F.softmax(logits, dim=-1), num_samples=1)
+            logits = decoder.step(next_token)
+            timings.append(time.perf_counter() - start)
+        return timings
+
+    print(f"Per-token latency (ms) over {new_tokens} new tokens, prompt of {prompt_length} tokens")
+    print(f"{'tokens':>12} | {'uncached':>9} | {'cached':>9}")
+    results = {name: run() for name, run in (("uncached", uncached), ("cached", cached))}
+    bucket_size = max(1, new_tokens // buckets)
+    for start in range(0, new_tokens, bucket_size):
+        end = min(start + bucket_size, new_tokens)
+        row = [sum(results[name][start:end]) / (end - start) * 1000 for name in ("uncached", "cached")]
+        print(f"{start:5d}-{end - 1:<6d} | {row[0]:9.3f} | {row[1]:9.3f}")
+
+
+def benchmark_throughput(train_steps=20, decode_tokens=100):
+    """Training and decoding tokens/sec for the config.py architecture"""
+    model = build_model()
+    optimizer = torch.optim.AdamW(model.parameters(), lr=config.learning_rate)
+    xb = torch.randint(0, 65, (config.batch_size, config.block_size), device=config.device)
+    yb = torch.randint(0, 65, (config.batch_size, config.block_size), device=config.device)
+
+    model.train()
+    for step in range(train_steps + 2):
+        if step == 2:  # Skip warm-up steps
+            start = time.perf_counter()
+        _, loss = model(xb, yb)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+    train_time = time.perf_counter() - start
+    print(f"Training: {train_steps * xb.numel() / train_time:,.0f} tokens/sec "
+          f"({train_time / train_steps * 1000:.1f} ms/step)")
+
+    model.eval()
+    decoder = IncrementalDecoder(model)
+    start = time.perf_counter()
+    logits = decoder.prefill(xb[:1, :16])
+    for _ in range(decode_tokens):
+        next_token = torch.multinomial(F.softmax(logits, dim=-1), num_samples=1)
+        logits = decoder.step(next_token)
+    decode_time = time.perf_counter() - start
+    print(f"Decoding: {decode_tokens / decode_time:,.0f} tokens/sec")
+
+
+def load_chat_tokenizer():
+    return load_tokenizer(tokenizer_path("tokenizer_v2"))
+
+
+def benchmark_batched(num_prompts=16, max_new_tokens=64):
+    """Aggregate tokens/sec of batched generation versus one prompt at a time"""
+    tokenizer = load_chat_tokenizer()
+    model = build_model(tokenizer.vocab_size)
+    user_inputs = ["Hello!", "How are you today?", "Tell me a joke.", "What should I have for dinner tonight?"]
+    prompts = [f"Human: {user_inputs[i % len(user_inputs)]}\nAssistant:" for i in range(num_prompts)]
+
+    # No stop strings, so both modes generate exactly the same number of tokens
+    sequential = {"tokens": 0, "seconds": 0.0}
+    for prompt in prompts:
+        stats = {}
+        generate_batch(model, tokenizer, [prompt], max_new_tokens, stop_strings=(), stats=stats)
+        sequential["tokens"] += stats["tokens"]
+        sequential["seconds"] += stats["seconds"]
+
+    batched = {}
+    generate_batch(model, tokenizer, prompts, max_new_tokens, stop_strings=(), stats=batched)
+
+    print(f"{num_prompts} prompts x {max_new_tokens} new tokens")
+    for name, stats in (("sequential", sequential), ("batched", batched)):
+        print(f"{name:>10}: {stats['tokens'] / stats['seconds']:8,.0f} tokens/sec ({stats['seconds']:.2f}s)")
+
+
+def benchmark_get_batch(iterations=200):
+    """Time per batch when reloading the training tensors on every call versus a cached TokenDataset"""
+    import os
+    import tempfile
+    from dataset import TokenDataset, write_token_file
+
+    with open("data/conversation_input.txt", "r", encoding="utf-8") as f:
+        text = f.read()
+    tokenizer = CharTokenizer(text)
+    data = tokenizer.encode(text)
+    n = int(0.9 * len(data))
+
+    with tempfile.TemporaryDirectory() as directory:
+        # Previous pipeline: int64 tensors saved with torch.save and re-loaded for every batch
+        torch.save(torch.tensor(data[:n], dtype=torch.long), os.path.join(directory, "train.pt"))
+        torch.save(torch.tensor(data[n:], dtype=torch.long), os.path.join(directory, "val.pt"))
+
+        def reload_every_batch():
+            train_data = torch.load(os.path.join(directory, "train.pt"))
+            torch.load(os.path.join(directory, "val.pt"))
+            ix = torch.randint(len(train_data) - config.block_size, (config.batch_size,))
+            x = torch.stack([train_data[i:i + config.block_size] for i in ix])
+            y = torch.stack([train_data[i + 1:i + config.block_size + 1] for i in ix])
+            return x, y
+
+        path = os.path.join(directory, "tokens.bin")
+        write_token_file(path, {"train": data[:n], "val": data[n:]}, tokenizer.vocab_size)
+        token_dataset = TokenDataset(path)
+        in_memory_dataset = TokenDataset(path, in_memory=True)
+
+        train_data = torch.tensor(data[:n], dtype=torch.long)
+
+        def stack_windows():
+            ix = torch.randint(len(train_data) - config.block_size, (config.batch_size,))
+            x = torch.stack([train_data[i:i + config.block_size] for i in ix])
+            y = torch.stack([train_data[i + 1:i + config.block_size + 1] for i in ix])
+            return x, y
+
+        print(f"{iterations} batches of {config.batch_size} x {config.block_size} tokens")
+        for name, get_batch in (
+            ("torch.load per batch", reload_every_batch),
+            ("torch.stack loop (cached)", stack_windows),
+            ("TokenDataset (memmap)", lambda: token_dataset.get_batch("train")),
+            ("TokenDataset (in memory)", lambda: in_memory_dataset.get_batch("train")),
+            ("BatchSampler (reused)", in_memory_dataset.sampler("train")),
+        ):
+            start = time.perf_counter()
+            for _ in range(iterations):
+                get_batch()
+            elapsed = time.perf_counter() - start
+            print(f"{name:>26}: {elapsed / iterations * 1000:7.3f} ms/batch")
+
+
+def benchmark_tokenizer(repeats=50):
+    """CharTokenizer encode/decode throughput: per-character lists versus lookup tables"""
+    with open("data/conversation_input.txt", "r", encoding="utf-8") as f:
+        text = f.read() * repeats
+    tokenizer = CharTokenizer(text)
+    megabytes = len(text) / 1e6
+
+    start = time.perf_counter()
+    tokens = tokenizer.encode(text)
+    encode_time = time.perf_counter() - start
+    start = time.perf_counter()
+    token_array = tokenizer.encode_array(text)
+    encode_array_time = time.perf_counter() - start
+    assert token_array.tolist() == tokens
+
+    start = time.perf_counter()
+    decoded = tokenizer.decode(tokens)
+    decode_time = time.perf_counter() - start
+    start = time.perf_counter()
+    decoded_array = tokenizer.decode_array(token_array)
+    decode_array_time = time.perf_counter() - start
+    assert decoded == decoded_array == text
+
+    print(f"{megabytes:.1f}M characters")
+    print(f"encode:       {megabytes / encode_time:8.1f} M chars/sec")
+    print(f"encode_array: {megabytes / encode_array_time:8.1f} M chars/sec")
+    print(f"decode:       {megabytes / decode_time:8.1f} M chars/sec")
+    print(f"decode_array: {megabytes / decode_array_time:8.1f} M chars/sec")
+
+
+def benchmark_stop_criteria(reply_lengths=(100, 500, 2000)):
+    """Stop-string checking cost per reply: re-decoding the reply every step versus StopSequenceMatcher"""
+    tokenizer = load_chat_tokenizer()
+    text = open("data/conversation_input.txt", "r", encoding="utf-8").read()
+    # Replies without stop strings, so both checks run for every token
+    reply = text.replace("\nHuman:", " ").replace("\n\n", " ")
+    for length in reply_lengths:
+        tokens = tokenizer.encode(reply[:length])
+
+        start = time.perf_counter()
+        for i in range(1, len(tokens) + 1):
+            generated_text = tokenizer.decode(tokens[:i])
+            assert not any(stop in generated_text for stop in CHAT_STOP_STRINGS)
+        redecode_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        matcher = StopSequenceMatcher(tokenizer)
+        state = 0
+        for token in tokens:
+            state, stop = matcher.advance(state, token)
+            assert stop is None
+        matcher_time = time.perf_counter() - start
+
+        print(f"{len(tokens):5d} tokens: re-decode {redecode_time * 1000:8.2f} ms, "
+              f"matcher {matcher_time * 1000:6.2f} ms ({redecode_time / matcher_time:.0f}x)")
+
+
+def benchmark_streaming(max_new_tokens=200, repeats=5):
+    """Time to first token when streaming versus waiting for the whole reply"""
+    tokenizer = load_chat_tokenizer()
+    model = build_model(tokenizer.vocab_size)
+    first_token, total = [], []
+    for _ in range(repeats):
+        stats = {}
+        # No stop strings, so every reply has max_new_tokens tokens
+        for _ in stream_generate(model, tokenizer, "Human: Hello!\nAssistant:", max_new_tokens,
+                                 stop_strings=(), stats=stats):
+            pass
+        first_token.append(stats["time_to_first_token"])
+        total.append(stats["seconds"])
+    print(f"{max_new_tokens} tokens, median of {repeats} replies")
+    print(f"Time to first token (streaming): {sorted(first_token)[repeats // 2] * 1000:7.1f} ms")
+    print(f"Full reply (blocking):           {sorted(total)[repeats // 2] * 1000:7.1f} ms")
+
+
+def _train_in_precision(precision, train_steps, eval_batches):
+    """Train a fresh model on the conversation corpus in one precision; runs in its own process"""
+    import resource
+    import numpy as np
+    from dataset import sample_batch
+    from precision import autocast, grad_scaler
+
+    with open("data/conversation_input.txt", "r", encoding="utf-8") as f:
+        text = f.read()
+    tokenizer = CharTokenizer(text)
+    data = tokenizer.encode_array(text).astype(np.int64)
+    n = int(0.9 * len(data))
+    train_data, val_data = data[:n], data[n:]
+
+    model = build_model(tokenizer.vocab_size)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=config.learning_rate)
+    scaler = grad_scaler(precision)
+    generator = torch.Generator().manual_seed(0)
+    if config.device == "cuda":
+        torch.cuda.reset_peak_memory_stats()
+
+    model.train()
+    step_times = []
+    for _ in range(train_steps):
+        xb, yb = (t.to(config.device) for t in sample_batch(train_data, generator=generator))
+        start = time.perf_counter()
+        with autocast(precision):
+            _, loss = model(xb, yb)
+        optimizer.zero_grad()
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+        if config.device == "cuda":
+            torch.cuda.synchronize()
+        step_times.append(time.perf_counter() - start)
+
+    model.eval()
+    val_losses = []
+    with torch.no_grad(), autocast(precision):
+        for _ in range(eval_batches):
+            xb, yb = (t.to(config.device) for t in sample_batch(val_data, generator=generator))
+            val_losses.append(model(xb, yb)[1].item())
+
+    if config.device == "cuda":
+        peak_memory = torch.cuda.max_memory_allocated() / 2**20
+    else:
+        peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KiB on Linux
+    return sorted(step_times)[len(step_times) // 2], peak_memory, sum(val_losses) / len(val_losses)
+
+
+def benchmark_precision(train_steps=300, eval_batches=20):
+    """Step time, peak memory and val loss of fp32 versus mixed-precision training"""
+    import multiprocessing
+
+    precisions = ["fp32", "bf16"] + (["fp16"] if config.device == "cuda" else [])
+    memory = "allocated" if config.device == "cuda" else "process RSS"
+    print(f"{train_steps} steps of {config.batch_size} x {config.block_size} tokens on {config.device}")
+    for precision in precisions:
+        # A fresh process per precision so the peak memory figures don't mix
+        with multiprocessing.get_context("spawn").Pool(1) as pool:
+            step_time, peak_memory, val_loss = pool.apply(
+                _train_in_precision, (precision, train_steps, eval_batches)
+            )
+        print(f"{precision}: {step_time * 1000:6.1f} ms/step | peak {memory} {peak_memory:7.1f} MiB | "
+              f"val loss {val_loss:.4f}")
+
+
+def benchmark_compile(decode_tokens=100, prompt_length=64):
+    """Load (build + warm-up) time and per-token latency of eager vs compiled inference graphs"""
+    from compilation import compile_model
+
+    print(f"Prefill of {prompt_length} tokens, then {decode_tokens} cached decode steps at batch 1 and 8")
+    print(f"{'backend':>11} | {'load s':>7} | {'prefill ms':>10} | {'ms/token':>8} | {'ms/step (8)':>11}")
+    for backend in ("eager", "torchscript", "compile"):
+        model = compile_model(build_model(), backend, verbose=False)
+        row = []
+        for batch_size in (1, 8):
+            torch.manual_seed(0)
+            prompt = torch.randint(0, 65, (batch_size, prompt_length), device=config.device)
+            decoder = IncrementalDecoder(model)
+            decoder.prefill(prompt)  # Shapes not seen during the warm-up
+            start = time.perf_counter()
+            logits = decoder.prefill(prompt)
+            prefill_time = time.perf_counter() - start
+            start = time.perf_counter()
+            for _ in range(decode_tokens):
+                logits = decoder.step(logits.argmax(dim=-1, keepdim=True))
+            row.append((prefill_time, (time.perf_counter() - start) / decode_tokens))
+        print(f"{model.compile_backend:>11} | {model.compile_seconds:>7.2f} | {row[0][0] * 1000:>10.2f} | "
+              f"{row[0][1] * 1000:>8.3f} | {row[1][1] * 1000:>11.3f}")
+
+
+def benchmark_speculative(max_new_tokens=100, draft_lengths=(2, 4, 6)):
+    """Acceptance rate and end-to-end speedup of speculative decoding with the trained draft model"""
+    import os
+    from chat_v2 import load_chat_model
+
+    draft_file = "checkpoints/mini_gpt_v2_draft_best.pt"
+    if not os.path.exists(draft_file):
+        print(f"No draft model at {draft_file}; train one with: python train_v2.py --draft")
+        return
+    model, tokenizer = load_chat_model("v2")
+    draft_model, _ = load_model(draft_file, architecture=model_architecture(
+        tokenizer.vocab_size, config.draft_embed_dim, config.draft_num_heads, config.draft_num_layers))
+    prompts = ["Hello! How are you?", "What's your favorite hobby?", "I'm feeling stressed today.",
+               "Tell me a joke.", "What should I have for dinner?", "I'm learning to code."]
+
+    def run(draft):
+        torch.manual_seed(0)
+        stats_total = {"tokens": 0, "seconds": 0.0, "drafted_tokens": 0, "accepted_tokens": 0}
+        for prompt in prompts:
+            stats = {}
+            # No stop strings, so every reply has max_new_tokens tokens
+            for _ in stream_generate(model, tokenizer, f"Human: {prompt}\nAssistant:", max_new_tokens,
+                                     stop_strings=(), stats=stats, draft_model=draft):
+                pass
+            for key in stats_total:
+                stats_total[key] += stats.get(key, 0)
+        return stats_total
+
+    run(None)  # Warm-up
+    baseline = run(None)
+    baseline_speed = baseline["tokens"] / baseline["seconds"]
+    print(f"{len(prompts)} replies of {max_new_tokens} tokens | draft model: {config.draft_num_layers} layer(s), "
+          f"embed_dim {config.draft_embed_dim}")
+    print(f"{'k':>8} | {'accepted':>8} | {'tokens/target fwd':>17} | {'tokens/sec':>10} | {'speedup':>7}")
+    print(f"{'baseline':>8} | {'':>8} | {1.0:>17.2f} | {baseline_speed:>10,.0f} | {1.0:>6.2f}x")
+    for k in draft_lengths:
+        config.speculative_tokens = k
+        stats = run(draft_model)
+        rounds = stats["drafted_tokens"] / k
+        speed = stats["tokens"] / stats["seconds"]
+        print(f"{k:>8} | {stats['accepted_tokens'] / stats['drafted_tokens']:>8.1%} | "
+              f"{stats['tokens'] / rounds:>17.2f} | {speed:>10,.0f} | {speed / baseline_speed:>6.2f}x")
+
+
+def benchmark_conversation(num_turns=16, reply_tokens=24, repeats=3):
+    """Time to first token per turn of a long conversation: cropped full history versus ConversationContext"""
+    from chat_v2 import stream_response
+    from conversation import ConversationContext
+    from prefix_cache import PrefixCache
+
+    tokenizer = load_chat_tokenizer()
+    model = build_model(tokenizer.vocab_size)
+    user_inputs = ["Hi!", "How are you today?", "Any plans for the weekend?", "Tell me a joke."]
+
+    def run(mode):
+        torch.manual_seed(0)
+        conversation = ConversationContext(tokenizer, model.sequence_length)
+        prefix_cache = PrefixCache() if mode == "context + cache" else None
+        history = ""
+        timings = []
+        for turn in range(num_turns):
+            user_input = user_inputs[turn % len(user_inputs)]
+            stats = {}
+            if mode == "cropped":
+                # Previous behaviour with history: the whole conversation, cropped to block_size by prefill
+                chunks = stream_generate(model, tokenizer, f"{history}Human: {user_input}\nAssistant:", reply_tokens,
+                                         stats=stats)
+            else:
+                chunks = stream_response(model, tokenizer, user_input, reply_tokens, stats=stats,
+                                         conversation=conversation, prefix_cache=prefix_cache)
+            response = "".join(chunks).strip()
+            timings.append(stats["time_to_first_token"])
+            history += f"Human: {user_input}\nAssistant: {response}\n\n"
+            conversation.add_turn(user_input, response)
+        return timings, conversation, prefix_cache
+
+    modes = ("cropped", "context", "context + cache")
+    run("cropped")  # Warm-up
+    results = {mode: [run(mode) for _ in range(repeats)] for mode in modes}
+    buckets = 4
+    bucket_size = max(1, num_turns // buckets)
+    print(f"{num_turns} turns, replies of up to {reply_tokens} tokens, block_size {config.block_size}, "
+          f"median of {repeats} conversations")
+    print(f"Time to first token (ms): {'turns':>7} | " + " | ".join(f"{mode:>15}" for mode in modes))
+    for start in range(0, num_turns, bucket_size):
+        turns = range(start, min(start + bucket_size, num_turns))
+        row = [sorted(sum(timings[turn] for turn in turns) / len(turns) for timings, _, _ in results[mode])
+               [repeats // 2] * 1000 for mode in modes]
+        print(f"{'':>25} {f'{start + 1}-{turns[-1] + 1}':>7} | " + " | ".join(f"{value:>15.1f}" for value in row))
+    _, conversation, prefix_cache = results["context + cache"][-1]
+    stats = prefix_cache.stats()
+    print(f"Retained turns: {len(conversation)} ({conversation.evicted_turns} evicted) | prompt tokens reused: "
+          f"{stats['hit_rate']:.0%} | cache {stats['memory_mib']:.2f} MiB, {stats['evicted_blocks']} blocks evicted")
+
+
+BENCHMARKS = {
+    "kv_cache": benchmark_kv_cache,
+    "throughput": benchmark_throughput,
+    "batched": benchmark_batched,
+    "get_batch": benchmark_get_batch,
+    "tokenizer": benchmark_tokenizer,
+    "stop_criteria": benchmark_stop_criteria,
+    "streaming": benchmark_streaming,
+    "precision": benchmark_precision,
+    "compile": benchmark_compile,
+    "speculative": benchmark_speculative,
+    "conversation": benchmark_conversation,
+}
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print("Available benchmarks: " + ", ".join(BENCHMARKS))
+        sys.exit(1)
+    BENCHMARKS[sys.argv[1]]()
@@ -0,0 +1,165 @@
+# bundle.py
+"""
+Single-file model bundles: architecture, tokenizer and weights together.
+
+A bundle holds plain data only (numbers, strings, lists and tensors), so it loads with
+weights_only=True and mmap=True: the weights are not read into memory at load time but
+paged in from the file as they are used, and processes that load the same bundle (e.g.
+forked server workers) share those pages through the OS page cache. load_model() is
+the one loader for entry points; it prefers an up-to-date bundle next to a checkpoint
+(checkpoints/mini_gpt_v2.bundle for checkpoints/mini_gpt_v2.pt) and otherwise falls
+back to the state dict, a separate tokenizer file and the config.py architecture.
+
+Usage:
+    python bundle.py checkpoints/mini_gpt_v2.pt --tokenizer data/tokenizer_v2.pt [--output ...]
+    python bundle.py checkpoints/mini_gpt_v2.pt --tokenizer data/tokenizer_v2.pt --cold-start
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+import torch
+from model import GPTMiniModel
+from quantization import quantization_warnings_ignored, is_quantized, load_weights, quantize
+from tokenizer import load_tokenizer, tokenizer_from_state, tokenizer_state
+from checkpoint import save_atomic
+import config
+
+BUNDLE_VERSION = 1
+
+
+def model_architecture(vocabulary_size, embedding_dim=None, number_of_heads=None, number_of_layers=None):
+    """GPTMiniModel keyword arguments, defaulting to the config.py architecture"""
+    return dict(
+        vocabulary_size=vocabulary_size,
+        sequence_length=config.block_size,
+        embedding_dim=embedding_dim or config.embed_dim,
+        number_of_heads=number_of_heads or config.num_heads,
+        number_of_layers=number_of_layers or config.num_layers
+    )
+
+
+def bundle_path(checkpoint):
+    return f"{os.path.splitext(checkpoint)[0]}.bundle"
+
+
+def save_bundle(path, state_dict, tokenizer, architecture):
+    """Write weights, tokenizer and GPTMiniModel arguments to one file"""
+    save_atomic({
+        "bundle_version": BUNDLE_VERSION,
+        "architecture": architecture,
+        "tokenizer": tokenizer_state(tokenizer),
+        "state_dict": state_dict,
+    }, path)
+
+
+def load_bundle(path, device=None, int8=None):
+    """
+    (model, tokenizer) from a bundle, with the CPU weights memory-mapped rather than copied.
+    fp32 weights are quantized when int8 (default config.quantize) is set.
+    """
+    device = device or config.device
+    with quantization_warnings_ignored():
+        bundle = torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+    if bundle.get("bundle_version") != BUNDLE_VERSION:
+        raise ValueError(f"{path} is not a version {BUNDLE_VERSION} model bundle")
+    tokenizer = tokenizer_from_state(bundle["tokenizer"])
+    model = GPTMiniModel(**bundle["architecture"])
+    state_dict = bundle["state_dict"]
+    if is_quantized(state_dict):
+        model = quantize(model)
+        model.load_state_dict(state_dict)
+    else:
+        # assign=True makes the mapped tensors the parameters instead of copying them
+        model.load_state_dict(state_dict, assign=True)
+        model = model.to(device)
+        if config.quantize if int8 is None else int8:
+            model = quantize(model)
+    model.eval()
+    return model, tokenizer
+
+
+def load_model(checkpoint, tokenizer_file=None, architecture=None, device=None, prefer_bundle=True, int8=None):
+    """
+    (model, tokenizer) for inference from a bundle or a state dict checkpoint.
+
+    A bundle next to checkpoint is used when it is at least as new. Otherwise the
+    state dict is loaded into a model built from architecture (default: config.py for
+    the vocabulary of tokenizer_file) and the tokenizer from tokenizer_file, which is
+    None when only an architecture is passed. int8 is passed on to load_weights.
+    """
+    bundle_file = checkpoint if checkpoint.endswith(".bundle") else bundle_path(checkpoint)
+    if prefer_bundle and os.path.exists(bundle_file) and (
+            not os.path.exists(checkpoint) or os.path.getmtime(bundle_file) >= os.path.getmtime(checkpoint)):
+        return load_bundle(bundle_file, device, int8)
+    if tokenizer_file is None and architecture is None:
+        raise ValueError(f"No bundle for {checkpoint}; pass the tokenizer file it was trained with")
+    tokenizer = load_tokenizer(tokenizer_file) if tokenizer_file else None
+    architecture = architecture or model_architecture(tokenizer.vocab_size)
+    model = GPTMiniModel(**architecture).to(device or config.device)
+    return load_weights(model, checkpoint, int8), tokenizer
+
+
+_COLD_START_SCRIPT = """
+import sys
+import time
+start = time.perf_counter()
+from bundle import load_model
+from compilation import compile_model
+from generation import stream_generate
+imported = time.perf_counter()
+model, tokenizer = load_model(sys.argv[1], sys.argv[2], prefer_bundle=sys.argv[3] == "bundle")
+model = compile_model(model, verbose=False)
+loaded = time.perf_counter()
+next(stream_generate(model, tokenizer, "Human: Hello!\\nAssistant:", stop_strings=()))
+print(imported - start, loaded - imported, time.perf_counter() - loaded)
+"""
+
+
+def cold_start(checkpoint, tokenizer_file, repeats=9):
+    """
+    Seconds from launching a fresh Python process to its first generated token, per load
+    path, split into imports, loading the model and generating the first token.
+    """
+    results = {}
+    for mode in ("state dict", "bundle"):
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            # The process exits right after the first token, so its lifetime is the cold start
+            output = subprocess.run(
+                [sys.executable, "-c", _COLD_START_SCRIPT, checkpoint, tokenizer_file, mode.split()[0]],
+                check=True, capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+            ).stdout
+            timings.append([time.perf_counter() - start] + [float(value) for value in output.split()[-3:]])
+        results[mode] = [sorted(column)[repeats // 2] for column in zip(*timings)]
+    print(f"\n📊 Cold start to first token ({checkpoint}, median of {repeats} processes, ms)")
+    print(f"{'':>10} | {'process':>7} | {'imports':>7} | {'load':>7} | {'first token':>11}")
+    for mode, (total, imports, load, first_token) in results.items():
+        print(f"{mode:>10} | {total * 1000:>7.0f} | {imports * 1000:>7.0f} | {load * 1000:>7.1f} | "
+              f"{first_token * 1000:>11.1f}")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bundle a checkpoint with its tokenizer and architecture")
+    parser.add_argument("checkpoint", help="State dict, e.g. checkpoints/mini_gpt_v2.pt")
+    parser.add_argument("--tokenizer", required=True, help="Tokenizer file, e.g. data/tokenizer_v2.pt")
+    parser.add_argument("--output", help="Default: the checkpoint path with a .bundle extension")
+    parser.add_argument("--draft", action="store_true", help="The checkpoint has the config.draft_* architecture")
+    parser.add_argument("--cold-start", action="store_true", help="Also time process start to first token")
+    args = parser.parse_args()
+
+    tokenizer = load_tokenizer(args.tokenizer)
+    if args.draft:
+        architecture = model_architecture(tokenizer.vocab_size, config.draft_embed_dim, config.draft_num_heads,
+                                          config.draft_num_layers)
+    else:
+        architecture = model_architecture(tokenizer.vocab_size)
+    model, _ = load_model(args.checkpoint, args.tokenizer, architecture, device="cpu", prefer_bundle=False)
+    output = args.output or bundle_path(args.checkpoint)
+    save_bundle(output, model.state_dict(), tokenizer, architecture)
+    print(f"✅ Saved {output} ({os.path.getsize(output) / 2 ** 20:.2f} MiB)")
+    if args.cold_start:
+        cold_start(args.checkpoint, args.tokenizer)
@@ -0,0 +1,427 @@
+# chat_server.py
+"""
+Continuous-batching chat server.
+
+Incoming requests are queued and join the in-flight batch at the next decode step;
+finished requests leave it immediately, so many users share every forward pass.
+
+Usage:
+    python chat_server.py [--port 8000] [--max-batch-size 16] [--max-queue-wait 0.01] [--prefix-cache]
+    python chat_server.py loadtest [--requests 64] [--concurrency 16] [--stream]
+
+Endpoints:
+    POST /chat   {"message": "Hello!", "max_tokens": 80, "temperature": 0.8, "stream": false}
+                 with "stream": true the reply arrives as newline-delimited JSON chunks
+    GET  /stats  request latency percentiles, tokens/sec and queue depth
+"""
+import argparse
+import asyncio
+import collections
+import json
+import math
+import time
+import torch
+import torch.nn.functional as F
+from generation import IncrementalDecoder, StopSequenceMatcher, TextStreamer, left_pad
+from prefix_cache import PrefixCache
+import config
+
+class ChatRequest:
+    def __init__(self, prompt_tokens, max_tokens, temperature, stop_matcher):
+        self.prompt_tokens = prompt_tokens
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.generated_tokens = []
+        self.streamer = TextStreamer(stop_matcher)
+        self.new_text = ""  # Text produced by the latest step, not yet delivered
+        self.chunks = asyncio.Queue()  # Delivered text chunks, then None once finished
+        self.error = None  # Why generation failed, if it did
+        self.arrival_time = time.perf_counter()
+
+
+class ServerStats:
+    """Rolling latency window plus lifetime token counters"""
+
+    def __init__(self, window=1000):
+        self.latencies = collections.deque(maxlen=window)
+        self.first_token_latencies = collections.deque(maxlen=window)
+        self.completed_requests = 0
+        self.failed_requests = 0
+        self.generated_tokens = 0
+        self.busy_seconds = 0.0  # Time spent running the model
+        self.start_time = time.perf_counter()
+
+    @staticmethod
+    def percentile(values, q):
+        if not values:
+            return 0.0
+        ordered = sorted(values)
+        return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+    def snapshot(self, queue_depth, batch_size):
+        return {
+            "completed_requests": self.completed_requests,
+            "failed_requests": self.failed_requests,
+            "generated_tokens": self.generated_tokens,
+            "p50_latency": self.percentile(self.latencies, 50),
+            "p99_latency": self.percentile(self.latencies, 99),
+            "p50_time_to_first_token": self.percentile(self.first_token_latencies, 50),
+            "p99_time_to_first_token": self.percentile(self.first_token_latencies, 99),
+            "tokens_per_second": self.generated_tokens / self.busy_seconds if self.busy_seconds else 0.0,
+            "uptime": time.perf_counter() - self.start_time,
+            "queue_depth": queue_depth,
+            "batch_size": batch_size,
+        }
+
+
+class ContinuousBatchScheduler:
+    """Decode queued chat requests together, admitting and retiring them at step boundaries"""
+
+    def __init__(self, model, tokenizer, max_batch_size=None, max_queue_wait=None, prefix_cache=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size or config.max_batch_size
+        self.max_queue_wait = config.max_queue_wait if max_queue_wait is None else max_queue_wait
+        self.queue = asyncio.Queue()
+        # Requests sharing a prompt prefix (e.g. a repeated question) reuse its keys/values. Off
+        # by default: cached prefixes need unpadded prompts, so admitted prompts are then
+        # prefilled one by one, which costs more than one padded batch unless prompts are
+        # long and shared.
+        prefix_cache = config.server_prefix_cache if prefix_cache is None else prefix_cache
+        self.prefix_cache = PrefixCache() if prefix_cache and config.prefix_cache_mib else None
+        self.decoder = IncrementalDecoder(model, prefix_cache=self.prefix_cache)
+        self.stop_matcher = StopSequenceMatcher(tokenizer)
+        self.active = []     # ChatRequest for each row of the batch
+        self.logits = None   # (B, vocab) next-token logits for each row
+        self.retired = []    # Requests the current step has finished so far
+        self.stats = ServerStats()
+
+    def new_request(self, message, max_tokens=80, temperature=0.8):
+        """A ChatRequest for message; raises ValueError for settings or text the model can't serve"""
+        if not (math.isfinite(temperature) and temperature > 0):
+            raise ValueError(f"temperature must be a positive number, got {temperature}")
+        if max_tokens < 1:
+            raise ValueError(f"max_tokens must be at least 1, got {max_tokens}")
+        try:
+            prompt_tokens = self.tokenizer.encode(f"Human: {message}\nAssistant:")
+        except KeyError as e:
+            raise ValueError(f"message contains {e.args[0]!r}, which is not in the model's vocabulary") from None
+        return ChatRequest(prompt_tokens, max_tokens, temperature, self.stop_matcher)
+
+    async def stream(self, request):
+        """Async iterator over the reply's text chunks as the batch generates them"""
+        await self.queue.put(request)
+        while True:
+            chunk = await request.chunks.get()
+            if chunk is None:
+                return
+            yield chunk
+
+    async def submit(self, request):
+        """The whole reply; raises RuntimeError if generating it failed"""
+        chunks = [chunk async for chunk in self.stream(request)]
+        if request.error is not None:
+            raise RuntimeError(request.error)
+        return "".join(chunks).strip()
+
+    async def _admit(self):
+        """Take as many queued requests as fit in the batch"""
+        admitted = []
+        if not self.active:
+            # Idle: wait for a request, then give others max_queue_wait to share its prefill
+            admitted.append(await self.queue.get())
+            deadline = time.perf_counter() + self.max_queue_wait
+            while len(admitted) < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    admitted.append(await asyncio.wait_for(self.queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+        while len(self.active) + len(admitted) < self.max_batch_size and not self.queue.empty():
+            admitted.append(self.queue.get_nowait())
+        return admitted
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            admitted = await self._admit()
+            start = time.perf_counter()
+            try:
+                # The model runs off the event loop so connections keep being accepted
+                finished = await loop.run_in_executor(None, self._step, admitted)
+            except Exception as e:
+                finished = self._abort(admitted, e)
+            self.stats.busy_seconds += time.perf_counter() - start
+
+            now = time.perf_counter()
+            for request in admitted:
+                if request.error is None:
+                    self.stats.first_token_latencies.append(now - request.arrival_time)
+            for request in self.active + finished:
+                if request.new_text:
+                    request.chunks.put_nowait(request.new_text)
+                    request.new_text = ""
+            for request in finished:
+                if request.error is None:
+                    self.stats.latencies.append(now - request.arrival_time)
+                    self.stats.completed_requests += 1
+                else:
+                    self.stats.failed_requests += 1
+                request.chunks.put_nowait(None)
+
+    def _abort(self, admitted, error):
+        """End every request in the batch after a failure that can't be traced to one of them"""
+        print(f"⚠️ Decode step failed ({type(error).__name__}: {error}); ending the current batch")
+        failed = []
+        for request in self.active + admitted:
+            if request not in failed and request not in self.retired:
+                failed.append(request)
+        for request in failed:
+            request.error = f"{type(error).__name__}: {error}"
+        # Requests retired earlier in the failed step still get their reply
+        finished = failed + self.retired
+        self.active, self.logits, self.retired = [], None, []
+        self.decoder.reset()
+        return finished
+
+    def _prefill(self, admitted):
+        """Add admitted requests to the batch; returns the ones whose prefill failed"""
+        if self.prefix_cache is not None and len(admitted) > 1:
+            # One unpadded prefill per prompt, so each can start from its cached prefix
+            return [request for one in admitted for request in self._prefill([one])]
+        try:
+            if self.prefix_cache is None:
+                tokens, attention_mask = left_pad([request.prompt_tokens for request in admitted],
+                                                  device=config.device)
+                new_logits = self.decoder.add_rows(tokens, attention_mask)
+            else:
+                tokens = torch.tensor([admitted[0].prompt_tokens], dtype=torch.long, device=config.device)
+                new_logits = self.decoder.add_rows(tokens)
+        except Exception as e:
+            if len(admitted) == 1:
+                admitted[0].error = f"{type(e).__name__}: {e}"
+                return admitted
+            # Admit them one at a time, so only the request that fails is dropped
+            return [request for one in admitted for request in self._prefill([one])]
+        self.logits = new_logits if self.logits is None else torch.cat((self.logits, new_logits), dim=0)
+        self.active.extend(admitted)
+        return []
+
+    @torch.no_grad()
+    def _step(self, admitted):
+        """
+        Prefill admitted requests into the batch, sample one token per row and retire finished
+        rows. Returns the finished requests, including admitted ones that failed to prefill.
+        """
+        self.retired = self._prefill(admitted) if admitted else []
+        if not self.active:
+            return self.retired
+
+        temperatures = torch.tensor([[request.temperature] for request in self.active], device=config.device)
+        probs = F.softmax(self.logits / temperatures, dim=-1)
+        next_tokens = torch.multinomial(probs, num_samples=1)
+        self.stats.generated_tokens += len(self.active)
+
+        keep_rows, finished = [], []
+        for row, (request, token) in enumerate(zip(self.active, next_tokens[:, 0].tolist())):
+            request.generated_tokens.append(token)
+            request.new_text += request.streamer.push(token)
+            if request.streamer.stopped or len(request.generated_tokens) >= request.max_tokens:
+                request.new_text += request.streamer.flush()
+                finished.append(request)
+                self.retired.append(request)
+            else:
+                keep_rows.append(row)
+
+        if finished:
+            self.active = [self.active[row] for row in keep_rows]
+            self.decoder.select(keep_rows)
+            if not keep_rows:
+                self.logits = None
+                return self.retired
+            next_tokens = next_tokens[keep_rows]
+        self.logits = self.decoder.step(next_tokens)
+        return self.retired
+
+
+async def read_http_request(reader):
+    request_line = (await reader.readline()).decode()
+    method, path, _ = request_line.split(" ", 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode().partition(":")
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get("content-length", 0)))
+    return method, path, body
+
+
+def write_http_response(writer, status, payload):
+    body = json.dumps(payload).encode()
+    reason = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error"}[status]
+    writer.write(
+        f"HTTP/1.1 {status} {reason}\r\nContent-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+    )
+
+
+async def write_streaming_response(writer, scheduler, request):
+    """Send each text chunk as a line of JSON as soon as it is produced, then a summary line"""
+    writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\nConnection: close\r\n\r\n")
+    start = time.perf_counter()
+    first_chunk_time = None
+    async for chunk in scheduler.stream(request):
+        if first_chunk_time is None:
+            first_chunk_time = time.perf_counter() - start
+        writer.write(json.dumps({"text": chunk}).encode() + b"\n")
+        await writer.drain()
+    summary = {"done": True, "latency": time.perf_counter() - start, "time_to_first_chunk": first_chunk_time}
+    if request.error is not None:
+        summary["error"] = request.error
+    writer.write(json.dumps(summary).encode() + b"\n")
+
+
+def make_handler(scheduler):
+    async def handle_connection(reader, writer):
+        try:
+            method, path, body = await read_http_request(reader)
+            if method == "POST" and path == "/chat":
+                data = json.loads(body or b"{}")
+                if not isinstance(data, dict):
+                    raise TypeError(f"expected a JSON object, got {type(data).__name__}")
+                # Bad settings and unencodable text are rejected here, before the request joins the batch
+                request = scheduler.new_request(str(data["message"]), int(data.get("max_tokens", 80)),
+                                                float(data.get("temperature", 0.8)))
+                if data.get("stream"):
+                    await write_streaming_response(writer, scheduler, request)
+                    await writer.drain()
+                    writer.close()
+                    return
+                start = time.perf_counter()
+                try:
+                    response = await scheduler.submit(request)
+                    status, payload = 200, {"response": response, "latency": time.perf_counter() - start}
+                except RuntimeError as e:
+                    status, payload = 500, {"error": str(e)}
+            elif method == "GET" and path == "/stats":
+                status, payload = 200, scheduler.stats.snapshot(scheduler.queue.qsize(), len(scheduler.active))
+                if scheduler.prefix_cache is not None:
+                    payload["prefix_cache"] = scheduler.prefix_cache.stats()
+            else:
+                status, payload = 404, {"error": f"No route for {method} {path}"}
+        except (ValueError, KeyError, TypeError) as e:
+            status, payload = 400, {"error": str(e)}
+        write_http_response(writer, status, payload)
+        await writer.drain()
+        writer.close()
+
+    return handle_connection
+
+
+async def serve(host, port, max_batch_size, max_queue_wait, version="v2", prefix_cache=None):
+    from chat_v2 import load_chat_model
+
+    model, tokenizer = load_chat_model(version)
+    scheduler = ContinuousBatchScheduler(model, tokenizer, max_batch_size, max_queue_wait, prefix_cache)
+    server = await asyncio.start_server(make_handler(scheduler), host, port)
+    print(f"🚀 Chat server listening on http://{host}:{port} "
+          f"(max batch size {scheduler.max_batch_size}, max queue wait {scheduler.max_queue_wait}s, "
+          f"prefix cache {'on' if scheduler.prefix_cache is not None else 'off'})")
+    async with server:
+        await asyncio.gather(server.serve_forever(), scheduler.run())
+
+
+async def http_request(host, port, method, path, payload=None):
+    """Minimal HTTP client used by the load generator"""
+    reader, writer = await asyncio.open_connection(host, port)
+    body = json.dumps(payload).encode() if payload is not None else b""
+    writer.write(
+        f"{method} {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+    )
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    return json.loads(response.split(b"\r\n\r\n", 1)[1])
+
+
+async def streaming_request(host, port, payload):
+    """POST a streaming chat request; returns the seconds until the first text chunk arrived"""
+    reader, writer = await asyncio.open_connection(host, port)
+    body = json.dumps(dict(payload, stream=True)).encode()
+    start = time.perf_counter()
+    writer.write(
+        f"POST /chat HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+    )
+    await writer.drain()
+    while await reader.readline() not in (b"\r\n", b""):
+        pass  # Headers
+    first_chunk_time = None
+    async for line in reader:
+        if first_chunk_time is None and "text" in json.loads(line):
+            first_chunk_time = time.perf_counter() - start
+    writer.close()
+    return first_chunk_time
+
+
+async def load_test(host, port, num_requests, concurrency, max_tokens, stream=False):
+    """Fire num_requests chat requests with at most concurrency in flight and report latency"""
+    messages = ["Hello!", "How are you today?", "Tell me a joke.", "I'm learning to code.",
+                "What should I have for dinner?", "I'm feeling stressed today."]
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    first_chunk_latencies = []
+
+    async def one_request(i):
+        async with semaphore:
+            start = time.perf_counter()
+            payload = {"message": messages[i % len(messages)], "max_tokens": max_tokens}
+            if stream:
+                first_chunk_time = await streaming_request(host, port, payload)
+                if first_chunk_time is not None:
+                    first_chunk_latencies.append(first_chunk_time)
+            else:
+                await http_request(host, port, "POST", "/chat", payload)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one_request(i) for i in range(num_requests)))
+    elapsed = time.perf_counter() - start
+
+    print(f"📊 {num_requests} requests, concurrency {concurrency}, {elapsed:.2f}s total "
+          f"({num_requests / elapsed:.1f} requests/sec)")
+    print(f"Client latency p50: {ServerStats.percentile(latencies, 50):.3f}s | "
+          f"p99: {ServerStats.percentile(latencies, 99):.3f}s")
+    if first_chunk_latencies:
+        print(f"Client time to first chunk p50: {ServerStats.percentile(first_chunk_latencies, 50):.3f}s | "
+              f"p99: {ServerStats.percentile(first_chunk_latencies, 99):.3f}s")
+    print("Server stats:", json.dumps(await http_request(host, port, "GET", "/stats"), indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Continuous-batching chat server")
+    parser.add_argument("mode", nargs="?", choices=["serve", "loadtest"], default="serve")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--version", default="v2", help="Model version passed to load_chat_model")
+    parser.add_argument("--max-batch-size", type=int, default=config.max_batch_size)
+    parser.add_argument("--max-queue-wait", type=float, default=config.max_queue_wait)
+    parser.add_argument("--prefix-cache", action="store_true", default=config.server_prefix_cache,
+                        help="Reuse keys/values of shared prompt prefixes (prefills admitted prompts one by one)")
+    parser.add_argument("--requests", type=int, default=64, help="loadtest: total requests")
+    parser.add_argument("--concurrency", type=int, default=16, help="loadtest: requests in flight")
+    parser.add_argument("--max-tokens", type=int, default=80, help="loadtest: tokens per response")
+    parser.add_argument("--stream", action="store_true", help="loadtest: request streamed replies")
+    args = parser.parse_args()
+
+    if args.mode == "loadtest":
+        asyncio.run(load_test(args.host, args.port, args.requests, args.concurrency, args.max_tokens,
+                              args.stream))
+    else:
+        asyncio.run(serve(args.host, args.port, args.max_batch_size, args.max_queue_wait, args.version,
+                          args.prefix_cache))
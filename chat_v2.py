@@ -1,103 +1,96 @@
-import torch
-import torch.nn.functional as F
-from model import GPTMiniModel
-from tokenizer import CharTokenizer
+import os
+from generation import generate_batch, stream_generate
+from bundle import bundle_path, load_model, model_architecture
+from compilation import compile_model
+from prefix_cache import PrefixCache
+from conversation import ConversationContext
+from tokenizer import load_tokenizer, tokenizer_path
 import config
 
 def load_chat_model(version="v2"):
     """Load the conversational model and tokenizer"""
     print(f"Loading conversational model v{version}...")
     
-    # Load tokenizer
-    tokenizer_file = f"data/tokenizer_{version}.pt" if version != "v1" else "data/tokenizer.pt"
-    with torch.serialization.safe_globals({"tokenizer.CharTokenizer": CharTokenizer}):
-        tokenizer = torch.load(tokenizer_file, weights_only=False)
+    tokenizer_file = tokenizer_path(f"tokenizer_{version}" if version != "v1" else "tokenizer")
     
-    # Update config with vocabulary size
-    config.vocab_size = tokenizer.vocab_size
-    
-    # Initialize model
-    model = GPTMiniModel(
-        vocabulary_size=config.vocab_size,
-        sequence_length=config.block_size,
-        embedding_dim=config.embed_dim,
-        number_of_heads=config.num_heads,
-        number_of_layers=config.num_layers
-    ).to(config.device)
-    
-    # Load weights
+    # Load the bundle or weights, falling back to the best checkpoint
     model_file = f"checkpoints/mini_gpt_{version}.pt"
     try:
-        model.load_state_dict(torch.load(model_file, map_location=config.device))
+        model, tokenizer = load_model(model_file, tokenizer_file)
     except FileNotFoundError:
         model_file = f"checkpoints/mini_gpt_{version}_best.pt"
-        model.load_state_dict(torch.load(model_file, map_location=config.device))
+        model, tokenizer = load_model(model_file, tokenizer_file)
+    model = compile_model(model)
     
-    model.eval()
     print(f"Model loaded from {model_file}")
     print(f"Vocabulary size: {tokenizer.vocab_size}")
     
     return model, tokenizer
 
-def generate_response(model, tokenizer, user_input, max_tokens=100, temperature=0.8):
-    """Generate a conversational response"""
-    model.eval()
-    
+def load_draft_model(version="v2"):
+    """Load the draft model for speculative decoding; None if it is disabled or not trained"""
+    model_file = f"checkpoints/mini_gpt_{version}_draft_best.pt"
+    if not config.speculative_tokens or not (os.path.exists(model_file) or os.path.exists(bundle_path(model_file))):
+        return None
+    
+    # Same tokenizer and context length as the chat model, smaller architecture
+    tokenizer_file = tokenizer_path(f"tokenizer_{version}" if version != "v1" else "tokenizer")
+    vocabulary_size = load_tokenizer(tokenizer_file).vocab_size
+    architecture = model_architecture(vocabulary_size, config.draft_embed_dim, config.draft_num_heads,
+                                      config.draft_num_layers)
+    model, _ = load_model(model_file, tokenizer_file, architecture)
+    model = compile_model(model)
+    
+    print(f"Draft model loaded from {model_file} ({config.speculative_tokens} tokens per verification)")
+    return model
+
+def stream_response(model, tokenizer, user_input, max_tokens=100, temperature=0.8, stats=None, draft_model=None,
+                    conversation=None, prefix_cache=None):
+    """
+    Yield a conversational response as text chunks while it is generated.
+
+    With a ConversationContext the prompt starts with its retained earlier turns; a
+    prefix_cache then reuses their keys/values from the previous turn.
+    """
     # Format the input as a conversation
-    prompt = f"Human: {user_input}\nAssistant:"
-    
-    # Encode the prompt
-    context = torch.tensor(tokenizer.encode(prompt), dtype=torch.long, device=config.device)
-    context = context.unsqueeze(0)  # Add batch dimension
-    
-    with torch.no_grad():
-        for _ in range(max_tokens):
-            # Crop context if too long
-            context_cropped = context[:, -config.block_size:]
-            logits = model(context_cropped)
-            
-            # Focus on the last token
-            logits = logits[:, -1, :] / temperature
-            
-            # Apply softmax
-            probs = F.softmax(logits, dim=-1)
-            
-            # Sample next token
-            next_token = torch.multinomial(probs, num_samples=1)
-            
-            # Check if we hit a natural stopping point (end of assistant response)
-            next_char = tokenizer.decode([next_token.item()])
-            
-            # Append to sequence
-            context = torch.cat((context, next_token), dim=1)
-            
-            # Stop if we encounter a human turn or double newline
-            generated_text = tokenizer.decode(context[0].tolist())
-            if "\nHuman:" in generated_text[len(prompt):] or generated_text.endswith("\n\n"):
-                break
-    
-    # Extract just the assistant's response
-    generated_text = tokenizer.decode(context[0].tolist())
-    assistant_response = generated_text[len(prompt):].strip()
-    
-    # Clean up the response - remove any "Human:" that might have been generated
-    if "\nHuman:" in assistant_response:
-        assistant_response = assistant_response.split("\nHuman:")[0].strip()
+    if conversation is None:
+        prompt = f"Human: {user_input}\nAssistant:"
+    else:
+        prompt = conversation.prompt(user_input)
     
-    return assistant_response
+    # Stop at a human turn or double newline (end of assistant response)
+    return stream_generate(model, tokenizer, prompt, max_new_tokens=max_tokens, temperature=temperature,
+                           stats=stats, draft_model=draft_model, prefix_cache=prefix_cache)
+
+def generate_response(model, tokenizer, user_input, max_tokens=100, temperature=0.8, draft_model=None):
+    """Generate a conversational response"""
+    return "".join(stream_response(model, tokenizer, user_input, max_tokens, temperature,
+                                   draft_model=draft_model)).strip()
+
+def generate_responses(model, tokenizer, user_inputs, max_tokens=100, temperature=0.8):
+    """Generate conversational responses for several inputs in a single batch"""
+    prompts = [f"Human: {user_input}\nAssistant:" for user_input in user_inputs]
+    generated_texts = generate_batch(model, tokenizer, prompts, max_new_tokens=max_tokens,
+                                     temperature=temperature)
+    
+    # Keep just the assistant's response, as generate_response does
+    return [text.split("\nHuman:")[0].strip() for text in generated_texts]
 
 def chat_interface():
     """Interactive chat interface"""
     print("🤖 ChatGPT Mini v2 - Conversational Mode")
     print("=" * 50)
-    print("Type 'quit' to exit, 'clear' to clear history")
+    print("Type 'quit' to exit, 'clear' to clear history, 'cache' for prefix cache stats")
     print("Type 'switch v1' to use the Shakespeare model")
     print("=" * 50)
     
     current_version = "v2"
     model, tokenizer = load_chat_model(current_version)
+    draft_model = load_draft_model(current_version)
+    # Keys/values of the conversation so far, so each turn only runs the model on new text
+    prefix_cache = PrefixCache() if config.prefix_cache_mib else None
     
-    conversation_history = []
+    conversation = ConversationContext(tokenizer, model.sequence_length)
     
     while True:
         user_input = input("\n🧑 You: ").strip()
@@ -106,9 +99,18 @@ def chat_interface():
             print("\n👋 Goodbye! Thanks for chatting!")
             break
         elif user_input.lower() == 'clear':
-            conversation_history = []
+            conversation.clear()
             print("\n🗑️ Conversation history cleared!")
             continue
+        elif user_input.lower() == 'cache':
+            if prefix_cache is None:
+                print("\nPrefix cache disabled (config.prefix_cache_mib = 0)")
+            else:
+                stats = prefix_cache.stats()
+                print(f"\n📊 Prefix cache: {stats['hit_rate']:.0%} of prompt tokens reused "
+                      f"({stats['hit_tokens']}/{stats['lookup_tokens']}), {stats['blocks']} blocks, "
+                      f"{stats['memory_mib']:.2f} MiB, {stats['evicted_blocks']} evicted")
+            continue
         elif user_input.lower().startswith('switch'):
             if 'v1' in user_input.lower():
                 current_version = "v1"
@@ -119,6 +121,9 @@ def chat_interface():
             
             try:
                 model, tokenizer = load_chat_model(current_version)
+                draft_model = load_draft_model(current_version)
+                prefix_cache = PrefixCache() if config.prefix_cache_mib else None
+                conversation = ConversationContext(tokenizer, model.sequence_length)
                 print(f"✅ Successfully switched to version {current_version}")
             except Exception as e:
                 print(f"❌ Error switching models: {e}")
@@ -129,13 +134,20 @@ def chat_interface():
         # Generate response
         try:
             print("\n🤖 Assistant: ", end="", flush=True)
-            response = generate_response(model, tokenizer, user_input, 
-                                       max_tokens=80, temperature=0.8)
-            print(response)
+            response = ""
+            for chunk in stream_response(model, tokenizer, user_input, max_tokens=80, temperature=0.8,
+                                         draft_model=draft_model, conversation=conversation,
+                                         prefix_cache=prefix_cache):
+                # Print as the reply is generated, skipping the leading space after "Assistant:"
+                if not response:
+                    chunk = chunk.lstrip()
+                response += chunk
+                print(chunk, end="", flush=True)
+            print()
+            response = response.strip()
             
             # Add to conversation history
-            conversation_history.append(f"Human: {user_input}")
-            conversation_history.append(f"Assistant: {response}")
+            conversation.add_turn(user_input, response)
             
         except Exception as e:
             print(f"❌ Error generating response: {e}")
@@ -160,9 +172,10 @@ def test_chat_model():
         "What do you think about artificial intelligence?"
     ]
     
-    for i, prompt in enumerate(test_prompts, 1):
+    responses = generate_responses(model, tokenizer, test_prompts, max_tokens=60, temperature=0.8)
+    
+    for i, (prompt, response) in enumerate(zip(test_prompts, responses), 1):
         print(f"\n🧑 Test {i}: {prompt}")
-        response = generate_response(model, tokenizer, prompt, max_tokens=60, temperature=0.8)
         print(f"🤖 Assistant: {response}")
         print("-" * 40)
 
@@ -1,7 +1,7 @@
-import torch
-import torch.nn.functional as F
-from model import GPTMiniModel
-from tokenizer import CharTokenizer
+from generation import stream_generate
+from bundle import load_model
+from compilation import compile_model
+from tokenizer import tokenizer_path
 import config
 import re
 
@@ -10,77 +10,25 @@ class ChatBot:
         """Initialize the chatbot with trained model"""
         print("🤖 Loading ChatBot V2...")
         
-        # Load tokenizer
-        with torch.serialization.safe_globals({"tokenizer.CharTokenizer": CharTokenizer}):
-            self.tokenizer = torch.load("data/tokenizer.pt", weights_only=False)
-        
-        # Update config
-        config.vocab_size = self.tokenizer.vocab_size
-        
-        # Load model
-        self.model = GPTMiniModel(
-            vocabulary_size=config.vocab_size,
-            sequence_length=config.block_size,
-            embedding_dim=config.embed_dim,
-            number_of_heads=config.num_heads,
-            number_of_layers=config.num_layers
-        ).to(config.device)
-        
-        self.model.load_state_dict(torch.load(model_path, map_location=config.device))
-        self.model.eval()
+        # Load the bundle or weights and tokenizer
+        self.model, self.tokenizer = load_model(model_path, tokenizer_path("tokenizer"))
+        self.model = compile_model(self.model)
         
         print(f"✅ ChatBot loaded! Vocabulary size: {self.tokenizer.vocab_size}")
         print(f"🧠 Model architecture: {config.num_layers} layers, {config.num_heads} heads, {config.embed_dim} embed_dim")
     
-    def generate_response(self, user_input, max_new_tokens=150, temperature=0.8):
-        """Generate a response to user input"""
+    def stream_response(self, user_input, max_new_tokens=150, temperature=0.8, stats=None):
+        """Yield a response to user input as text chunks while it is generated"""
         # Format the input as a conversation
         prompt = f"Human: {user_input}\nAssistant:"
         
-        # Encode the prompt
-        context = torch.tensor(self.tokenizer.encode(prompt), dtype=torch.long, device=config.device)
-        context = context.unsqueeze(0)  # Add batch dimension
-        
-        generated_tokens = []
-        
-        with torch.no_grad():
-            for _ in range(max_new_tokens):
-                # Crop context to fit block size
-                context_cropped = context[:, -config.block_size:]
-                logits = self.model(context_cropped)
-                
-                # Get logits for the last token
-                logits = logits[:, -1, :] / temperature
-                
-                # Apply softmax and sample
-                probs = F.softmax(logits, dim=-1)
-                next_token = torch.multinomial(probs, num_samples=1)
-                
-                # Check if we've hit a natural stopping point
-                next_char = self.tokenizer.decode([next_token.item()])
-                generated_tokens.append(next_token.item())
-                
-                # Stop if we encounter a human prompt or double newline (conversation boundary)
-                generated_so_far = self.tokenizer.decode(generated_tokens)
-                if "\nHuman:" in generated_so_far or "\n\n" in generated_so_far:
-                    break
-                
-                # Append to context for next iteration
-                context = torch.cat((context, next_token), dim=1)
-        
-        # Decode the full generated sequence
-        full_response = self.tokenizer.decode(context[0].tolist())
-        
-        # Extract just the assistant's response
-        if "Assistant:" in full_response:
-            response = full_response.split("Assistant:")[-1].strip()
-            # Clean up the response
-            response = response.split("\nHuman:")[0].strip()
-            response = response.split("\n\n")[0].strip()
-        else:
-            response = "I'm not sure how to respond to that."
-        
-        return response
+        # Stop if we encounter a human prompt or double newline (conversation boundary)
+        return stream_generate(self.model, self.tokenizer, prompt, max_new_tokens=max_new_tokens,
+                               temperature=temperature, stats=stats)
+    
+    def generate_response(self, user_input, max_new_tokens=150, temperature=0.8):
+        """Generate a response to user input"""
+        return "".join(self.stream_response(user_input, max_new_tokens, temperature)).strip()
     
     def chat(self):
         """Start an interactive chat session"""
@@ -113,8 +61,14 @@ class ChatBot:
                 continue
             
             print("🤖 Assistant: ", end="", flush=True)
-            response = self.generate_response(user_input)
-            print(response)
+            started = False
+            for chunk in self.stream_response(user_input):
+                # Print as the reply is generated, skipping the leading space after "Assistant:"
+                if not started:
+                    chunk = chunk.lstrip()
+                    started = bool(chunk)
+                print(chunk, end="", flush=True)
+            print()
 
 def quick_test():
     """Quick test of the chatbot with preset questions"""
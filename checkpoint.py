@@ -0,0 +1,124 @@
+# checkpoint.py
+"""
+Full training checkpoints that a killed run can resume from.
+
+A training checkpoint holds the model and optimizer state, the iteration, the best
+validation loss, the RNG states, the position of the training batch stream and a
+snapshot of config.py. Files are replaced atomically (write to a temporary file, then
+os.replace), so a crash mid-write leaves the previous checkpoint intact, and
+CheckpointWriter does the serialising and disk I/O on a background thread.
+"""
+import os
+import queue
+import threading
+import torch
+import config
+
+
+def snapshot(state):
+    """Copy every tensor in a (nested) state dict to the CPU, detached from training"""
+    if isinstance(state, torch.Tensor):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        return {key: snapshot(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(value) for value in state)
+    return state
+
+
+def rng_state():
+    state = {"torch": torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def config_snapshot():
+    """Plain settings from config.py (numbers, strings, booleans)"""
+    return {
+        name: value for name, value in vars(config).items()
+        if not name.startswith("_") and isinstance(value, (bool, int, float, str, type(None)))
+    }
+
+
+def config_differences(saved):
+    """Settings whose current value differs from a snapshot, as {name: (saved, current)}"""
+    current = config_snapshot()
+    return {
+        name: (saved.get(name), current.get(name))
+        for name in sorted(set(saved) | set(current)) if saved.get(name) != current.get(name)
+    }
+
+
+def save_atomic(state, path):
+    """torch.save that never leaves a partially written file at path"""
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "wb") as f:
+        torch.save(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary_path, path)
+
+
+def load_training_checkpoint(path):
+    return torch.load(path, map_location="cpu", weights_only=True)
+
+
+class CheckpointWriter:
+    """
+    Write checkpoints on a background thread.
+
+    save() snapshots the state to the CPU on the calling thread, which is fast, and
+    queues the write. At most one write waits behind the one in progress; a further
+    save() blocks until there is room, so checkpoints are never dropped. Use as a
+    context manager (or call close()) to wait for outstanding writes.
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=1)
+        self.error = None
+        self.thread = threading.Thread(target=self._work, daemon=True)
+        self.thread.start()
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            state, path = item
+            try:
+                save_atomic(state, path)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def save(self, state, path):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((snapshot(state), path))
+
+    def wait(self):
+        """Block until every queued checkpoint is on disk"""
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.wait()
+        self.queue.put(None)
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
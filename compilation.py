@@ -0,0 +1,142 @@
+# compilation.py
+"""
+Compiled inference graphs for GPTMiniModel, selected by config.compile_backend.
+
+Two graphs are built for the calls IncrementalDecoder makes for unpadded prompts: the
+prompt prefill and the one-token KV-cache step. "compile" builds them with torch.compile
+and dynamic shapes, so the growing cache and changing prompt lengths reuse the same
+kernels; "torchscript" traces them with torch.jit.trace. Other calls (padding masks,
+several new tokens at once, training) run eagerly. A backend that fails to build, or
+whose warm-up output differs from eager, falls back to the next one in BACKENDS.
+"""
+import time
+import warnings
+import torch
+import torch.nn as nn
+from generation import IncrementalDecoder
+import config
+
+BACKENDS = ("compile", "torchscript", "eager")
+
+
+class _PrefillGraph(nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_indices):
+        logits, present_key_values = self.model(input_indices, use_cache=True)
+        return logits, tuple(present_key_values)
+
+
+class _StepGraph(nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_indices, past_key_values):
+        logits, present_key_values = self.model(input_indices, past_key_values=list(past_key_values),
+                                                use_cache=True)
+        return logits, tuple(present_key_values)
+
+
+class InferenceGraphs(nn.Module):
+    """GPTMiniModel whose unpadded prefill and one-token decode step run through compiled graphs"""
+
+    def __init__(self, model, prefill, step):
+        super().__init__()
+        self.model = model
+        self.sequence_length = model.sequence_length
+        self.prefill = prefill
+        self.step = step
+
+    def forward(self, input_indices, target_indices=None, past_key_values=None, use_cache=False,
+                attention_mask=None):
+        if use_cache and target_indices is None and attention_mask is None and not torch.is_grad_enabled():
+            # Graphs are specialised on strides, so inputs are passed as fresh contiguous
+            # tensors: a copy of the few new tokens, and of the cache only right after a
+            # prefill (where it is a view of the fused projection; later it comes from torch.cat)
+            input_indices = input_indices.clone(memory_format=torch.contiguous_format)
+            if past_key_values is None:
+                logits, present_key_values = self.prefill(input_indices)
+                return logits, list(present_key_values)
+            if input_indices.shape[1] == 1:
+                past_key_values = tuple((keys.contiguous(), values.contiguous()) for keys, values in past_key_values)
+                logits, present_key_values = self.step(input_indices, past_key_values)
+                return logits, list(present_key_values)
+        return self.model(input_indices, target_indices, past_key_values, use_cache, attention_mask)
+
+
+def _build(model, backend, example_tokens):
+    if backend == "compile":
+        if not hasattr(torch, "compile"):
+            raise RuntimeError("torch.compile needs PyTorch 2.0 or newer")
+        return InferenceGraphs(model, torch.compile(_PrefillGraph(model), dynamic=True),
+                               torch.compile(_StepGraph(model), dynamic=True))
+    if backend == "torchscript":
+        with torch.no_grad(), warnings.catch_warnings():
+            # The tracer warns about every shape-dependent Python branch; the traced
+            # graphs are only used for the inputs those branches were traced with
+            warnings.simplefilter("ignore")
+            prefill = torch.jit.trace(_PrefillGraph(model), (example_tokens,), check_trace=False)
+            _, past_key_values = model(example_tokens, use_cache=True)
+            step = torch.jit.trace(_StepGraph(model), (example_tokens[:, -1:], tuple(past_key_values)),
+                                   check_trace=False)
+        return InferenceGraphs(model, prefill, step)
+    return model
+
+
+def _warm_up(model, example_tokens):
+    """
+    Make the calls IncrementalDecoder makes, so torch.compile compiles them now rather
+    than on the first request: a single prompt and a batch, the decode steps after each
+    and the refill of a sliced context once the cache is full.
+    """
+    example_length = example_tokens.shape[1]
+    outputs = []
+    for tokens in (example_tokens[:1], example_tokens):
+        decoder = IncrementalDecoder(model, block_size=2 * example_length, refill_size=example_length)
+        outputs.append(decoder.prefill(tokens))
+        # Fixed inputs rather than sampled ones, so small numerical differences can't change the path
+        for i in range(example_length + 1):
+            outputs.append(decoder.step(tokens[:, i % example_length:i % example_length + 1]))
+    return torch.cat(outputs)
+
+
+def compile_model(model, backend=None, example_length=16, verbose=True):
+    """
+    Return model, or a compiled version of it, for inference with IncrementalDecoder.
+
+    Builds the requested backend, warms it up and checks its logits against eager; on any
+    failure the next backend in BACKENDS is tried. The chosen backend is stored on the
+    result as compile_backend and the seconds spent as compile_seconds.
+    """
+    backend = backend or config.compile_backend
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown compile backend {backend!r}: expected one of {', '.join(BACKENDS)}")
+    model.eval()
+    if backend == "eager":
+        # Nothing to build or check, so no warm-up on the start-up path
+        model.compile_backend, model.compile_seconds = "eager", 0.0
+        return model
+    device = next(model.parameters()).device
+    vocabulary_size = model.token_embedding_table.num_embeddings
+    example_tokens = torch.randint(0, vocabulary_size, (2, example_length), device=device)
+    expected = _warm_up(model, example_tokens)
+
+    for candidate in BACKENDS[BACKENDS.index(backend):]:
+        start = time.perf_counter()
+        try:
+            compiled = _build(model, candidate, example_tokens)
+            outputs = _warm_up(compiled, example_tokens)
+            if not torch.allclose(outputs, expected, rtol=1e-3, atol=1e-3):
+                raise RuntimeError(f"logits differ from eager by {(outputs - expected).abs().max():.2e}")
+        except Exception as e:
+            if verbose:
+                print(f"⚠️ {candidate} backend unavailable ({type(e).__name__}: {e}); falling back")
+            continue
+        compiled.compile_backend = candidate
+        compiled.compile_seconds = time.perf_counter() - start
+        if verbose and candidate != "eager":
+            print(f"⚙️ Inference graph: {candidate} ({compiled.compile_seconds:.1f}s to build and warm up)")
+        return compiled
@@ -3,11 +3,25 @@
 import torch
 
 # Training parameters
-batch_size = 32         # Number of sequences per batch
+batch_size = 32         # Sequences per forward/backward pass (micro-batch)
+effective_batch_size = 32  # Sequences per optimizer step (a multiple of batch_size; gradients accumulate)
 block_size = 128        # Length of each input sequence (increased for longer conversations)
 max_iters = 8000        # Number of training steps (increased for better chat training)
 eval_interval = 500     # Steps between logging loss
+eval_batch_size = 128   # Windows per forward pass when evaluating (no activations are kept)
+eval_max_batches = 8    # Batches per validation pass, spread over the val split (None: all of it)
+eval_in_background = False  # train_v2.py: validate in a separate process while training continues
 learning_rate = 1e-3    # AdamW learning rate
+checkpoint_interval = 500  # Steps between full (resumable) training checkpoints
+seed = None             # Seed for weights, dropout and batch sampling; None picks a new one each run
+prefetch_workers = 1    # Background threads building training batches
+prefetch_depth = 4      # Ready batches kept queued ahead of the training step
+prep_chunk_size = 16 * 1024 * 1024  # Bytes of corpus per token shard when preparing datasets
+prep_workers = 4        # Processes encoding shards in parallel
+
+# Tokenizer
+tokenizer_type = "char" # "char" for one token per character, "bpe" for byte-pair encoding
+bpe_vocab_size = 512    # Vocabulary size learned by the BPE tokenizer
 
 # Model architecture
 vocab_size = None       # Set later in prepare_dataset
@@ -15,5 +29,27 @@ embed_dim = 128         # Embedding dimension (increased for better representati
 num_heads = 8           # Number of attention heads (increased)
 num_layers = 4          # Number of transformer layers (increased for better understanding)
 
+# Draft model for speculative decoding (train_v2.py --draft)
+draft_embed_dim = 64    # Embedding dimension of the draft model
+draft_num_heads = 4     # Attention heads of the draft model
+draft_num_layers = 1    # Transformer layers of the draft model
+speculative_tokens = 0  # Draft tokens verified per chat-model forward (0: off; e.g. 4 with a trained, well-matched draft)
+
+# Prefix cache (prefix_cache.py)
+prefix_cache_mib = 64   # Memory for reusable prompt/conversation keys and values (0 disables the cache)
+prefix_cache_block = 16 # Tokens per cached block; prefixes are reused in whole blocks
+
+# Conversation context (conversation.py)
+context_reply_tokens = 32  # Tokens kept free for the reply when packing earlier turns into the prompt
+context_keep_fraction = 0.5  # Share of the history budget left after evicting, so the new prefix is reused for several turns
+
 # Device configuration
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
+precision = "fp32"      # "fp32", "bf16" (autocast on CPU or GPU) or "fp16" (autocast + grad scaling, GPU only)
+quantize = False        # Chat entry points: int8 nn.Linear weights on the CPU (see quantization.py)
+compile_backend = "eager"  # Chat inference graph: "eager", "compile" (torch.compile) or "torchscript" (see compilation.py)
+
+# Serving (chat_server.py)
+max_batch_size = 16     # Most requests decoded together in one forward pass
+max_queue_wait = 0.01   # Seconds an idle server waits for more requests to batch with the first
+server_prefix_cache = False  # Prefill each admitted prompt separately from its cached prefix instead of as one padded batch
@@ -0,0 +1,55 @@
+# conversation.py
+"""
+Earlier turns of a chat, packed into prompts that fit the model's sequence_length.
+
+Every prompt is the retained turns followed by the new question, so consecutive prompts
+share everything but the latest exchange and a PrefixCache only runs the model over the
+new text. When the turns no longer fit, whole turns are evicted from the start. Removing
+tokens shifts the absolute positions of everything after them and invalidates the
+cached prefix, so eviction goes down to context_keep_fraction of the history budget
+rather than just below it: the shortened history is then reused for the next few turns
+instead of shifting (and being recomputed) on every one.
+"""
+import config
+
+
+class ConversationContext:
+    """Retained (human, assistant) turns of a conversation and the prompt for the next reply"""
+
+    def __init__(self, tokenizer, block_size, reply_tokens=None, keep_fraction=None):
+        self.tokenizer = tokenizer
+        self.block_size = block_size  # The model's sequence_length
+        self.reply_tokens = config.context_reply_tokens if reply_tokens is None else reply_tokens
+        self.keep_fraction = config.context_keep_fraction if keep_fraction is None else keep_fraction
+        self.turns = []  # (text, number of tokens) of every retained turn
+        self.evicted_turns = 0
+
+    def __len__(self):
+        return len(self.turns)
+
+    @property
+    def history_tokens(self):
+        return sum(length for _, length in self.turns)
+
+    def add_turn(self, user_input, response):
+        text = f"Human: {user_input}\nAssistant: {response}\n\n"
+        self.turns.append((text, len(self.tokenizer.encode(text))))
+
+    def clear(self):
+        self.turns = []
+
+    def _evict(self, budget):
+        while self.turns and self.history_tokens > budget:
+            self.turns.pop(0)
+            self.evicted_turns += 1
+
+    def prompt(self, user_input):
+        """
+        Prompt for the reply to user_input: as many recent turns as fit in block_size,
+        leaving room for the question and reply_tokens of reply.
+        """
+        question = f"Human: {user_input}\nAssistant:"
+        budget = self.block_size - self.reply_tokens - len(self.tokenizer.encode(question))
+        if self.history_tokens > budget:
+            self._evict(int(budget * self.keep_fraction))
+        return "".join(text for text, _ in self.turns) + question
@@ -0,0 +1,360 @@
+# dataset.py
+"""
+Compact on-disk token storage.
+
+A token file is a fixed-size header followed by every split's tokens stored back to
+back as the smallest unsigned integer type that fits the vocabulary (uint8 for the
+character-level vocabularies used here, i.e. 1 byte per character instead of 8).
+Files are opened with np.memmap, so a corpus never has to fit in RAM: batches read
+just the windows they need and only those are widened to int64.
+
+Header layout (little-endian, HEADER_SIZE bytes, zero padded):
+    magic b"GPTTOKEN" | version u32 | vocab_size u32 | itemsize u32 | num_splits u32
+    then per split: name (16 bytes, NUL padded) | offset u64 | length u64
+Offsets and lengths are counted in tokens from the end of the header.
+
+Corpora prepared by prepare_corpus.py are split over several such shard files in one
+directory, listed in order by a manifest.json; ShardedTokenDataset reads them as if
+they were a single file.
+"""
+import functools
+import json
+import os
+import queue
+import struct
+import threading
+import time
+import numpy as np
+import torch
+import config
+
+MAGIC = b"GPTTOKEN"
+VERSION = 1
+HEADER_SIZE = 256
+_HEADER_FORMAT = "<8sIIII"
+_SPLIT_FORMAT = "<16sQQ"
+MANIFEST = "manifest.json"
+
+
+def token_dtype(vocab_size):
+    """Smallest unsigned NumPy dtype that can hold every token id"""
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if vocab_size <= np.iinfo(dtype).max + 1:
+            return np.dtype(dtype)
+    raise ValueError(f"Vocabulary of {vocab_size} tokens is too large for a token file")
+
+
+def write_token_file(path, splits, vocab_size):
+    """Write {split name: sequence of token ids} to path"""
+    dtype = token_dtype(vocab_size)
+    header = struct.pack(_HEADER_FORMAT, MAGIC, VERSION, vocab_size, dtype.itemsize, len(splits))
+    offset = 0
+    arrays = []
+    for name, tokens in splits.items():
+        array = np.asarray(tokens, dtype=dtype)
+        header += struct.pack(_SPLIT_FORMAT, name.encode(), offset, len(array))
+        arrays.append(array)
+        offset += len(array)
+    if len(header) > HEADER_SIZE:
+        raise ValueError(f"Too many splits for a {HEADER_SIZE}-byte header")
+
+    # Write beside the target and swap it in, so open memory maps of an older
+    # version keep reading their own (unlinked) copy instead of a truncated file
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "wb") as f:
+        f.write(header.ljust(HEADER_SIZE, b"\0"))
+        for array in arrays:
+            f.write(array.tobytes())
+    os.replace(temporary_path, path)
+    load_token_dataset.cache_clear()
+
+
+class TokenFile:
+    """Read-only, memory-mapped view of a file written by write_token_file"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            header = f.read(HEADER_SIZE)
+        magic, version, self.vocab_size, itemsize, num_splits = struct.unpack_from(_HEADER_FORMAT, header)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} token file")
+        self.dtype = token_dtype(self.vocab_size)
+        if self.dtype.itemsize != itemsize:
+            raise ValueError(f"{path} stores {itemsize}-byte tokens, expected {self.dtype.itemsize}")
+
+        self.splits = {}
+        position = struct.calcsize(_HEADER_FORMAT)
+        for _ in range(num_splits):
+            name, offset, length = struct.unpack_from(_SPLIT_FORMAT, header, position)
+            position += struct.calcsize(_SPLIT_FORMAT)
+            self.splits[name.rstrip(b"\0").decode()] = np.memmap(
+                path, dtype=self.dtype, mode="r", offset=HEADER_SIZE + offset * itemsize, shape=(length,)
+            )
+
+    def __getitem__(self, split):
+        return self.splits[split]
+
+
+def gradient_accumulation_steps(effective_batch_size=None, batch_size=None):
+    """
+    Micro-batches whose gradients are accumulated into each optimizer step.
+
+    Each micro-batch loss is a mean over its own tokens, so dividing it by this number
+    makes the summed gradients those of one effective batch.
+    """
+    effective_batch_size = effective_batch_size or config.effective_batch_size
+    batch_size = batch_size or config.batch_size
+    if effective_batch_size % batch_size:
+        raise ValueError(f"effective_batch_size ({effective_batch_size}) must be a multiple "
+                         f"of batch_size ({batch_size})")
+    return effective_batch_size // batch_size
+
+
+def sample_batch(data, batch_size=None, block_size=None, out=None, generator=None):
+    """
+    Sample random (x, y) windows from a split as int64 tensors.
+
+    Every (block_size + 1)-token window is gathered in a single indexing operation and
+    x / y are overlapping views of that one (B, T + 1) array. Pass a preallocated int64
+    out tensor of that shape to fill it in place instead of allocating a new batch.
+    generator is an optional torch.Generator for the window offsets.
+    """
+    batch_size = batch_size or config.batch_size
+    block_size = block_size or config.block_size
+    ix = torch.randint(len(data) - block_size, (batch_size,), generator=generator).numpy()
+    # Only the sampled windows are read from disk, and only they are widened to int64
+    windows = data[ix[:, None] + np.arange(block_size + 1)]
+    if out is None:
+        out = torch.from_numpy(windows.astype(np.int64))
+    else:
+        np.copyto(out.numpy(), windows, casting="unsafe")
+    return out[:, :-1], out[:, 1:]
+
+
+class BatchSampler:
+    """
+    Sample batches from one split into a ring of preallocated buffers.
+
+    A returned batch stays valid until num_buffers more batches have been sampled,
+    which covers copying it to the device before the next step. pin_memory allocates
+    page-locked buffers for faster host-to-GPU copies.
+    """
+
+    def __init__(self, data, batch_size=None, block_size=None, pin_memory=False, num_buffers=2):
+        self.data = data
+        self.batch_size = batch_size or config.batch_size
+        self.block_size = block_size or config.block_size
+        self.buffers = [
+            torch.empty((self.batch_size, self.block_size + 1), dtype=torch.long, pin_memory=pin_memory)
+            for _ in range(num_buffers)
+        ]
+        self.next_buffer = 0
+
+    def __call__(self):
+        out = self.buffers[self.next_buffer]
+        self.next_buffer = (self.next_buffer + 1) % len(self.buffers)
+        return sample_batch(self.data, self.batch_size, self.block_size, out=out)
+
+
+class PrefetchLoader:
+    """
+    Iterator over training batches that background worker threads build ahead of time.
+
+    Each worker samples from its own torch.Generator seeded with seed + worker id into a
+    bounded queue, and batches are taken from the workers in round-robin order, so the
+    batch sequence only depends on seed. skip_batches resumes that sequence after the
+    first skip_batches batches (position is the number consumed so far, including those).
+    Use as a context manager (or call close()) to stop the workers. stats() tells whether
+    training is waiting on data.
+    """
+
+    def __init__(self, data, batch_size=None, block_size=None, device=None, num_workers=None,
+                 queue_depth=None, seed=None, pin_memory=False, skip_batches=0):
+        self.data = data
+        self.batch_size = batch_size or config.batch_size
+        self.block_size = block_size or config.block_size
+        self.device = device or config.device
+        self.pin_memory = pin_memory
+        num_workers = num_workers or config.prefetch_workers
+        queue_depth = queue_depth or config.prefetch_depth
+        if seed is None:
+            seed = torch.initial_seed()
+        self.seed = seed
+        self.skip_batches = skip_batches
+
+        self.queues = [queue.Queue(maxsize=max(1, queue_depth // num_workers)) for _ in range(num_workers)]
+        self.stop_event = threading.Event()
+        self.next_worker = skip_batches % num_workers
+        self.batches = 0
+        self.starved_batches = 0  # Batches the consumer had to wait for
+        self.wait_seconds = 0.0
+        self.queue_depth_total = 0
+
+        # Worker i builds batches i, i + num_workers, ...; skip those already consumed
+        self.workers = [
+            threading.Thread(target=self._work, daemon=True,
+                             args=(self.queues[i], seed + i, len(range(i, skip_batches, num_workers))))
+            for i in range(num_workers)
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    def _work(self, batch_queue, seed, skip):
+        generator = torch.Generator().manual_seed(seed)
+        for _ in range(skip):
+            # The same draw sample_batch makes for the window offsets, without gathering them
+            torch.randint(len(self.data) - self.block_size, (self.batch_size,), generator=generator)
+        try:
+            while not self.stop_event.is_set():
+                x, y = sample_batch(self.data, self.batch_size, self.block_size, generator=generator)
+                if self.pin_memory:
+                    x, y = x.pin_memory(), y.pin_memory()
+                self._put(batch_queue, (x, y))
+        except Exception as e:
+            self._put(batch_queue, e)
+
+    def _put(self, batch_queue, item):
+        while not self.stop_event.is_set():
+            try:
+                batch_queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        batch_queue = self.queues[self.next_worker]
+        self.next_worker = (self.next_worker + 1) % len(self.queues)
+        self.queue_depth_total += sum(q.qsize() for q in self.queues)
+        if batch_queue.empty():
+            self.starved_batches += 1
+        start = time.perf_counter()
+        item = batch_queue.get()
+        self.wait_seconds += time.perf_counter() - start
+        if isinstance(item, Exception):
+            raise item
+        self.batches += 1
+
+        x, y = item
+        return x.to(self.device, non_blocking=self.pin_memory), y.to(self.device, non_blocking=self.pin_memory)
+
+    @property
+    def position(self):
+        return self.skip_batches + self.batches
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "mean_queue_depth": self.queue_depth_total / max(1, self.batches),
+            "max_queue_depth": sum(q.maxsize for q in self.queues),
+            "starved_batches": self.starved_batches,
+            "wait_seconds": self.wait_seconds,
+        }
+
+    def close(self):
+        self.stop_event.set()
+        for worker in self.workers:
+            worker.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class TokenDataset:
+    """Splits of a token file opened once and kept around for batch sampling"""
+
+    def __init__(self, path, in_memory=False):
+        self.token_file = TokenFile(path)
+        self.vocab_size = self.token_file.vocab_size
+        # in_memory copies the (compact) splits into RAM instead of paging them from disk
+        self.splits = {
+            name: np.array(split) if in_memory else split for name, split in self.token_file.splits.items()
+        }
+
+    def __getitem__(self, split):
+        return self.splits[split]
+
+    def get_batch(self, split, batch_size=None, block_size=None):
+        return sample_batch(self.splits[split], batch_size, block_size)
+
+    def sampler(self, split, batch_size=None, block_size=None, pin_memory=False):
+        """BatchSampler over split that reuses its batch buffers between calls"""
+        return BatchSampler(self.splits[split], batch_size, block_size, pin_memory=pin_memory)
+
+    def prefetch(self, split, **kwargs):
+        """PrefetchLoader over split; keyword arguments are passed through"""
+        return PrefetchLoader(self.splits[split], **kwargs)
+
+    def shard(self, split, rank, world_size):
+        """Contiguous 1/world_size of split read by one data-parallel rank (a view, not a copy)"""
+        data = self.splits[split]
+        size = len(data) // world_size
+        return data[rank * size:(rank + 1) * size]
+
+
+class ShardedSplit:
+    """One split spread over several shards, indexable by token position like a single array"""
+
+    def __init__(self, parts):
+        self.parts = parts
+        self.offsets = np.cumsum([0] + [len(part) for part in parts])
+        self.dtype = parts[0].dtype
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __array__(self, dtype=None, copy=None):
+        return np.concatenate(self.parts).astype(dtype or self.dtype)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice) and index.step in (None, 1):
+            # Contiguous ranges stay views of the shards, like slicing a memmap
+            start, stop, _ = index.indices(len(self))
+            parts = []
+            for part, offset in zip(self.parts, self.offsets):
+                low, high = max(start - offset, 0), min(stop - offset, len(part))
+                if low < high:
+                    parts.append(part[low:high])
+            if len(parts) == 1:
+                return parts[0]
+            return ShardedSplit(parts) if parts else self.parts[0][:0]
+        if isinstance(index, slice):
+            index = np.arange(*index.indices(len(self)))
+        index = np.asarray(index)
+        shard = np.searchsorted(self.offsets, index, side="right") - 1
+        out = np.empty(index.shape, dtype=self.dtype)
+        for i in np.unique(shard):
+            in_shard = shard == i
+            out[in_shard] = self.parts[i][index[in_shard] - self.offsets[i]]
+        return out
+
+
+class ShardedTokenDataset(TokenDataset):
+    """TokenDataset over a directory of shard files written by prepare_corpus.py"""
+
+    def __init__(self, directory, in_memory=False):
+        with open(os.path.join(directory, MANIFEST), "r", encoding="utf-8") as f:
+            self.manifest = json.load(f)
+        self.vocab_size = self.manifest["vocab_size"]
+        self.token_files = [TokenFile(os.path.join(directory, name)) for name in self.manifest["shards"]]
+
+        self.splits = {}
+        for name in ("train", "val"):
+            parts = [token_file[name] for token_file in self.token_files if name in token_file.splits]
+            if parts:
+                split = parts[0] if len(parts) == 1 else ShardedSplit(parts)
+                self.splits[name] = np.array(split) if in_memory else split
+
+
+@functools.lru_cache(maxsize=None)
+def load_token_dataset(path):
+    """Shared TokenDataset for a token file or shard directory, opened on first use"""
+    if os.path.isdir(path):
+        return ShardedTokenDataset(path)
+    return TokenDataset(path)
@@ -0,0 +1,175 @@
+# evaluate.py
+"""
+Validation loss over many windows instead of a single random batch.
+
+evaluate() sweeps a split with strided windows (every stride tokens, block_size + 1 long)
+in large inference-mode batches. The windows are the same on every call, so losses of
+different checkpoints are directly comparable; max_batches spreads a fixed subset of
+them evenly over the split when a full sweep is too slow. BackgroundEvaluator runs
+evaluate() in a separate process on snapshots of the weights while training continues.
+
+Usage: python evaluate.py checkpoints/mini_gpt_v2_best.pt [--data data/tokens_v2] [--split val]
+"""
+import argparse
+import math
+import multiprocessing
+import queue
+import time
+import numpy as np
+import torch
+import torch.nn.functional as F
+from model import GPTMiniModel
+from precision import autocast
+from dataset import load_token_dataset
+from checkpoint import snapshot
+import config
+
+
+def window_starts(length, block_size, stride=None, max_windows=None):
+    """Start offsets of the evaluation windows; evenly spaced when there are more than max_windows"""
+    starts = np.arange(0, length - block_size, stride or block_size)
+    if max_windows is not None and len(starts) > max_windows:
+        starts = starts[np.linspace(0, len(starts) - 1, max_windows).round().astype(np.int64)]
+    return starts
+
+
+def evaluate(model, data, batch_size=None, block_size=None, stride=None, max_batches=None,
+             precision=None, device=None):
+    """
+    Mean next-token loss of model over data (a token split such as TokenDataset["val"]).
+
+    Covers the whole split unless max_batches limits the number of batches. Returns a
+    dict with loss, perplexity, the number of predicted tokens, the elapsed seconds and
+    tokens_per_second. The model's train/eval mode is restored afterwards.
+    """
+    batch_size = batch_size or config.eval_batch_size
+    block_size = block_size or config.block_size
+    device = device or config.device
+    max_windows = None if max_batches is None else max_batches * batch_size
+    starts = window_starts(len(data), block_size, stride, max_windows)
+
+    was_training = model.training
+    model.eval()
+    start_time = time.perf_counter()
+    total_loss, total_tokens = 0.0, 0
+    with torch.inference_mode(), autocast(precision, device):
+        for i in range(0, len(starts), batch_size):
+            windows = data[starts[i:i + batch_size, None] + np.arange(block_size + 1)]
+            windows = torch.from_numpy(windows.astype(np.int64)).to(device)
+            logits = model(windows[:, :-1])
+            # Summed (not averaged) per batch so a short final batch is weighted correctly
+            loss = F.cross_entropy(logits.float().reshape(-1, logits.shape[-1]), windows[:, 1:].reshape(-1),
+                                   reduction="sum")
+            total_loss += loss.item()
+            total_tokens += windows[:, 1:].numel()
+    model.train(was_training)
+
+    seconds = time.perf_counter() - start_time
+    loss = total_loss / total_tokens
+    return {
+        "loss": loss,
+        "perplexity": math.exp(loss),
+        "tokens": total_tokens,
+        "seconds": seconds,
+        "tokens_per_second": total_tokens / seconds,
+    }
+
+
+def _evaluation_worker(model_kwargs, data_path, split, evaluate_kwargs, requests, results):
+    # One thread, so validation does not compete with the training process for every core
+    torch.set_num_threads(1)
+    model = GPTMiniModel(**model_kwargs)
+    data = load_token_dataset(data_path)[split]
+    while True:
+        request = requests.get()
+        if request is None:
+            return
+        tag, state_dict = request
+        model.load_state_dict(state_dict)
+        results.put((tag, evaluate(model, data, device="cpu", **evaluate_kwargs)))
+
+
+class BackgroundEvaluator:
+    """
+    Evaluate snapshots of a model in a separate CPU process while training continues.
+
+    submit() copies the weights, returns the copy and continues immediately; poll()
+    returns the (tag, metrics) pairs finished so far and wait() blocks for all outstanding
+    ones. Use as a context manager (or call close()) to stop the process.
+    """
+
+    def __init__(self, model_kwargs, data_path, split="val", **evaluate_kwargs):
+        # fork where available: spawn would re-run the calling script (train_v2.py has no main guard)
+        start_method = "fork" if "fork" in multiprocessing.get_all_start_methods() else None
+        context = multiprocessing.get_context(start_method)
+        self.requests = context.Queue()
+        self.results = context.Queue()
+        self.pending = 0
+        self.process = context.Process(
+            target=_evaluation_worker, daemon=True,
+            args=(model_kwargs, data_path, split, evaluate_kwargs, self.requests, self.results)
+        )
+        self.process.start()
+
+    def submit(self, tag, state_dict):
+        state_dict = snapshot(state_dict)
+        self.requests.put((tag, state_dict))
+        self.pending += 1
+        return state_dict
+
+    def poll(self):
+        finished = []
+        while self.pending:
+            try:
+                finished.append(self.results.get_nowait())
+            except queue.Empty:
+                break
+            self.pending -= 1
+        return finished
+
+    def wait(self):
+        finished = []
+        while self.pending:
+            finished.append(self._get())
+            self.pending -= 1
+        return finished
+
+    def _get(self):
+        while True:
+            try:
+                return self.results.get(timeout=1.0)
+            except queue.Empty:
+                if not self.process.is_alive():
+                    raise RuntimeError("Background evaluation process exited unexpectedly")
+
+    def close(self):
+        if self.process.is_alive():
+            self.requests.put(None)
+            self.process.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Validation loss, perplexity and throughput of a checkpoint")
+    parser.add_argument("checkpoint", help="Model state dict, e.g. checkpoints/mini_gpt_v2_best.pt")
+    parser.add_argument("--data", default="data/tokens_v2", help="Token file or shard directory")
+    parser.add_argument("--split", default="val")
+    parser.add_argument("--batch-size", type=int, default=config.eval_batch_size)
+    parser.add_argument("--stride", type=int, default=None, help="Tokens between windows (default block_size)")
+    parser.add_argument("--max-batches", type=int, default=None, help="Default: the whole split")
+    args = parser.parse_args()
+
+    from bundle import load_model, model_architecture  # bundle imports this module through quantization
+    token_dataset = load_token_dataset(args.data)
+    model, _ = load_model(args.checkpoint, architecture=model_architecture(token_dataset.vocab_size))
+
+    metrics = evaluate(model, token_dataset[args.split], args.batch_size, stride=args.stride,
+                       max_batches=args.max_batches)
+    print(f"📊 {args.checkpoint} on {args.data} ({args.split}, {metrics['tokens']:,} tokens)")
+    print(f"Loss: {metrics['loss']:.4f} | Perplexity: {metrics['perplexity']:.2f} | "
+          f"{metrics['tokens_per_second']:,.0f} tokens/sec ({metrics['seconds']:.2f}s)")
@@ -0,0 +1,462 @@
+# generation.py
+import itertools
+import time
+import torch
+import torch.nn.functional as F
+from precision import autocast
+import config
+
+
+class IncrementalDecoder:
+    """Run GPTMiniModel one token at a time, reusing the attention keys/values of earlier tokens"""
+
+    def __init__(self, model, block_size=None, refill_size=None, precision=None, prefix_cache=None):
+        self.model = model
+        # Tokens the model has position embeddings for, unless a smaller window is asked for
+        self.block_size = block_size or model.sequence_length
+        self.precision = precision or config.precision
+        # Optional PrefixCache (for this model) consulted by single-prompt prefills
+        self.prefix_cache = prefix_cache
+        # Position embeddings are absolute, so once the cache covers every position the
+        # oldest entries can't simply be dropped: the most recent refill_size tokens are
+        # re-encoded instead, which leaves room for the next block_size - refill_size steps.
+        self.refill_size = refill_size or self.block_size // 2
+        self.reset()
+
+    def reset(self):
+        """Forget all cached state"""
+        self.past_key_values = None
+        self.tokens = None  # (B, T) tokens currently held in the cache
+        self.attention_mask = None  # (B, T) 0 where tokens are left padding, None without padding
+
+    @property
+    def cache_length(self):
+        return 0 if self.tokens is None else self.tokens.shape[1]
+
+    @property
+    def sequence_lengths(self):
+        """Number of real (non-padding) cached tokens per row"""
+        if self.attention_mask is None:
+            return [self.cache_length] * self.tokens.shape[0]
+        return self.attention_mask.sum(dim=1).tolist()
+
+    @torch.no_grad()
+    def prefill(self, context, attention_mask=None, all_logits=False):
+        """
+        Encode a (B, T) prompt from scratch and return the logits for its last position, or
+        with all_logits=True the (B, T, V) logits for every position.
+        """
+        context = context[:, -self.block_size:]
+        if attention_mask is not None:
+            attention_mask = attention_mask[:, -self.block_size:]
+        # Keys/values of a cached prefix are reused; at least the last token is always run
+        cached_length, past_key_values = 0, None
+        use_prefix_cache = (self.prefix_cache is not None and attention_mask is None and context.shape[0] == 1
+                            and not all_logits)
+        if use_prefix_cache:
+            cached_length, past_key_values = self.prefix_cache.lookup(context[0].tolist(), context.shape[1] - 1)
+        with autocast(self.precision):
+            logits, self.past_key_values = self.model(context[:, cached_length:], past_key_values=past_key_values,
+                                                      use_cache=True, attention_mask=attention_mask)
+        self.tokens = context
+        self.attention_mask = attention_mask
+        if use_prefix_cache:
+            self.prefix_cache.insert(context[0].tolist(), self.past_key_values)
+        return logits.float() if all_logits else logits[:, -1, :].float()
+
+    @torch.no_grad()
+    def step(self, next_tokens, all_logits=False):
+        """
+        Append (B, n) new tokens and return the logits for the last one, or with
+        all_logits=True the (B, n, V) logits for each of them. An empty decoder prefills.
+        """
+        if self.tokens is None:
+            return self.prefill(next_tokens, all_logits=all_logits)
+        if max(self.sequence_lengths) + next_tokens.shape[1] > self.block_size:
+            # At least all the new tokens, so all_logits has one row for each of them
+            refill_size = max(self.refill_size, next_tokens.shape[1])
+            context = torch.cat((self.tokens, next_tokens), dim=1)[:, -refill_size:]
+            attention_mask = None
+            if self.attention_mask is not None:
+                attention_mask = torch.cat((self.attention_mask, torch.ones_like(next_tokens)), dim=1)
+                attention_mask = attention_mask[:, -refill_size:]
+            logits = self.prefill(context, attention_mask, all_logits)
+            return logits[:, -next_tokens.shape[1]:] if all_logits else logits
+
+        if self.attention_mask is not None:
+            self.attention_mask = torch.cat((self.attention_mask, torch.ones_like(next_tokens)), dim=1)
+        with autocast(self.precision):
+            logits, self.past_key_values = self.model(
+                next_tokens, past_key_values=self.past_key_values, use_cache=True,
+                attention_mask=self.attention_mask
+            )
+        self.tokens = torch.cat((self.tokens, next_tokens), dim=1)
+        return logits.float() if all_logits else logits[:, -1, :].float()
+
+    def save_prefix(self):
+        """Add everything decoded so far (prompt and reply) to the prefix cache, for the next turn"""
+        if self.prefix_cache is not None and self.tokens is not None and self.attention_mask is None \
+                and self.tokens.shape[0] == 1:
+            self.prefix_cache.insert(self.tokens[0].tolist(), self.past_key_values)
+
+    def rewind(self, num_tokens):
+        """Drop the last num_tokens cached tokens, e.g. draft tokens that were rejected"""
+        if num_tokens <= 0:
+            return
+        length = self.cache_length - num_tokens
+        self.tokens = self.tokens[:, :length]
+        self.past_key_values = [(keys[:, :, :length], values[:, :, :length]) for keys, values in self.past_key_values]
+        if self.attention_mask is not None:
+            self.attention_mask = self.attention_mask[:, :length]
+
+    @torch.no_grad()
+    def add_rows(self, context, attention_mask=None):
+        """Prefill (B', T) new prompts, append them to the batch and return their last logits"""
+        new_rows = IncrementalDecoder(self.model, self.block_size, self.refill_size, self.precision,
+                                      self.prefix_cache)
+        logits = new_rows.prefill(context, attention_mask)
+        if self.tokens is None:
+            self.tokens, self.attention_mask = new_rows.tokens, new_rows.attention_mask
+            self.past_key_values = new_rows.past_key_values
+            return logits
+
+        # Left-pad whichever side is shorter so both share one cache width
+        width = max(self.cache_length, new_rows.cache_length)
+        tokens, attention_masks, past_key_values = [], [], []
+        for part in (self, new_rows):
+            padding = width - part.cache_length
+            attention_mask = part.attention_mask
+            if attention_mask is None:
+                attention_mask = torch.ones_like(part.tokens)
+            tokens.append(F.pad(part.tokens, (padding, 0)))
+            attention_masks.append(F.pad(attention_mask, (padding, 0)))
+            past_key_values.append([
+                (F.pad(keys, (0, 0, padding, 0)), F.pad(values, (0, 0, padding, 0)))
+                for keys, values in part.past_key_values
+            ])
+        self.tokens = torch.cat(tokens, dim=0)
+        self.attention_mask = torch.cat(attention_masks, dim=0)
+        self.past_key_values = [
+            (torch.cat((old_keys, new_keys), dim=0), torch.cat((old_values, new_values), dim=0))
+            for (old_keys, old_values), (new_keys, new_values) in zip(*past_key_values)
+        ]
+        return logits
+
+    def select(self, rows):
+        """Keep only the given batch rows, e.g. to drop sequences that finished generating"""
+        if len(rows) == 0:
+            self.reset()
+            return
+        rows = torch.as_tensor(rows, dtype=torch.long, device=self.tokens.device)
+        self.tokens = self.tokens[rows]
+        self.past_key_values = [(keys[rows], values[rows]) for keys, values in self.past_key_values]
+        if self.attention_mask is not None:
+            self.attention_mask = self.attention_mask[rows]
+            # Drop leading columns that are padding in every remaining row
+            padding_columns = int((self.attention_mask.sum(dim=0) == 0).long().cumprod(dim=0).sum())
+            if padding_columns:
+                self.tokens = self.tokens[:, padding_columns:]
+                self.attention_mask = self.attention_mask[:, padding_columns:]
+                self.past_key_values = [
+                    (keys[:, :, padding_columns:], values[:, :, padding_columns:])
+                    for keys, values in self.past_key_values
+                ]
+
+
+def left_pad(sequences, padding_value=0, device=None):
+    """Stack token lists of different lengths into (B, T) tokens plus a 0/1 attention mask"""
+    width = max(len(sequence) for sequence in sequences)
+    tokens = torch.full((len(sequences), width), padding_value, dtype=torch.long, device=device)
+    attention_mask = torch.zeros((len(sequences), width), dtype=torch.long, device=device)
+    for row, sequence in enumerate(sequences):
+        if sequence:
+            tokens[row, width - len(sequence):] = torch.tensor(sequence, dtype=torch.long, device=device)
+            attention_mask[row, width - len(sequence):] = 1
+    return tokens, attention_mask
+
+
+CHAT_STOP_STRINGS = ("\nHuman:", "\n\n")
+
+
+class StopSequenceMatcher:
+    """
+    Detect stop strings incrementally as token ids are generated.
+
+    The stop strings are compiled into an Aho-Corasick automaton, and transitions are
+    memoised per (state, token id), so each step costs one dictionary lookup and the
+    generated history is never decoded again. Walking each token's text through the
+    automaton (rather than matching pre-encoded token sequences) also catches stop
+    strings that a subword tokenizer splits differently. A sequence's state starts at 0:
+
+        state, stop = matcher.advance(state, token)   # stop is the matched string or None
+    """
+
+    def __init__(self, tokenizer, stop_strings=CHAT_STOP_STRINGS):
+        self.tokenizer = tokenizer
+        # Character trie: goto[state][char] -> state, output[state] -> stop string ending there
+        self.goto = [{}]
+        self.output = [None]
+        self.depth = [0]  # Length of the stop-string prefix each state stands for
+        for stop in stop_strings:
+            state = 0
+            for char in stop:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.output.append(None)
+                    self.depth.append(self.depth[state] + 1)
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.output[state] = stop
+
+        # Failure links, breadth first, so a state's fallback is always resolved before it
+        self.fail = [0] * len(self.goto)
+        queue = list(self.goto[0].values())
+        while queue:
+            state = queue.pop(0)
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                if state:
+                    self.fail[next_state] = self._step_char(self.fail[state], char)
+                if self.output[next_state] is None:
+                    self.output[next_state] = self.output[self.fail[next_state]]
+
+        self.transitions = {}  # (state, token id) -> (state, matched stop string or None)
+
+    def _step_char(self, state, char):
+        while state and char not in self.goto[state]:
+            state = self.fail[state]
+        return self.goto[state].get(char, 0)
+
+    def advance(self, state, token):
+        key = (state, token)
+        if key not in self.transitions:
+            matched = None
+            for char in self.tokenizer.decode([token]):
+                state = self._step_char(state, char)
+                matched = matched or self.output[state]
+            self.transitions[key] = (state, matched)
+        return self.transitions[key]
+
+
+class TextStreamer:
+    """
+    Turn generated token ids into text that is safe to show as soon as it arrives.
+
+    Text that may still be the start of a stop string is held back until it can't be, and
+    the stop string itself is never emitted. Tokens that decode to an incomplete UTF-8
+    character (byte-level BPE) are held until the character is complete.
+    """
+
+    def __init__(self, stop_matcher):
+        self.stop_matcher = stop_matcher
+        self.tokenizer = stop_matcher.tokenizer
+        self.state = 0
+        self.stopped = False
+        self.pending_tokens = []  # Tokens not yet decoded into whole characters
+        self.held_text = ""       # Decoded text that may be the start of a stop string
+        self.text = ""            # Everything emitted so far
+
+    def push(self, token):
+        """Add a generated token and return the newly visible text (often empty)"""
+        self.state, stop = self.stop_matcher.advance(self.state, token)
+        self.pending_tokens.append(token)
+        decoded = self.tokenizer.decode(self.pending_tokens)
+        if stop is None and decoded.endswith("\ufffd") and len(self.pending_tokens) < 4:
+            return ""
+        text = self.held_text + decoded
+        self.pending_tokens = []
+
+        if stop is not None:
+            self.stopped = True
+            self.held_text = ""
+            end = text.find(stop)
+            return self._emit(text if end < 0 else text[:end])
+        keep = self.stop_matcher.depth[self.state]
+        self.held_text = text[len(text) - keep:] if keep else ""
+        return self._emit(text[:len(text) - keep])
+
+    def flush(self):
+        """Release any held-back text once generation ends without a stop string"""
+        text = self.held_text + self.tokenizer.decode(self.pending_tokens)
+        self.held_text, self.pending_tokens = "", []
+        return self._emit(text)
+
+    def _emit(self, text):
+        self.text += text
+        return text
+
+
+def sample(model, context, temperature=0.8, prefix_cache=None):
+    """
+    Yield token ids sampled from model one at a time after a (1, T) context.
+
+    With a prefix_cache the prompt's cached prefix is reused, and the prompt plus the
+    decoded reply are added to the cache when the generator is closed.
+    """
+    decoder = IncrementalDecoder(model, prefix_cache=prefix_cache)
+    try:
+        logits = decoder.prefill(context)
+        while True:
+            next_token = torch.multinomial(F.softmax(logits / temperature, dim=-1), num_samples=1)
+            yield next_token.item()
+            logits = decoder.step(next_token)
+    finally:
+        decoder.save_prefix()
+
+
+def accept_draft_tokens(target_probs, draft_probs, draft_tokens):
+    """
+    Speculative sampling: decide which draft tokens the target model keeps.
+
+    target_probs is (k + 1, V), the target model's next-token distribution at each of the
+    k draft positions and after the last one; draft_probs is (k, V), the distributions the
+    k draft_tokens were sampled from. Draft token i is kept with probability
+    min(1, p_i / q_i). The first rejected one is replaced by a sample from the normalised
+    max(0, p_i - q_i), and if all are kept one more token is sampled from the last target
+    distribution, so the returned tokens are distributed exactly as if the target model
+    had sampled them itself. Returns (tokens, number of draft tokens kept).
+    """
+    for i, token in enumerate(draft_tokens):
+        if torch.rand(()).item() * draft_probs[i, token].item() < target_probs[i, token].item():
+            continue
+        residual = (target_probs[i] - draft_probs[i]).clamp(min=0)
+        if residual.sum() <= 0:  # Only possible through rounding when p == q
+            residual = target_probs[i]
+        return draft_tokens[:i] + [torch.multinomial(residual, num_samples=1).item()], i
+    return draft_tokens + [torch.multinomial(target_probs[-1], num_samples=1).item()], len(draft_tokens)
+
+
+def speculative_sample(model, draft_model, context, temperature=0.8, num_draft_tokens=None, stats=None,
+                       block_size=None):
+    """
+    Yield token ids from model's distribution, proposed num_draft_tokens at a time by draft_model.
+
+    Each round the draft model samples k tokens one by one, the target model scores all
+    of them in a single forward pass and accept_draft_tokens keeps a prefix, so a round
+    yields 1 to k + 1 tokens for one target forward. Both KV caches are rewound past
+    rejected tokens. If a stats dict is passed, drafted_tokens and accepted_tokens count
+    the proposals and how many of them were kept.
+    """
+    k = num_draft_tokens or config.speculative_tokens
+    target, draft = IncrementalDecoder(model, block_size), IncrementalDecoder(draft_model, block_size)
+    # Tokens each decoder has not consumed yet: the prompt, then the last round's final token
+    target_pending = draft_pending = context
+    while True:
+        draft_logits = draft.step(draft_pending)
+        draft_probs, draft_tokens = [], []
+        for i in range(k):
+            probs = F.softmax(draft_logits / temperature, dim=-1)
+            draft_tokens.append(torch.multinomial(probs, num_samples=1))
+            draft_probs.append(probs[0])
+            if i < k - 1:
+                draft_logits = draft.step(draft_tokens[-1])
+        proposal = torch.cat(draft_tokens, dim=1)
+
+        # The target's logits for the last pending token onwards: the k draft positions plus one
+        target_logits = target.step(torch.cat((target_pending, proposal), dim=1), all_logits=True)[0, -(k + 1):]
+        tokens, accepted = accept_draft_tokens(F.softmax(target_logits / temperature, dim=-1),
+                                               torch.stack(draft_probs), proposal[0].tolist())
+        if stats is not None:
+            stats["drafted_tokens"] = stats.get("drafted_tokens", 0) + k
+            stats["accepted_tokens"] = stats.get("accepted_tokens", 0) + accepted
+
+        # The target cache holds all k proposals, the draft cache the first k - 1
+        target.rewind(k - accepted)
+        draft.rewind(k - 1 - accepted)
+        target_pending = torch.tensor([tokens[-1:]], dtype=torch.long, device=context.device)
+        draft_pending = target_pending if accepted < k else torch.cat((proposal[:, -1:], target_pending), dim=1)
+        yield from tokens
+
+
+def stream_generate(model, tokenizer, prompt, max_new_tokens=100, temperature=0.8,
+                    stop_strings=CHAT_STOP_STRINGS, stats=None, draft_model=None, prefix_cache=None):
+    """
+    Yield the continuation of prompt as text chunks while it is being generated.
+
+    Stop strings end the continuation and are not yielded; breaking out of the loop stops
+    generation. With a draft_model the tokens come from speculative_sample (same
+    distribution, fewer forward passes of model); otherwise a prefix_cache lets the
+    prompt reuse the keys/values of earlier prompts and replies. If a stats dict is
+    passed it is filled with time_to_first_token, the number of generated tokens and the
+    elapsed time (seconds), plus the speculative_sample counts.
+    """
+    model.eval()
+    start_time = time.perf_counter()
+    streamer = TextStreamer(StopSequenceMatcher(tokenizer, stop_strings))
+    context = torch.tensor([tokenizer.encode(prompt)], dtype=torch.long, device=config.device)
+    generated = 0
+    if draft_model is None:
+        tokens = sample(model, context, temperature, prefix_cache)
+    else:
+        draft_model.eval()
+        tokens = speculative_sample(model, draft_model, context, temperature, stats=stats)
+
+    try:
+        for token in itertools.islice(tokens, max_new_tokens):
+            generated += 1
+            if generated == 1 and stats is not None:
+                stats["time_to_first_token"] = time.perf_counter() - start_time
+
+            chunk = streamer.push(token)
+            if chunk:
+                yield chunk
+            if streamer.stopped:
+                break
+        else:
+            chunk = streamer.flush()
+            if chunk:
+                yield chunk
+    finally:
+        tokens.close()  # sample() then adds the prompt and reply to the prefix cache
+        if stats is not None:
+            stats["tokens"] = generated
+            stats["seconds"] = time.perf_counter() - start_time
+
+
+def generate_batch(model, tokenizer, prompts, max_new_tokens=100, temperature=0.8,
+                   stop_strings=CHAT_STOP_STRINGS, stats=None):
+    """
+    Sample continuations for several prompts together, one forward pass per step.
+
+    Prompts are left-padded to a common length; each sequence leaves the batch as soon
+    as its continuation contains one of stop_strings. Returns the generated text for
+    each prompt (without the prompt). If a stats dict is passed it is filled with the
+    number of generated tokens and the elapsed time.
+    """
+    model.eval()
+    start_time = time.perf_counter()
+    tokens, attention_mask = left_pad([tokenizer.encode(prompt) for prompt in prompts], device=config.device)
+
+    generated_tokens = [[] for _ in prompts]
+    active = list(range(len(prompts)))  # Prompt index of each row still in the batch
+    stop_matcher = StopSequenceMatcher(tokenizer, stop_strings)
+    stop_states = [0] * len(prompts)
+
+    with torch.no_grad():
+        decoder = IncrementalDecoder(model)
+        logits = decoder.prefill(tokens, attention_mask)
+
+        for _ in range(max_new_tokens):
+            probs = F.softmax(logits / temperature, dim=-1)
+            next_tokens = torch.multinomial(probs, num_samples=1)
+
+            keep_rows = []
+            for row, token in enumerate(next_tokens[:, 0].tolist()):
+                index = active[row]
+                generated_tokens[index].append(token)
+                stop_states[index], stop = stop_matcher.advance(stop_states[index], token)
+                if stop is None:
+                    keep_rows.append(row)
+
+            if not keep_rows:
+                break
+            if len(keep_rows) < len(active):
+                active = [active[row] for row in keep_rows]
+                next_tokens = next_tokens[keep_rows]
+                decoder.select(keep_rows)
+            logits = decoder.step(next_tokens)
+
+    if stats is not None:
+        stats["tokens"] = sum(len(generated) for generated in generated_tokens)
+        stats["seconds"] = time.perf_counter() - start_time
+    return [tokenizer.decode(generated) for generated in generated_tokens]
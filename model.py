@@ -3,52 +3,80 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-class SelfAttentionHead(nn.Module):
-    def __init__(self, embedding_dim, head_size, sequence_length):
+class MultiHeadAttention(nn.Module):
+    def __init__(self, embedding_dim, number_of_heads, sequence_length):
         super().__init__()
-        self.query = nn.Linear(embedding_dim, head_size, bias=False)
-        self.key = nn.Linear(embedding_dim, head_size, bias=False)
-        self.value = nn.Linear(embedding_dim, head_size, bias=False)
-
-        self.attention_mask = torch.tril(torch.ones(sequence_length, sequence_length))
+        self.number_of_heads = number_of_heads
+        self.head_size = embedding_dim // number_of_heads
+        # Queries, keys and values for every head come out of a single projection
+        self.query_key_value = nn.Linear(embedding_dim, 3 * embedding_dim, bias=False)
+        self.linear_projection = nn.Linear(embedding_dim, embedding_dim)
         self.dropout = nn.Dropout(0.1)
-        self.scaling_factor = head_size ** -0.5
+        self.attention_dropout = 0.1
 
-    def forward(self, token_embeddings):
+        self.register_buffer(
+            "attention_mask", torch.tril(torch.ones(sequence_length, sequence_length, dtype=torch.bool)),
+            persistent=False
+        )
+        self.scaling_factor = self.head_size ** -0.5
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Checkpoints saved before the heads were fused have separate query/key/value
+        # weights per head under attention_heads.<i>; stack them into the fused layout.
+        legacy_prefix = prefix + "attention_heads."
+        if legacy_prefix + "0.query.weight" in state_dict:
+            weights = []
+            for projection in ("query", "key", "value"):
+                for head in range(self.number_of_heads):
+                    weights.append(state_dict.pop(f"{legacy_prefix}{head}.{projection}.weight"))
+            state_dict[prefix + "query_key_value.weight"] = torch.cat(weights, dim=0)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def forward(self, token_embeddings, past_key_value=None, attention_mask=None):
         batch_size, sequence_length, embedding_dim = token_embeddings.shape
 
-        queries = self.query(token_embeddings)  # (B, T, head_size)
-        keys = self.key(token_embeddings)       # (B, T, head_size)
-        values = self.value(token_embeddings)   # (B, T, head_size)
-
-        attention_scores = (queries @ keys.transpose(-2, -1)) * self.scaling_factor
-        attention_scores = attention_scores.masked_fill(
-            self.attention_mask[:sequence_length, :sequence_length] == 0, float('-inf')
+        # (B, T, 3 * C) -> three tensors of shape (B, num_heads, T, head_size)
+        queries, keys, values = (
+            self.query_key_value(token_embeddings)
+            .view(batch_size, sequence_length, 3, self.number_of_heads, self.head_size)
+            .permute(2, 0, 3, 1, 4)
         )
 
-        attention_weights = F.softmax(attention_scores, dim=-1)
-        attention_weights = self.dropout(attention_weights)
-
-        output = attention_weights @ values  # (B, T, head_size)
-        return output
-
-
-class MultiHeadAttention(nn.Module):
-    def __init__(self, embedding_dim, number_of_heads, sequence_length):
-        super().__init__()
-        head_size = embedding_dim // number_of_heads
-        self.attention_heads = nn.ModuleList([
-            SelfAttentionHead(embedding_dim, head_size, sequence_length) for _ in range(number_of_heads)
-        ])
-        self.linear_projection = nn.Linear(embedding_dim, embedding_dim)
-        self.dropout = nn.Dropout(0.1)
+        # Prepend cached keys/values from earlier steps so new queries see the whole prefix
+        past_length = 0
+        if past_key_value is not None:
+            past_keys, past_values = past_key_value
+            past_length = past_keys.shape[2]
+            keys = torch.cat((past_keys, keys), dim=2)
+            values = torch.cat((past_values, values), dim=2)
+
+        output = self._attend(queries, keys, values, past_length, attention_mask)
+        output = output.transpose(1, 2).reshape(batch_size, sequence_length, embedding_dim)
+        projected_output = self.linear_projection(output)
+        return self.dropout(projected_output), (keys, values)
+
+    def _attend(self, queries, keys, values, past_length, padding_mask=None):
+        dropout_p = self.attention_dropout if self.training else 0.0
+        total_length = keys.shape[2]
+        if padding_mask is not None:
+            attention_mask = padding_mask
+        else:
+            attention_mask = self.attention_mask[past_length:total_length, :total_length]
+
+        if hasattr(F, "scaled_dot_product_attention"):
+            if padding_mask is None and past_length == 0:
+                return F.scaled_dot_product_attention(queries, keys, values, dropout_p=dropout_p, is_causal=True)
+            if padding_mask is None and queries.shape[2] == 1:
+                attention_mask = None  # A single new token may attend to every cached position
+            return F.scaled_dot_product_attention(
+                queries, keys, values, attn_mask=attention_mask, dropout_p=dropout_p
+            )
 
-    def forward(self, token_embeddings):
-        concatenated_outputs = torch.cat(
-            [head(token_embeddings) for head in self.attention_heads], dim=-1
-        )
-        projected_output = self.linear_projection(concatenated_outputs)
-        return self.dropout(projected_output)
+        attention_scores = (queries @ keys.transpose(-2, -1)) * self.scaling_factor
+        attention_scores = attention_scores.masked_fill(~attention_mask, float('-inf'))
+        attention_weights = F.softmax(attention_scores, dim=-1)
+        attention_weights = F.dropout(attention_weights, dropout_p)
+        return attention_weights @ values
 
 
 class FeedForwardNetwork(nn.Module):
@@ -70,15 +98,19 @@ class TransformerBlock(nn.Module):
         self.layer_norm_2 = nn.LayerNorm(embedding_dim)
         self.feed_forward = FeedForwardNetwork(embedding_dim)
 
-    def forward(self, token_embeddings):
-        x = token_embeddings + self.multi_head_attention(self.layer_norm_1(token_embeddings))
+    def forward(self, token_embeddings, past_key_value=None, attention_mask=None):
+        attention_output, present_key_value = self.multi_head_attention(
+            self.layer_norm_1(token_embeddings), past_key_value, attention_mask
+        )
+        x = token_embeddings + attention_output
         x = x + self.feed_forward(self.layer_norm_2(x))
-        return x
+        return x, present_key_value
 
 
 class GPTMiniModel(nn.Module):
     def __init__(self, vocabulary_size, sequence_length, embedding_dim=128, number_of_heads=4, number_of_layers=4):
         super().__init__()
+        self.sequence_length = sequence_length
         self.token_embedding_table = nn.Embedding(vocabulary_size, embedding_dim)
         self.position_embedding_table = nn.Embedding(sequence_length, embedding_dim)
 
@@ -89,23 +121,70 @@ class GPTMiniModel(nn.Module):
         self.final_layer_norm = nn.LayerNorm(embedding_dim)
         self.language_model_head = nn.Linear(embedding_dim, vocabulary_size)
 
-    def forward(self, input_indices, target_indices=None):
+    def forward(self, input_indices, target_indices=None, past_key_values=None, use_cache=False,
+                attention_mask=None):
+        """
+        Run the model over input_indices.
+
+        past_key_values holds the per-layer (keys, values) pairs, each shaped
+        (B, num_heads, T, head_size), returned by a previous call with use_cache=True;
+        input_indices then only contains the new tokens, which are positioned after the
+        cached prefix. With use_cache=True the return value is (logits, present_key_values)
+        so the caller can feed the cache back in next step.
+
+        attention_mask is an optional (B, past + T) tensor that is 1 for real tokens and 0
+        for padding, used to batch left-padded prompts of different lengths. Each row's
+        positions then count only its real tokens.
+        """
         batch_size, sequence_length = input_indices.shape
+        past_length = 0 if past_key_values is None else past_key_values[0][0].shape[2]
+
+        if attention_mask is None:
+            position_indices = torch.arange(past_length, past_length + sequence_length, device=input_indices.device)
+            padding_mask = None
+            last_position = past_length + sequence_length - 1
+        else:
+            position_indices = (attention_mask.long().cumsum(dim=-1) - 1).clamp(min=0)[:, past_length:]
+            padding_mask = self._padding_mask(attention_mask.bool(), past_length, sequence_length)
+            last_position = position_indices.max().item()
+        if last_position >= self.sequence_length:
+            raise ValueError(
+                f"Cannot process {sequence_length} tokens after a cache of {past_length}: "
+                f"the model only has {self.sequence_length} positions"
+            )
+
         token_embeddings = self.token_embedding_table(input_indices)
-        position_indices = torch.arange(sequence_length, device=input_indices.device)
         position_embeddings = self.position_embedding_table(position_indices)
 
         x = token_embeddings + position_embeddings
-        x = self.transformer_blocks(x)
+        if past_key_values is None:
+            past_key_values = [None] * len(self.transformer_blocks)
+        present_key_values = []
+        for block, past_key_value in zip(self.transformer_blocks, past_key_values):
+            x, present_key_value = block(x, past_key_value, padding_mask)
+            present_key_values.append(present_key_value)
         x = self.final_layer_norm(x)
         logits = self.language_model_head(x)
 
         if target_indices is None:
+            if use_cache:
+                return logits, present_key_values
             return logits
 
         # reshape logits and targets for loss computation
         batch_size, seq_len, vocab_size = logits.shape
         logits = logits.view(batch_size * seq_len, vocab_size)
-        target_indices = target_indices.view(batch_size * seq_len)
-        loss = F.cross_entropy(logits, target_indices)
+        target_indices = target_indices.reshape(batch_size * seq_len)
+        # Under autocast the logits may be bf16/fp16; log-softmax over the vocabulary in fp32
+        loss = F.cross_entropy(logits.float(), target_indices)
         return logits, loss
+
+    @staticmethod
+    def _padding_mask(attention_mask, past_length, sequence_length):
+        """(B, 1, T, past + T) boolean mask combining causality with key padding"""
+        total_length = past_length + sequence_length
+        causal = torch.ones(sequence_length, total_length, dtype=torch.bool, device=attention_mask.device)
+        causal = causal.tril(diagonal=past_length)
+        # Padding queries still attend to themselves so that no softmax row is empty
+        diagonal = causal & ~causal.tril(diagonal=past_length - 1)
+        return (causal & attention_mask[:, None, None, :]) | diagonal
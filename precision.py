@@ -0,0 +1,33 @@
+# precision.py
+"""
+Mixed-precision helpers shared by training and inference, selected by config.precision.
+
+"bf16" runs matmuls and attention under torch.autocast in bfloat16 (CPU or GPU) while
+the weights, optimizer state and loss stay in fp32. "fp16" does the same in float16 on
+CUDA and pairs it with gradient scaling, since fp16 gradients underflow without it.
+"""
+import contextlib
+import torch
+import config
+
+DTYPES = {"bf16": torch.bfloat16, "fp16": torch.float16}
+
+
+def autocast(precision=None, device=None):
+    """Context manager running eligible ops in the configured low precision; a no-op for fp32"""
+    precision = precision or config.precision
+    if precision == "fp32":
+        return contextlib.nullcontext()
+    if precision not in DTYPES:
+        raise ValueError(f"Unknown precision {precision!r}: expected 'fp32', 'bf16' or 'fp16'")
+    device_type = torch.device(device or config.device).type
+    if precision == "fp16" and device_type != "cuda":
+        raise ValueError("fp16 autocast needs a CUDA device; use 'bf16' on CPU")
+    return torch.autocast(device_type=device_type, dtype=DTYPES[precision])
+
+
+def grad_scaler(precision=None, device=None):
+    """GradScaler that is only active for fp16 (a pass-through otherwise)"""
+    precision = precision or config.precision
+    device_type = torch.device(device or config.device).type
+    return torch.amp.GradScaler(device_type, enabled=precision == "fp16")
@@ -0,0 +1,109 @@
+# prefix_cache.py
+"""
+Attention keys/values of already processed token prefixes, reused across prompts.
+
+A multi-turn chat prompt starts with every earlier turn, and many prompts share their
+opening tokens; IncrementalDecoder looks up the longest cached prefix of a prompt and
+only runs the model over the rest. Keys and values depend on every earlier token and on
+absolute positions, so a block is only reused after exactly the prefix it was computed
+for. Blocks are keyed by a hash chained from the previous block's key and the block's own
+tokens, which stands for the whole prefix without storing or rehashing it; each entry
+keeps its parent key and tokens, and a lookup checks both, so a hash collision is a miss.
+"""
+import collections
+import sys
+import torch
+import config
+
+
+class PrefixCache:
+    """
+    Blocks of block_tokens cached keys/values, evicted least-recently-used beyond max_mib.
+
+    A lookup refreshes a prefix's blocks from the last one to the first, so a block is
+    always more recently used than the blocks that extend it and eviction removes the
+    ends of prefixes before their beginnings. Each cache belongs to one model.
+    """
+
+    def __init__(self, max_mib=None, block_tokens=None):
+        self.max_bytes = (config.prefix_cache_mib if max_mib is None else max_mib) * 2 ** 20
+        self.block_tokens = block_tokens or config.prefix_cache_block
+        # Block key -> (parent key, block tokens, per-layer (keys, values), bytes)
+        self.blocks = collections.OrderedDict()
+        self.bytes = 0  # Keys/values plus the keys and tokens stored with them
+        self.lookup_tokens = 0  # Prompt tokens looked up
+        self.hit_tokens = 0     # Prompt tokens whose keys/values came from the cache
+        self.evicted_blocks = 0
+
+    def _keys(self, tokens, length):
+        """(key, parent key, block tokens) of each complete block in tokens[:length]"""
+        keys, parent = [], None
+        for start in range(0, length - self.block_tokens + 1, self.block_tokens):
+            block = tuple(tokens[start:start + self.block_tokens])
+            key = hash((parent, block))
+            keys.append((key, parent, block))
+            parent = key
+        return keys
+
+    def _cached(self, key, parent, block):
+        entry = self.blocks.get(key)
+        return entry is not None and entry[0] == parent and entry[1] == block
+
+    def lookup(self, tokens, max_length=None):
+        """
+        Longest cached prefix of tokens (a list of ids) that is at most max_length long.
+
+        Returns (length, past_key_values) in the model's (1, heads, length, head_size)
+        layout, or (0, None) on a miss.
+        """
+        max_length = len(tokens) if max_length is None else min(max_length, len(tokens))
+        self.lookup_tokens += len(tokens)
+        found = []
+        for key, parent, block in self._keys(tokens, max_length):
+            if not self._cached(key, parent, block):
+                break
+            found.append(key)
+        if not found:
+            return 0, None
+        for key in reversed(found):
+            self.blocks.move_to_end(key)
+        length = len(found) * self.block_tokens
+        self.hit_tokens += length
+        layers = zip(*(self.blocks[key][2] for key in found))
+        past_key_values = [
+            (torch.cat([keys for keys, _ in blocks], dim=2), torch.cat([values for _, values in blocks], dim=2))
+            for blocks in layers
+        ]
+        return length, past_key_values
+
+    def insert(self, tokens, past_key_values):
+        """Store the complete blocks of a (1, T) cache computed for tokens that are not cached yet"""
+        block_keys = self._keys(tokens, min(len(tokens), past_key_values[0][0].shape[2]))
+        for index, (key, parent, block) in enumerate(block_keys):
+            if self._cached(key, parent, block):
+                continue
+            if key in self.blocks:  # A hash collision: the newer block replaces the older one
+                self.bytes -= self.blocks.pop(key)[3]
+            start, end = index * self.block_tokens, (index + 1) * self.block_tokens
+            # Copies, so the block doesn't keep the whole decoder cache alive
+            layers = [(keys[:, :, start:end].clone(), values[:, :, start:end].clone())
+                      for keys, values in past_key_values]
+            size = (sum(keys.nbytes + values.nbytes for keys, values in layers) + sys.getsizeof(key)
+                    + sys.getsizeof(block))
+            self.blocks[key] = (parent, block, layers, size)
+            self.bytes += size
+        for key, _, _ in reversed(block_keys):
+            self.blocks.move_to_end(key)
+        while self.bytes > self.max_bytes and self.blocks:
+            self.bytes -= self.blocks.popitem(last=False)[1][3]
+            self.evicted_blocks += 1
+
+    def stats(self):
+        return {
+            "hit_rate": self.hit_tokens / self.lookup_tokens if self.lookup_tokens else 0.0,
+            "hit_tokens": self.hit_tokens,
+            "lookup_tokens": self.lookup_tokens,
+            "blocks": len(self.blocks),
+            "memory_mib": self.bytes / 2 ** 20,
+            "evicted_blocks": self.evicted_blocks,
+        }
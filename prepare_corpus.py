@@ -0,0 +1,166 @@
+# prepare_corpus.py
+"""
+Streaming corpus preparation for datasets larger than memory.
+
+Pass 1 reads the corpus in chunks to build the tokenizer vocabulary (the character
+set, or BPE chunk counts) and to record where each chunk starts. Pass 2 encodes the
+chunks in parallel over a process pool, each into its own shard token file (see
+dataset.py), with the last (1 - train_fraction) of the characters going to the "val"
+split. Peak memory is bounded by the chunk size per worker rather than the corpus.
+The manifest records the input file and settings, and shards that are still up to
+date are reused instead of being prepared again.
+
+Usage: python prepare_corpus.py <input.txt> <output_dir> [--tokenizer-name tokenizer]
+                                [--chunk-size 16777216] [--workers 4] [--force]
+"""
+import argparse
+import codecs
+import json
+import multiprocessing
+import os
+from tokenizer import BPETokenizer, CharTokenizer, load_tokenizer, save_tokenizer, tokenizer_path
+from dataset import MANIFEST, load_token_dataset, write_token_file
+import config
+
+
+def scan_corpus(input_path, chunk_size):
+    """
+    Pass 1: read the corpus chunk by chunk.
+
+    Returns (vocabulary, chunks, total_characters): vocabulary is the character set
+    (or BPE chunk counts) and chunks lists (byte_offset, byte_length, character_offset)
+    for pieces of the file that start and end on whole characters.
+    """
+    use_bpe = config.tokenizer_type == "bpe"
+    vocabulary = {} if use_bpe else set()
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    chunks = []
+    byte_offset = character_offset = 0
+
+    with open(input_path, "rb") as f:
+        while True:
+            raw = f.read(chunk_size)
+            text = decoder.decode(raw, final=not raw)
+            if text:
+                if use_bpe:
+                    BPETokenizer.count_chunks(text, vocabulary)
+                else:
+                    vocabulary.update(text)
+                # Bytes of a character split across reads stay in the decoder for the next chunk
+                end = f.tell() - len(decoder.getstate()[0])
+                chunks.append((byte_offset, end - byte_offset, character_offset))
+                byte_offset = end
+                character_offset += len(text)
+            if not raw:
+                break
+    return vocabulary, chunks, character_offset
+
+
+def encode_shard(task):
+    """Pass 2: encode one chunk of the corpus into a shard token file"""
+    input_path, byte_offset, byte_length, character_offset, val_start, tokenizer, shard_path = task
+    with open(input_path, "rb") as f:
+        f.seek(byte_offset)
+        text = f.read(byte_length).decode("utf-8")
+
+    split_at = min(max(val_start - character_offset, 0), len(text))
+    splits = {}
+    if split_at > 0:
+        splits["train"] = tokenizer.encode_array(text[:split_at])
+    if split_at < len(text):
+        splits["val"] = tokenizer.encode_array(text[split_at:])
+    write_token_file(shard_path, splits, tokenizer.vocab_size)
+    return {name: len(tokens) for name, tokens in splits.items()}
+
+
+def corpus_source(input_path, tokenizer_name, train_fraction):
+    """Everything the prepared shards depend on, stored in the manifest to detect stale data"""
+    stat = os.stat(input_path)
+    return {
+        "input_path": os.path.abspath(input_path),
+        "input_bytes": stat.st_size,
+        "input_mtime": stat.st_mtime,
+        "tokenizer": tokenizer_path(tokenizer_name),
+        "bpe_vocab_size": config.bpe_vocab_size if config.tokenizer_type == "bpe" else None,
+        "train_fraction": train_fraction,
+    }
+
+
+def is_prepared(input_path, output_dir, tokenizer_name, train_fraction=0.9):
+    """Whether output_dir and the saved tokenizer already hold input_path prepared with these settings"""
+    try:
+        with open(os.path.join(output_dir, MANIFEST), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return False
+    return (manifest.get("source") == corpus_source(input_path, tokenizer_name, train_fraction)
+            and os.path.exists(tokenizer_path(tokenizer_name)))
+
+
+def prepare_corpus(input_path, output_dir, tokenizer_name, chunk_size=None, num_workers=None, train_fraction=0.9,
+                   force=False):
+    """
+    Build and save the tokenizer for input_path and encode it into token shards in output_dir.
+
+    Shards and tokenizer that is_prepared() finds up to date are kept unless force is
+    set. Returns the tokenizer either way.
+    """
+    if not force and is_prepared(input_path, output_dir, tokenizer_name, train_fraction):
+        return load_tokenizer(tokenizer_path(tokenizer_name))
+    chunk_size = chunk_size or config.prep_chunk_size
+    num_workers = num_workers or config.prep_workers
+
+    vocabulary, chunks, total_characters = scan_corpus(input_path, chunk_size)
+    if config.tokenizer_type == "bpe":
+        tokenizer = BPETokenizer.train_from_counts(vocabulary, config.bpe_vocab_size)
+    else:
+        tokenizer = CharTokenizer("".join(vocabulary))
+    save_tokenizer(tokenizer, tokenizer_path(tokenizer_name))
+
+    os.makedirs(output_dir, exist_ok=True)
+    val_start = int(train_fraction * total_characters)
+    shard_names = [f"shard_{i:05d}.bin" for i in range(len(chunks))]
+    tasks = [
+        (input_path, byte_offset, byte_length, character_offset, val_start, tokenizer, os.path.join(output_dir, name))
+        for (byte_offset, byte_length, character_offset), name in zip(chunks, shard_names)
+    ]
+    if num_workers > 1 and len(tasks) > 1:
+        # Forked workers don't re-import the calling script (train.py etc. run at import time)
+        start_method = "fork" if "fork" in multiprocessing.get_all_start_methods() else None
+        with multiprocessing.get_context(start_method).Pool(min(num_workers, len(tasks))) as pool:
+            shard_lengths = pool.map(encode_shard, tasks)
+    else:
+        shard_lengths = [encode_shard(task) for task in tasks]
+
+    manifest = {
+        "source": corpus_source(input_path, tokenizer_name, train_fraction),
+        "vocab_size": tokenizer.vocab_size,
+        "characters": total_characters,
+        "shards": shard_names,
+        "tokens": {
+            split: sum(lengths.get(split, 0) for lengths in shard_lengths) for split in ("train", "val")
+        },
+    }
+    with open(os.path.join(output_dir, MANIFEST), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    load_token_dataset.cache_clear()
+    return tokenizer
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stream a text corpus into token shards")
+    parser.add_argument("input_path")
+    parser.add_argument("output_dir")
+    parser.add_argument("--tokenizer-name", default="tokenizer", help="Saved as data/<name>.pt or .json")
+    parser.add_argument("--chunk-size", type=int, default=config.prep_chunk_size, help="Bytes per shard")
+    parser.add_argument("--workers", type=int, default=config.prep_workers)
+    parser.add_argument("--force", action="store_true", help="Prepare again even if the shards are up to date")
+    args = parser.parse_args()
+
+    tokenizer = prepare_corpus(args.input_path, args.output_dir, args.tokenizer_name,
+                               args.chunk_size, args.workers, force=args.force)
+    with open(os.path.join(args.output_dir, MANIFEST), encoding="utf-8") as f:
+        manifest = json.load(f)
+    print(f"✅ Encoded {manifest['characters']} characters into {len(manifest['shards'])} shards "
+          f"({manifest['tokens']['train']} train / {manifest['tokens']['val']} val tokens, "
+          f"vocabulary size {tokenizer.vocab_size})")
@@ -1,31 +1,43 @@
-import torch
-from tokenizer import CharTokenizer
-import config
+# prepare_dataset.py
+"""
+The Shakespeare dataset (data/input.txt) used by train.py.
+
+Importing this module does no work: prepare_dataset() encodes the corpus into
+data/tokens (only when the shards are missing or out of date, see prepare_corpus.py)
+and get_batch() prepares it on first use.
 
-with open("data/input.txt","r",encoding="utf-8") as f:
-    text = f.read()
-    
-# Initialize the tokenizer
-tokenizer = CharTokenizer(text)
+Usage: python prepare_dataset.py [--force]
+"""
+import argparse
+from prepare_corpus import prepare_corpus
+from dataset import load_token_dataset
+import config
 
-# Encode the entire text to integer tokens
-data = torch.tensor(tokenizer.encode(text),dtype=torch.long)
+_samplers = {}
 
-# Split into train and validation sets
 
-n = int(0.9 * len(data))
-train_data = data[:n]
-val_data = data[n:]
+def prepare_dataset(force=False):
+    """Tokenizer and shards for data/input.txt, prepared if needed; returns the TokenDataset"""
+    prepare_corpus("data/input.txt", "data/tokens", "tokenizer", train_fraction=0.9, force=force)
+    return load_token_dataset("data/tokens")
 
-# Save the train and validation data
-torch.save(train_data, "data/train.pt")
-torch.save(val_data, "data/val.pt")
-torch.save(tokenizer, "data/tokenizer.pt") # Save the tokenizer for later use
-print(f"Dataset prepared with {len(train_data)} training tokens and {len(val_data)} validation tokens.")
 
 def get_batch(split):
-    data = train_data if split == 'train' else val_data
-    ix = torch.randint(len(data) - config.block_size, (config.batch_size,))
-    x = torch.stack([data[i:i + config.block_size] for i in ix])
-    y = torch.stack([data[i + 1:i + config.block_size + 1] for i in ix])
-    return x, y
\ No newline at end of file
+    if not _samplers:
+        token_dataset = prepare_dataset()
+        # Batches are written into reusable buffers (pinned when training on a GPU)
+        for name in ('train', 'val'):
+            _samplers[name] = token_dataset.sampler(name, config.batch_size, config.block_size,
+                                                    pin_memory=config.device == 'cuda')
+    return _samplers[split]()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Encode data/input.txt into data/tokens for train.py")
+    parser.add_argument("--force", action="store_true", help="Prepare again even if the shards are up to date")
+    args = parser.parse_args()
+
+    token_dataset = prepare_dataset(args.force)
+    train_data, val_data = token_dataset["train"], token_dataset["val"]
+    print(f"Dataset prepared with {len(train_data)} training tokens and {len(val_data)} validation tokens "
+          f"({token_dataset.manifest['characters'] / (len(train_data) + len(val_data)):.2f} characters per token).")
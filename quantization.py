@@ -0,0 +1,135 @@
+# quantization.py
+"""
+Int8 CPU inference through dynamic quantization of GPTMiniModel's nn.Linear layers.
+
+The fused query/key/value and output projections of every attention layer, both
+FeedForwardNetwork layers and language_model_head keep their weights in int8 (one scale
+per output channel); activations are quantized on the fly for each matmul and the
+results come back in fp32. Embeddings and layer norms stay in fp32. Quantized models run
+on the CPU with config.precision = "fp32" only.
+
+Usage:
+    python quantization.py checkpoints/mini_gpt_v2_best.pt [--tokenizer data/tokenizer_v2.pt] [--output ...]
+    python quantization.py checkpoints/mini_gpt_v2_best.pt --report [--data data/tokens_v2]
+"""
+import argparse
+import contextlib
+import io
+import os
+import time
+import warnings
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.ao.quantization import per_channel_dynamic_qconfig, quantize_dynamic
+from generation import IncrementalDecoder
+from dataset import load_token_dataset
+from evaluate import evaluate
+from tokenizer import tokenizer_path
+import config
+
+
+@contextlib.contextmanager
+def quantization_warnings_ignored():
+    # torch.ao.quantization and quantized tensors announce their move to torchao on every use
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        warnings.simplefilter("ignore", UserWarning)
+        yield
+
+
+def quantize(model):
+    """Replace the nn.Linear layers of a CPU model by int8 dynamically quantized ones (in place)"""
+    if any(parameter.device.type != "cpu" for parameter in model.parameters()):
+        raise ValueError("Dynamic int8 quantization runs on the CPU only; load the model with device 'cpu'")
+    model.eval()
+    with quantization_warnings_ignored():
+        return quantize_dynamic(model, {nn.Linear: per_channel_dynamic_qconfig}, dtype=torch.qint8, inplace=True)
+
+
+def is_quantized(state_dict):
+    return any(key.endswith("_packed_params._packed_params") for key in state_dict)
+
+
+def load_weights(model, path, int8=None):
+    """
+    Load a checkpoint written by torch.save(model.state_dict()) or by this module into model.
+
+    int8 checkpoints quantize model before loading; fp32 checkpoints are quantized after
+    loading when int8 (default config.quantize) is set. Returns the model, ready for inference.
+    """
+    with quantization_warnings_ignored():
+        state_dict = torch.load(path, map_location=config.device)
+    if is_quantized(state_dict):
+        model = quantize(model)
+        model.load_state_dict(state_dict)
+    else:
+        model.load_state_dict(state_dict)
+        if config.quantize if int8 is None else int8:
+            model = quantize(model)
+    model.eval()
+    return model
+
+
+def weight_bytes(model):
+    """Size of the serialized state dict, i.e. the memory the weights take"""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes
+
+
+def decode_tokens_per_second(model, batch_size=1, prompt_length=16, new_tokens=100):
+    torch.manual_seed(0)
+    decoder = IncrementalDecoder(model)
+    prompt = torch.randint(0, model.language_model_head.out_features, (batch_size, prompt_length))
+    logits = decoder.prefill(prompt)  # Warm-up
+    start = time.perf_counter()
+    logits = decoder.prefill(prompt)
+    for _ in range(new_tokens):
+        next_tokens = torch.multinomial(F.softmax(logits, dim=-1), num_samples=1)
+        logits = decoder.step(next_tokens)
+    return batch_size * new_tokens / (time.perf_counter() - start)
+
+
+def report(checkpoint, tokenizer_file, data_path, max_batches=None):
+    """Decoding throughput, weight memory and validation loss of a checkpoint in fp32 and int8"""
+    from bundle import load_model  # bundle imports this module
+    token_dataset = load_token_dataset(data_path)
+    rows = {}
+    for name in ("fp32", "int8"):
+        model, _ = load_model(checkpoint, tokenizer_file, device="cpu", int8=name == "int8")
+        metrics = evaluate(model, token_dataset["val"], max_batches=max_batches, precision="fp32", device="cpu")
+        rows[name] = (decode_tokens_per_second(model), decode_tokens_per_second(model, batch_size=8),
+                      weight_bytes(model) / 2 ** 20, metrics["loss"], metrics["tokens_per_second"])
+
+    print(f"\n📊 {checkpoint}: fp32 vs int8 on the CPU ({torch.get_num_threads()} threads, "
+          f"{metrics['tokens']:,} val tokens)")
+    print(f"{'':>5} | {'decode tok/s':>12} | {'batch 8 tok/s':>13} | {'weights MiB':>11} | "
+          f"{'val loss':>8} | {'eval tok/s':>10}")
+    for name, (decode, batched, mebibytes, loss, eval_speed) in rows.items():
+        print(f"{name:>5} | {decode:>12,.0f} | {batched:>13,.0f} | {mebibytes:>11.2f} | {loss:>8.4f} | "
+              f"{eval_speed:>10,.0f}")
+    print(f"Val loss drift: {rows['int8'][3] - rows['fp32'][3]:+.4f} | "
+          f"Weights: {rows['int8'][2] / rows['fp32'][2]:.0%} of fp32")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert a checkpoint to int8 for CPU inference")
+    parser.add_argument("checkpoint", help="fp32 state dict, e.g. checkpoints/mini_gpt_v2_best.pt")
+    parser.add_argument("--output", help="Default: the checkpoint path with an _int8 suffix")
+    parser.add_argument("--tokenizer", default=tokenizer_path("tokenizer_v2"),
+                        help="Tokenizer the checkpoint was trained with (its vocabulary size), unless it has a bundle")
+    parser.add_argument("--data", default="data/tokens_v2", help="--report: token dataset to validate on")
+    parser.add_argument("--report", action="store_true", help="Compare speed, memory and val loss with fp32")
+    parser.add_argument("--max-batches", type=int, default=None, help="--report: val batches (default all)")
+    args = parser.parse_args()
+
+    if args.report:
+        report(args.checkpoint, args.tokenizer, args.data, args.max_batches)
+    else:
+        from bundle import load_model  # bundle imports this module
+        model, _ = load_model(args.checkpoint, args.tokenizer, device="cpu", int8=True)
+        output = args.output or f"{os.path.splitext(args.checkpoint)[0]}_int8.pt"
+        torch.save(model.state_dict(), output)
+        print(f"✅ Saved int8 model to {output} ({os.path.getsize(args.checkpoint) / 2 ** 20:.2f} MiB -> "
+              f"{os.path.getsize(output) / 2 ** 20:.2f} MiB)")
@@ -3,17 +3,19 @@ import torch
 import torch.nn as nn
 import torch.optim as optim
 from model import GPTMiniModel
-from prepare_dataset import get_batch
-from tokenizer import CharTokenizer
+from prepare_dataset import prepare_dataset
+from tokenizer import load_tokenizer, tokenizer_path
 import config
 import os
 
 print("🧪 Quick Training Test for Chat Model V2")
 print("=" * 50)
 
+# Encode data/input.txt unless data/tokens is already up to date
+token_dataset = prepare_dataset()
+
 # Load tokenizer and set vocab size in config
-with torch.serialization.safe_globals({"tokenizer.CharTokenizer": CharTokenizer}):
-    tokenizer: CharTokenizer = torch.load("data/tokenizer.pt", weights_only=False)
+tokenizer = load_tokenizer(tokenizer_path("tokenizer"))
 
 # Update config with the actual vocabulary size from tokenizer
 config.vocab_size = tokenizer.vocab_size
@@ -47,7 +49,7 @@ quick_iters = 100
 eval_interval = 25
 
 for iteration in range(quick_iters):
-    xb, yb = get_batch('train')
+    xb, yb = token_dataset.get_batch('train')
     xb, yb = xb.to(config.device), yb.to(config.device)
 
     logits, loss = model(xb, yb)
@@ -60,7 +62,7 @@ for iteration in range(quick_iters):
     if iteration % eval_interval == 0 or iteration == quick_iters - 1:
         model.eval()
         with torch.no_grad():
-            val_x, val_y = get_batch('val')
+            val_x, val_y = token_dataset.get_batch('val')
             val_x, val_y = val_x.to(config.device), val_y.to(config.device)
             _, val_loss = model(val_x, val_y)
         model.train()
@@ -0,0 +1,78 @@
+# startup_profile.py
+"""
+Import-time profile of the command-line entry points.
+
+For each script, its module-level import statements (not the rest of the script) run
+in a fresh interpreter under python -X importtime. The report shows the wall time of
+those imports and the packages whose own module code takes the most of it.
+
+Usage: python startup_profile.py [script.py ...] [--top 4]
+"""
+import argparse
+import ast
+import collections
+import os
+import subprocess
+import sys
+
+ENTRY_POINTS = (
+    "train.py", "train_v2.py", "train_distributed.py", "quick_train_test.py", "prepare_dataset.py",
+    "prepare_corpus.py", "evaluate.py", "quantization.py", "bundle.py", "benchmark.py", "chat_v2.py",
+    "chatbot_v2.py", "simple_chat.py", "chat_server.py", "test_model.py", "create_chat_dataset.py",
+    "create_extended_dataset.py", "download_chat_dataset.py",
+)
+
+
+def import_statements(script):
+    """Source of the module-level import statements of script"""
+    with open(script, "r", encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    return "\n".join(ast.unparse(node) for node in tree.body if isinstance(node, (ast.Import, ast.ImportFrom)))
+
+
+def _import_times(code, cwd=None):
+    """Output of code and the (module, self seconds) pairs python -X importtime reports for it"""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True, cwd=cwd)
+    if result.returncode:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    modules = []
+    for line in result.stderr.splitlines():
+        # "import time: <self us> | <cumulative us> | <indented module name>", after a header line
+        fields = line.removeprefix("import time:").split("|")
+        if len(fields) == 3 and fields[0].strip().isdigit():
+            modules.append((fields[2].strip(), int(fields[0]) / 1e6))
+    return result.stdout, modules
+
+
+def profile(script):
+    """
+    (seconds, {package: self seconds}) of importing what script imports at module level.
+
+    Modules the interpreter imports at start-up are left out. Raises RuntimeError with
+    the interpreter's last error line if an import fails.
+    """
+    startup_modules = {module for module, _ in _import_times("pass")[1]}
+    code = f"import time\nstart = time.perf_counter()\n{import_statements(script)}\nprint(time.perf_counter() - start)"
+    output, modules = _import_times(code, cwd=os.path.dirname(os.path.abspath(script)))
+    packages = collections.Counter()
+    for module, seconds in modules:
+        if module not in startup_modules:
+            packages[module.split(".")[0]] += seconds
+    return float(output.split()[-1]), packages
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import time of each command-line entry point")
+    parser.add_argument("scripts", nargs="*", default=ENTRY_POINTS, help="Default: every entry point")
+    parser.add_argument("--top", type=int, default=4, help="Packages listed per script")
+    args = parser.parse_args()
+
+    print(f"{'script':>26} | {'imports ms':>10} | packages by own import time (ms)")
+    for script in args.scripts:
+        try:
+            seconds, packages = profile(script)
+        except RuntimeError as e:
+            print(f"{script:>26} | {'failed':>10} | {e}")
+            continue
+        top = ", ".join(f"{name} {package_seconds * 1000:.0f}" for name, package_seconds in packages.most_common(args.top))
+        print(f"{script:>26} | {seconds * 1000:>10.0f} | {top}")
@@ -0,0 +1,40 @@
+import os
+import tempfile
+import torch
+from model import GPTMiniModel
+from bundle import load_model, save_bundle
+from generation import IncrementalDecoder
+from tokenizer import BPETokenizer, CharTokenizer, tokenizer_from_state, tokenizer_state
+
+torch.manual_seed(0)
+
+# A context shorter than config.block_size, which only the bundle knows about
+architecture = dict(vocabulary_size=20, sequence_length=16, embedding_dim=32, number_of_heads=4, number_of_layers=2)
+model = GPTMiniModel(**architecture)
+model.eval()
+tokenizer = CharTokenizer("ABCDEFGHIJKLMNOPQRST")
+tokens = torch.randint(0, 20, (2, 16))
+
+# A bundle carries the architecture and tokenizer, so it loads without either being passed
+with torch.no_grad(), tempfile.TemporaryDirectory() as directory:
+    checkpoint = os.path.join(directory, "model.pt")
+    torch.save(model.state_dict(), checkpoint)
+    save_bundle(os.path.join(directory, "model.bundle"), model.state_dict(), tokenizer, architecture)
+    bundled_model, bundled_tokenizer = load_model(checkpoint, device="cpu")
+    assert torch.equal(bundled_model(tokens), model(tokens)), "Bundled weights differ."
+
+    # Decoding past the end of its context refills instead of running out of positions
+    decoder = IncrementalDecoder(bundled_model)
+    decoder.prefill(tokens[:, :10])
+    for t in range(20):
+        decoder.step(tokens[:, t % 16:t % 16 + 1])
+    assert decoder.block_size == 16 and decoder.cache_length <= 16
+
+    # Without the bundle the state dict loads into the architecture passed in
+    state_dict_model, no_tokenizer = load_model(checkpoint, architecture=architecture, device="cpu",
+                                                prefer_bundle=False)
+    assert no_tokenizer is None and torch.equal(state_dict_model(tokens), model(tokens))
+assert bundled_tokenizer.encode("ABBA") == tokenizer.encode("ABBA")
+bpe = BPETokenizer.train("hello hello world", 260)
+assert tokenizer_from_state(tokenizer_state(bpe)).encode("hello world") == bpe.encode("hello world")
+print("Model bundle round-trips weights, architecture and tokenizer.")
@@ -0,0 +1,121 @@
+import asyncio
+import json
+import torch
+from model import GPTMiniModel
+from generation import StopSequenceMatcher, generate_batch
+from tokenizer import CharTokenizer
+from chat_server import ContinuousBatchScheduler, make_handler
+
+torch.manual_seed(0)
+
+tokenizer = CharTokenizer("Human: Assistant\n abcdefghijklmnopqrstuvwxyz?!.")
+model = GPTMiniModel(vocabulary_size=tokenizer.vocab_size, sequence_length=64, embedding_dim=32,
+                     number_of_heads=4, number_of_layers=2)
+model.eval()
+# Low enough that sampling always picks the most likely token, so batched and solo runs agree
+temperature = 1e-4
+messages = ["hi", "how are you today?", "tell me a joke", "ok"]
+
+
+def solo(message, max_tokens):
+    """The reply to message from a batch of its own"""
+    return generate_batch(model, tokenizer, [f"Human: {message}\nAssistant:"], max_tokens, temperature,
+                          stop_strings=())[0]
+
+
+async def until(condition):
+    while not condition():
+        await asyncio.sleep(0.001)
+
+
+async def http_post(port, payload):
+    """(status, JSON body) of POST /chat"""
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    body = json.dumps(payload).encode()
+    writer.write(f"POST /chat HTTP/1.1\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, body = response.split(b"\r\n\r\n", 1)
+    return int(head.split()[1]), json.loads(body)
+
+
+async def join_mid_batch():
+    # Requests with different prompt lengths join a running batch and leave it at max_tokens
+    scheduler = ContinuousBatchScheduler(model, tokenizer, max_queue_wait=0, prefix_cache=False)
+    runner = asyncio.create_task(scheduler.run())
+    first = scheduler.new_request(messages[0], 20, temperature)
+    replies = [asyncio.create_task(scheduler.submit(first))]
+    await until(lambda: len(first.generated_tokens) >= 5)
+    later = [scheduler.new_request(message, max_tokens, temperature)
+             for message, max_tokens in zip(messages[1:], (12, 3, 16))]
+    replies += [asyncio.create_task(scheduler.submit(request)) for request in later]
+    await asyncio.gather(*replies)
+    for request, message in zip([first] + later, messages):
+        assert tokenizer.decode(request.generated_tokens) == solo(message, request.max_tokens), message
+    assert scheduler.stats.completed_requests == 4 and not scheduler.active
+    runner.cancel()
+
+
+async def stop_string():
+    # A request leaves the batch at its stop string, which is left out of the reply
+    expected = solo(messages[1], 20)
+    stop = expected[6:8]
+    scheduler = ContinuousBatchScheduler(model, tokenizer, max_queue_wait=0, prefix_cache=False)
+    scheduler.stop_matcher = StopSequenceMatcher(tokenizer, (stop,))
+    runner = asyncio.create_task(scheduler.run())
+    request = scheduler.new_request(messages[1], 20, temperature)
+    reply = await scheduler.submit(request)
+    assert reply == expected[:expected.index(stop)].strip() and len(request.generated_tokens) < 20, (reply, stop)
+    runner.cancel()
+
+
+async def failing_request():
+    # A request whose prefill fails is ended on its own; the rest of its batch carries on
+    scheduler = ContinuousBatchScheduler(model, tokenizer, max_queue_wait=0.05, prefix_cache=False)
+    bad_prompt = tokenizer.encode(f"Human: {messages[2]}\nAssistant:")
+    add_rows = scheduler.decoder.add_rows
+
+    def flaky_add_rows(tokens, attention_mask=None):
+        if any(row[-len(bad_prompt):].tolist() == bad_prompt for row in tokens):
+            raise RuntimeError("prefill failed")
+        return add_rows(tokens, attention_mask)
+
+    scheduler.decoder.add_rows = flaky_add_rows
+    runner = asyncio.create_task(scheduler.run())
+    requests = [scheduler.new_request(message, 10, temperature) for message in messages]
+    results = await asyncio.gather(*(scheduler.submit(request) for request in requests), return_exceptions=True)
+    assert isinstance(results[2], RuntimeError) and "prefill failed" in str(results[2])
+    for request, message, result in zip(requests, messages, results):
+        if message != messages[2]:
+            assert not isinstance(result, Exception) and request.error is None, result
+            assert tokenizer.decode(request.generated_tokens) == solo(message, 10), message
+    assert scheduler.stats.failed_requests == 1 and scheduler.stats.completed_requests == 3
+    runner.cancel()
+
+
+async def http_validation():
+    # Requests the model can't serve are rejected with 400 before joining the batch
+    scheduler = ContinuousBatchScheduler(model, tokenizer, max_queue_wait=0, prefix_cache=False)
+    runner = asyncio.create_task(scheduler.run())
+    server = await asyncio.start_server(make_handler(scheduler), "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    for payload in ({"message": "hi ~"}, {"message": "hi", "temperature": 0}, {"message": "hi", "max_tokens": 0},
+                    ["hi"], {"text": "hi"}):
+        status, body = await http_post(port, payload)
+        assert status == 400 and "error" in body, (payload, status, body)
+    status, body = await http_post(port, {"message": "hi", "max_tokens": 5, "temperature": temperature})
+    assert status == 200 and body["response"] == solo("hi", 5).strip(), body
+    assert scheduler.stats.completed_requests == 1
+    server.close()
+    runner.cancel()
+
+
+asyncio.run(join_mid_batch())
+print("Requests joining mid-batch get the same tokens as a solo run and leave at max_tokens.")
+asyncio.run(stop_string())
+print("Requests leave the batch at a stop string.")
+asyncio.run(failing_request())
+print("A failing request is ended without stopping the rest of its batch.")
+asyncio.run(http_validation())
+print("Unservable requests are rejected with 400.")
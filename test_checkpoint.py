@@ -0,0 +1,42 @@
+import os
+import subprocess
+import sys
+import tempfile
+import torch
+
+REPOSITORY = os.path.dirname(os.path.abspath(__file__))
+
+# A tiny, seeded train_v2.py run: every setting that affects the weights is fixed here
+TRAIN_SCRIPT = """
+import runpy
+import sys
+import config
+config.batch_size, config.effective_batch_size, config.block_size = 2, 4, 16
+config.embed_dim, config.num_heads, config.num_layers = 16, 2, 1
+config.max_iters, config.checkpoint_interval, config.eval_interval = int(sys.argv[1]), 4, 1000
+config.eval_max_batches, config.eval_batch_size, config.eval_in_background = 1, 4, False
+config.seed, config.device, config.precision, config.prep_workers = 1337, "cpu", "fp32", 1
+sys.argv = ["train_v2.py"] + sys.argv[2:]
+runpy.run_module("train_v2", run_name="__main__")
+"""
+
+
+def train(directory, max_iters, *arguments):
+    """Run train_v2.py in directory for max_iters iterations and return the final weights"""
+    os.makedirs(os.path.join(directory, "data"), exist_ok=True)
+    with open(os.path.join(directory, "data", "conversation_input.txt"), "w", encoding="utf-8") as f:
+        f.write("Human: Hello there!\nAssistant: Hi, how are you today?\n\n" * 40)
+    environment = dict(os.environ, PYTHONPATH=REPOSITORY)
+    subprocess.run([sys.executable, "-c", TRAIN_SCRIPT, str(max_iters), *arguments], cwd=directory,
+                   env=environment, check=True, capture_output=True)
+    return torch.load(os.path.join(directory, "checkpoints", "mini_gpt_v2.pt"))
+
+
+# Resuming after 4 iterations gives the same weights as 8 iterations without stopping
+with tempfile.TemporaryDirectory() as uninterrupted, tempfile.TemporaryDirectory() as interrupted:
+    expected = train(uninterrupted, 8)
+    train(interrupted, 4)
+    resumed = train(interrupted, 8, "--resume")
+for name, weights in expected.items():
+    assert torch.equal(resumed[name], weights), f"{name} differs after resuming."
+print("Resumed training matches an uninterrupted run.")
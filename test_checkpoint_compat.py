@@ -0,0 +1,26 @@
+import torch
+from model import GPTMiniModel
+
+# Checkpoints saved with one SelfAttentionHead module per head must still load
+# into the fused attention layout.
+state_dict = torch.load("checkpoints/mini_gpt_v2_best.pt", map_location="cpu")
+vocabulary_size, embedding_dim = state_dict["token_embedding_table.weight"].shape
+sequence_length = state_dict["position_embedding_table.weight"].shape[0]
+
+model = GPTMiniModel(vocabulary_size, sequence_length, embedding_dim=embedding_dim,
+                     number_of_heads=4, number_of_layers=2)
+model.load_state_dict(dict(state_dict))
+
+fused = model.transformer_blocks[0].multi_head_attention.query_key_value.weight
+head_size = embedding_dim // 4
+for i, projection in enumerate(("query", "key", "value")):
+    for head in range(4):
+        legacy = state_dict[f"transformer_blocks.0.multi_head_attention.attention_heads.{head}.{projection}.weight"]
+        rows = slice(i * embedding_dim + head * head_size, i * embedding_dim + (head + 1) * head_size)
+        assert torch.equal(fused[rows], legacy), f"{projection} weights of head {head} were not converted."
+
+# Converted checkpoints round-trip through the fused format
+reloaded = GPTMiniModel(vocabulary_size, sequence_length, embedding_dim=embedding_dim,
+                        number_of_heads=4, number_of_layers=2)
+reloaded.load_state_dict(model.state_dict())
+print("Legacy per-head checkpoint loads into fused attention.")
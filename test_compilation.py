@@ -0,0 +1,27 @@
+import torch
+from model import GPTMiniModel
+from generation import IncrementalDecoder
+from compilation import compile_model
+
+torch.manual_seed(0)
+
+block_size = 32
+model = GPTMiniModel(vocabulary_size=20, sequence_length=block_size, embedding_dim=32,
+                     number_of_heads=4, number_of_layers=2)
+model.eval()
+
+# TorchScript prefill/step graphs give the eager logits, including across a cache refill
+traced = compile_model(model, "torchscript", verbose=False)
+tokens = torch.randint(0, 20, (2, block_size))
+assert traced.compile_backend == "torchscript"
+eager_decoder, traced_decoder = IncrementalDecoder(model, block_size=block_size), IncrementalDecoder(traced, block_size=block_size)
+eager_logits, traced_logits = [eager_decoder.prefill(tokens[:, :7])], [traced_decoder.prefill(tokens[:, :7])]
+for t in range(block_size + 5):
+    next_tokens = tokens[:, t % block_size:t % block_size + 1]
+    eager_logits.append(eager_decoder.step(next_tokens))
+    traced_logits.append(traced_decoder.step(next_tokens))
+assert torch.allclose(torch.stack(traced_logits), torch.stack(eager_logits), atol=1e-5)
+print("Traced inference graphs match eager decoding.")
+
+# Without a block_size the decoder covers the model's positions, compiled or not
+assert IncrementalDecoder(model).block_size == IncrementalDecoder(traced).block_size == block_size
@@ -0,0 +1,18 @@
+from conversation import ConversationContext
+from tokenizer import CharTokenizer
+
+# Conversation prompts fit the block, drop whole turns from the start and keep a reusable prefix
+char_tokenizer = CharTokenizer("Human: Assistant\n abcdefghijklmnopqrstuvwxyz0123456789!?.")
+conversation = ConversationContext(char_tokenizer, block_size=256, reply_tokens=20)
+prompts = []
+for turn in range(12):
+    prompts.append(conversation.prompt(f"question {turn}?"))
+    assert len(char_tokenizer.encode(prompts[-1])) <= 236 and prompts[-1].startswith("Human: question ")
+    conversation.add_turn(f"question {turn}?", "an answer.")
+assert conversation.evicted_turns and conversation.history_tokens <= 236
+# After an eviction the shortened history stays the prompt's prefix for the following turns
+stable = [prompts[turn + 1].startswith(prompts[turn][:-len(f"Human: question {turn}?\nAssistant:")])
+          for turn in range(len(prompts) - 1)]
+assert not all(stable) and all(stable[turn] or stable[turn + 1] and stable[turn + 2]
+                               for turn in range(len(stable) - 2)), stable
+print("Conversation context evicts whole turns and keeps prompts within the block.")
@@ -1,6 +1,85 @@
+import os
+import tempfile
+import numpy as np
+import torch
+import torch.nn.functional as F
+from dataset import PrefetchLoader, ShardedSplit, TokenFile, sample_batch, write_token_file
+from evaluate import evaluate, window_starts
+from model import GPTMiniModel
 from prepare_dataset import get_batch
 
 x, y = get_batch('train')
 print(f"Batch x shape: {x.shape}, Batch y shape: {y.shape}")
 print(f"First batch x: {x[0]}")
-print(f"First batch y: {y[0]}")
\ No newline at end of file
+print(f"First batch y: {y[0]}")
+
+# Token files round-trip every split through the header, in the smallest dtype for the vocabulary
+with tempfile.TemporaryDirectory() as directory:
+    for vocab_size, dtype in ((256, np.uint8), (257, np.uint16), (70000, np.uint32)):
+        path = os.path.join(directory, f"tokens_{vocab_size}.bin")
+        splits = {"train": np.arange(1000) % vocab_size, "val": (np.arange(300) * 7) % vocab_size, "empty": []}
+        write_token_file(path, splits, vocab_size)
+        token_file = TokenFile(path)
+        assert token_file.vocab_size == vocab_size and token_file.dtype == dtype
+        assert list(token_file.splits) == list(splits)
+        for name, tokens in splits.items():
+            assert np.array_equal(token_file[name], np.asarray(tokens, dtype=dtype)), name
+    with open(path, "r+b") as f:
+        f.write(b"NOTTOKEN")
+    try:
+        TokenFile(path)
+        raise AssertionError("A file with the wrong magic bytes was read as a token file.")
+    except ValueError:
+        pass
+print("Token file headers round-trip splits, vocabulary size and dtype.")
+
+# Prefetched batches depend only on the seed, and skip_batches resumes the same sequence
+data = np.arange(5000, dtype=np.uint16)
+loader_kwargs = dict(batch_size=4, block_size=8, device="cpu", num_workers=3, queue_depth=6, seed=7)
+with PrefetchLoader(data, **loader_kwargs) as loader:
+    batches = [next(loader) for _ in range(10)]
+with PrefetchLoader(data, **loader_kwargs) as loader:
+    assert all(torch.equal(x, expected_x) for (x, _), (expected_x, _) in zip(loader, batches[:5]))
+with PrefetchLoader(data, skip_batches=4, **loader_kwargs) as loader:
+    resumed = [next(loader) for _ in range(6)]
+    assert loader.position == 10
+for (x, y), (expected_x, expected_y) in zip(resumed, batches[4:]):
+    assert torch.equal(x, expected_x) and torch.equal(y, expected_y) and torch.equal(x[:, 1:], y[:, :-1])
+print("Prefetched batches are deterministic and resume after skip_batches.")
+
+# Windows that cross shard boundaries read the same tokens as one concatenated split
+with tempfile.TemporaryDirectory() as directory:
+    tokens = np.arange(100) % 50
+    boundaries = [0, 13, 14, 60, 100]  # Includes a one-token shard
+    parts = []
+    for i, (start, stop) in enumerate(zip(boundaries, boundaries[1:])):
+        path = os.path.join(directory, f"shard_{i}.bin")
+        write_token_file(path, {"train": tokens[start:stop]}, 50)
+        parts.append(TokenFile(path)["train"])
+    split = ShardedSplit(parts)
+    assert len(split) == len(tokens) and np.array_equal(np.array(split), tokens)
+    starts = np.arange(len(tokens) - 9)
+    assert np.array_equal(split[starts[:, None] + np.arange(10)], tokens[starts[:, None] + np.arange(10)])
+    for start, stop in ((10, 20), (13, 14), (5, 95), (60, 100)):
+        assert np.array_equal(np.array(split[start:stop]), tokens[start:stop]), (start, stop)
+    x, y = sample_batch(split, batch_size=64, block_size=9, generator=torch.Generator().manual_seed(0))
+    assert torch.equal((x + 1) % 50, y)
+print("Sharded splits read windows across shard boundaries.")
+
+# Evaluation covers strided windows; the loss is per token, whatever the batch size
+assert window_starts(100, 10, stride=5).tolist() == list(range(0, 90, 5))
+assert window_starts(100, 10, stride=5, max_windows=4).tolist() == [0, 30, 55, 85]
+torch.manual_seed(0)
+model = GPTMiniModel(vocabulary_size=50, sequence_length=8, embedding_dim=16, number_of_heads=2, number_of_layers=1)
+model.eval()
+data = np.arange(200, dtype=np.uint8) * 7 % 50
+metrics = evaluate(model, data, batch_size=3, block_size=8, stride=5, precision="fp32", device="cpu")
+windows = torch.from_numpy(data[window_starts(200, 8, stride=5)[:, None] + np.arange(9)].astype(np.int64))
+with torch.no_grad():
+    expected = F.cross_entropy(model(windows[:, :-1]).reshape(-1, 50), windows[:, 1:].reshape(-1)).item()
+assert metrics["tokens"] == windows[:, 1:].numel() and abs(metrics["loss"] - expected) < 1e-5, (metrics, expected)
+assert abs(evaluate(model, data, batch_size=7, block_size=8, stride=5, precision="fp32",
+                    device="cpu")["loss"] - expected) < 1e-5
+assert evaluate(model, data, batch_size=3, block_size=8, stride=5, max_batches=2, precision="fp32",
+                device="cpu")["tokens"] == 2 * 3 * 8
+print("Evaluation averages the loss over strided windows.")
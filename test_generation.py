@@ -0,0 +1,71 @@
+import itertools
+import torch
+from model import GPTMiniModel
+from generation import IncrementalDecoder, StopSequenceMatcher, TextStreamer, accept_draft_tokens, speculative_sample
+from tokenizer import BPETokenizer
+
+torch.manual_seed(0)
+
+block_size = 32
+model = GPTMiniModel(vocabulary_size=20, sequence_length=block_size, embedding_dim=32,
+                     number_of_heads=4, number_of_layers=2)
+model.eval()
+tokens = torch.randint(0, 20, (2, block_size))
+
+# Stop strings are found incrementally, including across token boundaries
+tokenizer = BPETokenizer.train("Human: hi\nAssistant: hello there\n\nHuman: bye", 300)
+matcher = StopSequenceMatcher(tokenizer, ("\nHuman:", "\n\n", "ere"))
+for text, expected_stop in [("hello\nHum", None), ("hello\nHuman: bye", "\nHuman:"),
+                            ("hi\n\nthere", "\n\n"), ("th" + "ere", "ere"), ("\nHu\nHuman", None)]:
+    state, stop = 0, None
+    for token in tokenizer.encode(text):
+        state, stop = matcher.advance(state, token)
+        if stop is not None:
+            break
+    assert stop == expected_stop, (text, stop)
+print("Stop strings are detected incrementally.")
+
+# Streamed chunks never include a stop string, even one split across tokens
+for text, expected in [("hello\nHuman: bye", "hello"), ("a\nb\n\nc", "a\nb"), ("thr\nH", "thr\nH"),
+                       ("caf\u00e9 \U0001f642 ok", "caf\u00e9 \U0001f642 ok")]:
+    streamer = TextStreamer(StopSequenceMatcher(tokenizer))
+    chunks = []
+    for token in tokenizer.encode(text):
+        chunks.append(streamer.push(token))
+        if streamer.stopped:
+            break
+    assert "\ufffd" not in "".join(chunks)
+    if not streamer.stopped:
+        chunks.append(streamer.flush())
+    assert "".join(chunks) == streamer.text == expected, (text, chunks)
+print("Streamed text matches the reply before the stop string.")
+
+# Rewinding the cache forgets tokens as if they had never been decoded
+decoder = IncrementalDecoder(model, block_size=block_size)
+decoder.prefill(tokens[:, :6])
+expected = decoder.step(tokens[:, 6:7])
+decoder.rewind(1)
+decoder.step(tokens[:, 10:14], all_logits=True)
+decoder.rewind(4)
+assert torch.allclose(decoder.step(tokens[:, 6:7]), expected, atol=1e-5)
+
+# Speculative sampling keeps the target distribution whatever the draft proposes
+target_probs = torch.tensor([[0.5, 0.2, 0.2, 0.1], [0.25, 0.25, 0.25, 0.25]])
+draft_probs = torch.tensor([[0.1, 0.1, 0.1, 0.7]])
+counts = torch.zeros(4)
+for _ in range(20000):
+    draft_token = torch.multinomial(draft_probs[0], num_samples=1).item()
+    emitted, _ = accept_draft_tokens(target_probs, draft_probs, [draft_token])
+    counts[emitted[0]] += 1
+assert torch.allclose(counts / counts.sum(), target_probs[0], atol=0.015), counts / counts.sum()
+
+# A draft identical to the target has every proposal accepted (until the caches refill
+# at different points), and generation continues past the context length
+stats = {}
+generated = list(itertools.islice(speculative_sample(model, model, tokens[:1, :5], num_draft_tokens=3, stats=stats,
+                                                     block_size=block_size), 18))
+assert len(generated) == 18 and stats["accepted_tokens"] == stats["drafted_tokens"], stats
+generated = list(itertools.islice(speculative_sample(model, model, tokens[:1, :5], num_draft_tokens=3,
+                                                     block_size=block_size), 3 * block_size))
+assert len(generated) == 3 * block_size
+print("Speculative decoding rewinds the cache and preserves the target distribution.")
@@ -0,0 +1,74 @@
+import torch
+from model import GPTMiniModel
+from generation import IncrementalDecoder, left_pad
+
+torch.manual_seed(0)
+
+block_size = 32
+model = GPTMiniModel(vocabulary_size=20, sequence_length=block_size, embedding_dim=32,
+                     number_of_heads=4, number_of_layers=2)
+model.eval()
+
+# Cached step-by-step logits must match a full forward over the same context
+tokens = torch.randint(0, 20, (2, block_size))
+with torch.no_grad():
+    full_logits = model(tokens)
+
+decoder = IncrementalDecoder(model, block_size=block_size)
+cached_logits = [decoder.prefill(tokens[:, :5])]
+for t in range(5, block_size):
+    cached_logits.append(decoder.step(tokens[:, t:t + 1]))
+cached_logits = torch.stack(cached_logits, dim=1)
+
+max_diff = (cached_logits - full_logits[:, 4:, :]).abs().max().item()
+print(f"Max logit difference (cached vs full): {max_diff:.2e}")
+assert max_diff < 1e-4, "Cached logits do not match the full forward pass."
+
+# Once the cache is full it re-encodes the most recent window
+logits = decoder.step(torch.zeros(2, 1, dtype=torch.long))
+assert decoder.cache_length == decoder.refill_size
+with torch.no_grad():
+    expected = model(decoder.tokens)[:, -1, :]
+assert torch.allclose(logits, expected, atol=1e-4), "Refilled cache does not match the full forward pass."
+
+# A refill keeps every new token, even when there are more of them than refill_size
+decoder = IncrementalDecoder(model, block_size=block_size, refill_size=4)
+decoder.prefill(tokens[:, :block_size - 2])
+logits = decoder.step(tokens[:, :6], all_logits=True)
+with torch.no_grad():
+    expected = model(tokens[:, :6])
+assert logits.shape[1] == decoder.cache_length == 6 and torch.allclose(logits, expected, atol=1e-4)
+
+# Left-padded prompts decoded as one batch must match decoding each prompt alone
+prompts = [[1, 2, 3], [4, 5, 6, 7, 8, 9], [10]]
+tokens, attention_mask = left_pad(prompts)
+decoder = IncrementalDecoder(model, block_size=block_size)
+batch_logits = decoder.prefill(tokens, attention_mask)
+next_tokens = torch.tensor([[11], [12], [13]])
+batch_logits = decoder.step(next_tokens)
+decoder.select([0, 2])  # Drop the longest row; its padding column is trimmed
+batch_logits = torch.cat((batch_logits[:2], decoder.step(next_tokens[[0, 2]])), dim=0)
+assert decoder.cache_length == 5
+
+with torch.no_grad():
+    expected = [
+        model(torch.tensor([prompts[0] + [11]]))[0, -1],
+        model(torch.tensor([prompts[1] + [12]]))[0, -1],
+        model(torch.tensor([prompts[0] + [11, 11]]))[0, -1],
+        model(torch.tensor([prompts[2] + [13, 13]]))[0, -1],
+    ]
+assert torch.allclose(batch_logits, torch.stack(expected), atol=1e-4), "Padded batch does not match single prompts."
+
+# Prompts joining a running batch must match decoding them alone
+decoder = IncrementalDecoder(model, block_size=block_size)
+decoder.prefill(torch.tensor([prompts[0]]))
+decoder.step(torch.tensor([[11]]))
+joined_logits = decoder.add_rows(torch.tensor([prompts[1]]))
+joined_logits = decoder.step(torch.tensor([[11], [12]]))
+with torch.no_grad():
+    expected = torch.stack([
+        model(torch.tensor([prompts[0] + [11, 11]]))[0, -1],
+        model(torch.tensor([prompts[1] + [12]]))[0, -1],
+    ])
+assert torch.allclose(joined_logits, expected, atol=1e-4), "Rows added mid-generation do not match single prompts."
+print("KV cache matches the uncached path.")
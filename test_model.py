@@ -1,33 +1,15 @@
 import torch
 import torch.nn.functional as F
-from model import GPTMiniModel
-from tokenizer import CharTokenizer
+from generation import IncrementalDecoder
+from bundle import load_model
+from tokenizer import tokenizer_path
 import config
 
 def load_trained_model():
     """Load the trained model and tokenizer"""
-    print("Loading tokenizer...")
-    with torch.serialization.safe_globals({"tokenizer.CharTokenizer": CharTokenizer}):
-        tokenizer = torch.load("data/tokenizer.pt", weights_only=False)
-    
     print("Loading trained model...")
-    # Update config with vocabulary size
-    config.vocab_size = tokenizer.vocab_size
-    
-    # Initialize model with same architecture as training
-    model = GPTMiniModel(
-        vocabulary_size=config.vocab_size,
-        sequence_length=config.block_size,
-        embedding_dim=config.embed_dim,
-        number_of_heads=config.num_heads,
-        number_of_layers=config.num_layers
-    ).to(config.device)
-    
-    # Load the trained weights
-    model.load_state_dict(torch.load("checkpoints/mini_gpt.pt", map_location=config.device))
-    model.eval()
-    
-    return model, tokenizer
+    # The bundle, or the weights with the config.py architecture and the saved tokenizer
+    return load_model("checkpoints/mini_gpt.pt", tokenizer_path("tokenizer"))
 
 def generate_text(model, tokenizer, prompt, max_new_tokens=100, temperature=1.0):
     """Generate text from the model given a prompt"""
@@ -42,14 +24,13 @@ def generate_text(model, tokenizer, prompt, max_new_tokens=100, temperature=1.0)
     print("-" * 50)
     
     with torch.no_grad():
+        # Encode the prompt once; each later step only runs the newest token
+        decoder = IncrementalDecoder(model)
+        logits = decoder.prefill(context)
+        
         for _ in range(max_new_tokens):
-            # Get the logits for the last token
-            # Crop context to the last block_size tokens if it's too long
-            context_cropped = context[:, -config.block_size:]
-            logits = model(context_cropped)
-            
-            # Focus only on the last time step
-            logits = logits[:, -1, :] / temperature
+            # Logits for the last time step
+            logits = logits / temperature
             
             # Apply softmax to get probabilities
             probs = F.softmax(logits, dim=-1)
@@ -59,6 +40,7 @@ def generate_text(model, tokenizer, prompt, max_new_tokens=100, temperature=1.0)
             
             # Append to the running sequence
             context = torch.cat((context, next_token), dim=1)
+            logits = decoder.step(next_token)
     
     # Decode the generated sequence
     generated_tokens = context[0].tolist()
@@ -0,0 +1,42 @@
+import torch
+from model import GPTMiniModel
+from generation import IncrementalDecoder
+from prefix_cache import PrefixCache
+
+torch.manual_seed(0)
+
+block_size = 32
+model = GPTMiniModel(vocabulary_size=20, sequence_length=block_size, embedding_dim=32,
+                     number_of_heads=4, number_of_layers=2)
+model.eval()
+
+# A prompt that starts with a cached prefix only runs the model on the rest, with the same logits
+prefix_cache = PrefixCache(max_mib=1, block_tokens=4)
+tokens = torch.randint(0, 20, (1, block_size))
+expected = IncrementalDecoder(model, block_size=block_size).prefill(tokens[:, :22])
+IncrementalDecoder(model, block_size=block_size, prefix_cache=prefix_cache).prefill(tokens[:, :10])
+cached = IncrementalDecoder(model, block_size=block_size, prefix_cache=prefix_cache).prefill(tokens[:, :22])
+assert prefix_cache.hit_tokens == 8 and torch.allclose(cached, expected, atol=1e-5), prefix_cache.stats()
+
+# A finished reply is saved for the next turn; least recently used blocks go first
+decoder = IncrementalDecoder(model, block_size=block_size, prefix_cache=prefix_cache)
+decoder.prefill(tokens[:, :22])
+decoder.step(tokens[:, 22:27], all_logits=True)
+decoder.save_prefix()
+assert prefix_cache.lookup(tokens[0, :27].tolist())[0] == 24
+block_bytes = max(size for _, _, _, size in prefix_cache.blocks.values())
+small_cache = PrefixCache(max_mib=3 * block_bytes / 2 ** 20, block_tokens=4)
+small_cache.insert(tokens[0, :8].tolist(), decoder.past_key_values)
+small_cache.insert(tokens[0, 16:24].tolist(), [(k[:, :, 16:24], v[:, :, 16:24]) for k, v in decoder.past_key_values])
+assert len(small_cache.blocks) == 3 and small_cache.lookup(tokens[0, :8].tolist())[0] == 4
+assert small_cache.lookup(tokens[0, 16:24].tolist())[0] == 8
+
+# Eviction keeps the keys/values and the block keys and tokens stored with them within max_bytes
+for _ in range(20):
+    prompt = torch.randint(0, 20, (1, 12))
+    small_cache.insert(prompt[0].tolist(), decoder.past_key_values)
+    assert small_cache.bytes <= small_cache.max_bytes
+    assert small_cache.bytes == sum(size for _, _, _, size in small_cache.blocks.values())
+assert small_cache.bytes > sum(keys.nbytes + values.nbytes for _, _, layers, _ in small_cache.blocks.values()
+                               for keys, values in layers)
+print("Prefix cache reuses keys/values of earlier prompts within its memory budget.")
@@ -0,0 +1,26 @@
+import os
+import tempfile
+import torch
+from model import GPTMiniModel
+from quantization import is_quantized, load_weights, quantize
+
+torch.manual_seed(0)
+
+architecture = dict(vocabulary_size=20, sequence_length=32, embedding_dim=32, number_of_heads=4, number_of_layers=2)
+model = GPTMiniModel(**architecture)
+model.eval()
+tokens = torch.randint(0, 20, (2, 32))
+
+# An int8 checkpoint reloads through load_weights and stays close to the fp32 model
+with torch.no_grad(), tempfile.TemporaryDirectory() as directory:
+    expected = model(tokens)
+    fp32_path, int8_path = os.path.join(directory, "fp32.pt"), os.path.join(directory, "int8.pt")
+    torch.save(model.state_dict(), fp32_path)
+    torch.save(quantize(model).state_dict(), int8_path)
+    int8_model = load_weights(GPTMiniModel(**architecture), int8_path)
+    assert (int8_model(tokens) - expected).abs().max() < 0.1 * expected.abs().max(), "int8 logits drifted from fp32."
+
+    # An fp32 checkpoint is quantized on load only when asked to
+    assert not is_quantized(load_weights(GPTMiniModel(**architecture), fp32_path, int8=False).state_dict())
+    assert is_quantized(load_weights(GPTMiniModel(**architecture), fp32_path, int8=True).state_dict())
+print("Quantized checkpoint round-trips through load_weights.")
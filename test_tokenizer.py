@@ -13,4 +13,33 @@ print(f'Vocabulary Size: {tokenizer.chars}')
 print(f'Vocabulary Size: {tokenizer.vocab_size}')
 
 # Check correctness
-assert decode == sample_text, "Decoded text does not match original text."
\ No newline at end of file
+assert decode == sample_text, "Decoded text does not match original text."
+
+# The vectorized path must agree with the per-character one
+encode_array = tokenizer.encode_array(sample_text)
+assert encode_array.tolist() == encode, "encode_array does not match encode."
+assert tokenizer.decode_array(encode_array) == sample_text, "decode_array does not match original text."
+
+# Byte-pair encoding tokenizer
+import os
+import tempfile
+from tokenizer import BPETokenizer
+
+with open("data/conversation_input.txt", "r", encoding="utf-8") as f:
+    corpus = f.read()
+
+bpe = BPETokenizer.train(corpus, 300)
+assert bpe.vocab_size == 300
+bpe_tokens = bpe.encode(corpus)
+print(f'BPE characters per token: {len(corpus) / len(bpe_tokens):.2f}')
+assert bpe.decode(bpe_tokens) == corpus, "BPE round trip does not match original text."
+assert len(bpe_tokens) < len(corpus)
+
+# Text outside the training corpus still round-trips through the byte fallback
+unseen = 'Human: Héllo 🙂\nAssistant:'
+assert bpe.decode(bpe.encode(unseen)) == unseen
+
+with tempfile.TemporaryDirectory() as directory:
+    path = os.path.join(directory, "tokenizer.json")
+    bpe.save(path)
+    assert BPETokenizer.load(path).encode(corpus) == bpe_tokens, "Reloaded BPE tokenizer encodes differently."
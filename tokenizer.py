@@ -1,3 +1,10 @@
+import json
+import re
+import numpy as np
+import torch
+from dataset import token_dtype
+import config
+
 class CharTokenizer:
     def __init__(self,text):
         self.chars = sorted(list(set(text)))
@@ -10,3 +17,172 @@ class CharTokenizer:
 
     def decode(self, tokens):
         return ''.join([self.itos[i] for i in tokens])
+
+    # Bulk path for whole corpora: NumPy lookup tables indexed by code point / token id.
+    # The tables are built on first use (tokenizers pickled before they existed still
+    # work) and are left out of the pickle.
+
+    def _lookup_tables(self):
+        if "_encode_table" not in self.__dict__:
+            code_points = np.array([ord(c) for c in self.chars], dtype=np.int64)
+            self._encode_table = np.full(code_points.max() + 1, -1, dtype=np.int64)
+            self._encode_table[code_points] = np.arange(self.vocab_size)
+            self._decode_table = code_points.astype(np.uint32)
+        return self._encode_table, self._decode_table
+
+    def encode_array(self, s):
+        """Encode s straight into a compact uint8/uint16 NumPy array"""
+        encode_table, _ = self._lookup_tables()
+        code_points = np.frombuffer(s.encode("utf-32-le"), dtype=np.uint32)
+        unknown = code_points >= len(encode_table)
+        tokens = encode_table[np.where(unknown, 0, code_points)]
+        unknown |= tokens < 0
+        if unknown.any():
+            raise KeyError(chr(code_points[np.argmax(unknown)]))
+        return tokens.astype(token_dtype(self.vocab_size))
+
+    def decode_array(self, tokens):
+        """Decode an array (or list) of token ids in one vectorized lookup"""
+        _, decode_table = self._lookup_tables()
+        return decode_table[np.asarray(tokens)].tobytes().decode("utf-32-le")
+
+    def __getstate__(self):
+        return {key: value for key, value in self.__dict__.items() if not key.startswith("_")}
+
+
+class BPETokenizer:
+    """
+    Byte-level byte-pair-encoding tokenizer.
+
+    Token ids 0-255 are raw UTF-8 bytes and every later id is a learned merge of two
+    earlier tokens, so any text can be encoded. Merges never cross the boundaries of
+    the chunks produced by CHUNK_PATTERN (words with their leading space, punctuation
+    runs and whitespace runs).
+    """
+
+    CHUNK_PATTERN = re.compile(r" ?\w+| ?[^\w\s]+|\s+")
+
+    def __init__(self, merges=()):
+        self.merges = [tuple(pair) for pair in merges]
+        self.ranks = {pair: 256 + i for i, pair in enumerate(self.merges)}
+        self.vocab = [bytes([i]) for i in range(256)]
+        for left, right in self.merges:
+            self.vocab.append(self.vocab[left] + self.vocab[right])
+        self.vocab_size = len(self.vocab)
+        self._chunk_cache = {}
+
+    @classmethod
+    def train(cls, text, vocab_size):
+        """Learn vocab_size - 256 merges from text"""
+        return cls.train_from_counts(cls.count_chunks(text), vocab_size)
+
+    @classmethod
+    def count_chunks(cls, text, chunk_counts=None):
+        """Add the frequency of every chunk in text to chunk_counts, for training on a stream"""
+        chunk_counts = {} if chunk_counts is None else chunk_counts
+        for chunk in cls.CHUNK_PATTERN.findall(text):
+            chunk_counts[chunk] = chunk_counts.get(chunk, 0) + 1
+        return chunk_counts
+
+    @classmethod
+    def train_from_counts(cls, chunk_counts, vocab_size):
+        """Learn vocab_size - 256 merges from chunk frequencies collected by count_chunks"""
+        words = [(list(chunk.encode("utf-8")), count) for chunk, count in chunk_counts.items()]
+
+        merges = []
+        while 256 + len(merges) < vocab_size:
+            pair_counts = {}
+            for tokens, count in words:
+                for pair in zip(tokens, tokens[1:]):
+                    pair_counts[pair] = pair_counts.get(pair, 0) + count
+            if not pair_counts:
+                break
+            best_pair = max(pair_counts, key=pair_counts.get)
+            new_token = 256 + len(merges)
+            merges.append(best_pair)
+            words = [(cls._merge(tokens, best_pair, new_token), count) for tokens, count in words]
+        return cls(merges)
+
+    @staticmethod
+    def _merge(tokens, pair, new_token):
+        merged = []
+        i = 0
+        while i < len(tokens):
+            if i + 1 < len(tokens) and (tokens[i], tokens[i + 1]) == pair:
+                merged.append(new_token)
+                i += 2
+            else:
+                merged.append(tokens[i])
+                i += 1
+        return merged
+
+    def _encode_chunk(self, chunk):
+        if chunk in self._chunk_cache:
+            return self._chunk_cache[chunk]
+        tokens = list(chunk.encode("utf-8"))
+        while len(tokens) > 1:
+            # Apply the earliest-learned merge present in the chunk, as during training
+            pair = min(zip(tokens, tokens[1:]), key=lambda p: self.ranks.get(p, float("inf")))
+            if pair not in self.ranks:
+                break
+            tokens = self._merge(tokens, pair, self.ranks[pair])
+        self._chunk_cache[chunk] = tokens
+        return tokens
+
+    def encode(self, s):
+        tokens = []
+        for chunk in self.CHUNK_PATTERN.findall(s):
+            tokens.extend(self._encode_chunk(chunk))
+        return tokens
+
+    def decode(self, tokens):
+        return b"".join(self.vocab[i] for i in tokens).decode("utf-8", errors="replace")
+
+    def encode_array(self, s):
+        return np.asarray(self.encode(s), dtype=token_dtype(self.vocab_size))
+
+    def decode_array(self, tokens):
+        return self.decode(np.asarray(tokens).tolist())
+
+    def save(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"type": "bpe", "merges": self.merges}, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r", encoding="utf-8") as f:
+            return cls(json.load(f)["merges"])
+
+
+def tokenizer_path(name):
+    """Where a tokenizer called name (e.g. "tokenizer_v2") is saved for config.tokenizer_type"""
+    extension = "json" if config.tokenizer_type == "bpe" else "pt"
+    return f"data/{name}.{extension}"
+
+
+def save_tokenizer(tokenizer, path):
+    if isinstance(tokenizer, BPETokenizer):
+        tokenizer.save(path)
+    else:
+        torch.save(tokenizer, path)
+
+
+def tokenizer_state(tokenizer):
+    """The tokenizer as plain lists and strings, e.g. for a model bundle"""
+    if isinstance(tokenizer, BPETokenizer):
+        return {"type": "bpe", "merges": [list(pair) for pair in tokenizer.merges]}
+    return {"type": "char", "chars": "".join(tokenizer.chars)}
+
+
+def tokenizer_from_state(state):
+    if state["type"] == "bpe":
+        return BPETokenizer(state["merges"])
+    return CharTokenizer(state["chars"])
+
+
+def load_tokenizer(path):
+    """Load a tokenizer saved by save_tokenizer: JSON for BPE, a pickled CharTokenizer otherwise"""
+    if path.endswith(".json"):
+        return BPETokenizer.load(path)
+    with torch.serialization.safe_globals({"tokenizer.CharTokenizer": CharTokenizer}):
+        return torch.load(path, weights_only=False)
@@ -2,14 +2,20 @@ import torch
 import torch.nn as nn
 import torch.optim as optim
 from model import GPTMiniModel
-from prepare_dataset import get_batch
-from tokenizer import CharTokenizer
+from precision import autocast, grad_scaler
+from dataset import gradient_accumulation_steps
+from prepare_dataset import prepare_dataset
+from evaluate import evaluate
+from tokenizer import load_tokenizer, tokenizer_path
 import config
 import os
+import time
+
+# Encode data/input.txt unless data/tokens is already up to date
+token_dataset = prepare_dataset()
 
 # Load tokenizer and set vocab size in config
-with torch.serialization.safe_globals({"tokenizer.CharTokenizer": CharTokenizer}):
-    tokenizer: CharTokenizer = torch.load("data/tokenizer.pt", weights_only=False)
+tokenizer = load_tokenizer(tokenizer_path("tokenizer"))
 
 # Update config with the actual vocabulary size from tokenizer
 config.vocab_size = tokenizer.vocab_size
@@ -25,6 +31,11 @@ model = GPTMiniModel(
 
 # Optimizer and loss
 optimizer = optim.AdamW(model.parameters(), lr=config.learning_rate)
+scaler = grad_scaler()  # Only scales the loss for fp16
+
+# Gradients of several micro-batches are accumulated into each optimizer step
+accumulation_steps = gradient_accumulation_steps()
+tokens_per_step = config.effective_batch_size * config.block_size
 
 # Create checkpoint directory if not exists
 os.makedirs("checkpoints", exist_ok=True)
@@ -33,26 +44,40 @@ print("🚀 Training started...")
 step = 0
 model.train()
 
-for iteration in range(config.max_iters):
-    xb, yb = get_batch('train')
-    xb, yb = xb.to(config.device), yb.to(config.device)
+# Training batches are built by background workers while the model steps
+with token_dataset.prefetch('train', pin_memory=config.device == 'cuda') as train_batches:
+    train_seconds, train_steps = 0.0, 0  # Optimizer steps since the last log line
+    for iteration in range(config.max_iters):
+        start = time.perf_counter()
+        optimizer.zero_grad()
+        loss = 0.0
+        for _ in range(accumulation_steps):
+            xb, yb = next(train_batches)  # Already on config.device
 
-    logits, loss = model(xb, yb)
+            # Forward pass in config.precision; weights and optimizer state stay fp32
+            with autocast():
+                logits, micro_loss = model(xb, yb)
 
-    optimizer.zero_grad()
-    loss.backward()
-    optimizer.step()
+            micro_loss = micro_loss / accumulation_steps
+            scaler.scale(micro_loss).backward()
+            loss += micro_loss.detach()
+        scaler.step(optimizer)
+        scaler.update()
+        train_seconds += time.perf_counter() - start
+        train_steps += 1
 
-    # Evaluation
-    if iteration % config.eval_interval == 0 or iteration == config.max_iters - 1:
-        model.eval()
-        with torch.no_grad():
-            val_x, val_y = get_batch('val')
-            val_x, val_y = val_x.to(config.device), val_y.to(config.device)
-            _, val_loss = model(val_x, val_y)
-        model.train()
+        # Evaluation
+        if iteration % config.eval_interval == 0 or iteration == config.max_iters - 1:
+            # Validation loss over many windows of the val split
+            metrics = evaluate(model, token_dataset["val"], max_batches=config.eval_max_batches)
 
-        print(f"Step {iteration:5d} | Train Loss: {loss.item():.4f} | Val Loss: {val_loss.item():.4f}")
+            data_stats = train_batches.stats()
+            print(f"Step {iteration:5d} | Train Loss: {loss.item():.4f} | Val Loss: {metrics['loss']:.4f} | "
+                  f"{train_steps * tokens_per_step / train_seconds:,.0f} tokens/sec "
+                  f"({train_seconds / train_steps * 1000:.0f} ms/step) | "
+                  f"Data queue: {data_stats['mean_queue_depth']:.1f}/{data_stats['max_queue_depth']} "
+                  f"({data_stats['starved_batches']} batches waited on)")
+            train_seconds, train_steps = 0.0, 0
 
 # Save model
 torch.save(model.state_dict(), "checkpoints/mini_gpt.pt")
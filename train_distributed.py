@@ -0,0 +1,160 @@
+# train_distributed.py
+"""
+Data-parallel training of the v2 conversational model across processes on one machine.
+
+Every process holds a full model replica and trains on its own contiguous shard of the
+train split; DistributedDataParallel averages gradients over processes (gloo backend,
+CPU) during the backward pass. Rank 0 prepares the dataset, evaluates and writes
+checkpoints. Each process runs config.effective_batch_size sequences per optimizer
+step, so the global batch grows with the number of processes.
+
+Usage:
+    torchrun --standalone --nproc_per_node 4 train_distributed.py [--max-iters 8000]
+    python train_distributed.py --scaling-report 1,2,4 [--max-iters 40]
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import torch
+import torch.distributed as dist
+import torch.optim as optim
+from torch.nn.parallel import DistributedDataParallel
+from model import GPTMiniModel
+from precision import autocast, grad_scaler
+from prepare_corpus import prepare_corpus
+from dataset import PrefetchLoader, gradient_accumulation_steps, load_token_dataset
+from evaluate import evaluate
+from tokenizer import load_tokenizer, tokenizer_path
+import config
+
+
+def train(max_iters, checkpoint_dir):
+    dist.init_process_group("gloo")
+    rank, world_size = dist.get_rank(), dist.get_world_size()
+    # Share the cores between processes instead of oversubscribing them with intra-op threads
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+    device = "cpu"
+
+    # Rank 0 tokenizes the corpus while the other ranks wait for the shards
+    if rank == 0:
+        print(f"🚀 Distributed training of ChatGPT Mini v2 on {world_size} processes "
+              f"({torch.get_num_threads()} threads each)")
+        prepare_corpus("data/conversation_input.txt", "data/tokens_v2", "tokenizer_v2", train_fraction=0.9)
+    dist.barrier()
+    tokenizer = load_tokenizer(tokenizer_path("tokenizer_v2"))
+    config.vocab_size = tokenizer.vocab_size
+    token_dataset = load_token_dataset("data/tokens_v2")
+
+    # Reproducible with config.seed; DDP broadcasts rank 0's initial weights either way
+    if config.seed is not None:
+        torch.manual_seed(config.seed)
+    model = GPTMiniModel(
+        vocabulary_size=config.vocab_size,
+        sequence_length=config.block_size,
+        embedding_dim=config.embed_dim,
+        number_of_heads=config.num_heads,
+        number_of_layers=config.num_layers
+    ).to(device)
+    ddp_model = DistributedDataParallel(model)
+    optimizer = optim.AdamW(model.parameters(), lr=config.learning_rate)
+    scaler = grad_scaler(device=device)
+
+    accumulation_steps = gradient_accumulation_steps()
+    tokens_per_step = world_size * config.effective_batch_size * config.block_size
+    os.makedirs(checkpoint_dir, exist_ok=True)
+
+    best_val_loss = float('inf')
+    model.train()
+    train_seconds, train_steps = 0.0, 0  # Optimizer steps since the last log line
+    total_seconds, total_steps = 0.0, 0  # Optimizer steps after the first (warm-up) one
+    train_shard = token_dataset.shard('train', rank, world_size)
+    # Ranks' seeds are spaced apart so their workers (seed + worker id) never share one
+    with PrefetchLoader(train_shard, device=device, seed=torch.initial_seed() + 1000 * rank) as train_batches:
+        for iteration in range(max_iters):
+            start = time.perf_counter()
+            optimizer.zero_grad()
+            loss = 0.0
+            for micro_step in range(accumulation_steps):
+                xb, yb = next(train_batches)
+                with autocast(device=device):
+                    logits, micro_loss = ddp_model(xb, yb)
+                micro_loss = micro_loss / accumulation_steps
+                if micro_step < accumulation_steps - 1:
+                    # Gradients are only averaged across processes after the last micro-batch
+                    with ddp_model.no_sync():
+                        scaler.scale(micro_loss).backward()
+                else:
+                    scaler.scale(micro_loss).backward()
+                loss += micro_loss.detach()
+            scaler.step(optimizer)
+            scaler.update()
+            elapsed = time.perf_counter() - start
+            train_seconds += elapsed
+            train_steps += 1
+            if iteration > 0:
+                total_seconds += elapsed
+                total_steps += 1
+
+            # Evaluation and checkpoints on rank 0; the others wait for it at the next all-reduce
+            if rank == 0 and (iteration % config.eval_interval == 0 or iteration == max_iters - 1):
+                metrics = evaluate(model, token_dataset["val"], max_batches=config.eval_max_batches, device=device)
+                val_loss = metrics["loss"]
+
+                print(f"Step {iteration:5d} | Train Loss: {loss.item():.4f} | Val Loss: {val_loss:.4f} | "
+                      f"{train_steps * tokens_per_step / train_seconds:,.0f} tokens/sec "
+                      f"({train_seconds / train_steps * 1000:.0f} ms/step)")
+                train_seconds, train_steps = 0.0, 0
+
+                if val_loss < best_val_loss:
+                    best_val_loss = val_loss
+                    torch.save(model.state_dict(), os.path.join(checkpoint_dir, "mini_gpt_v2_best.pt"))
+
+    if rank == 0:
+        torch.save(model.state_dict(), os.path.join(checkpoint_dir, "mini_gpt_v2.pt"))
+        print(f"✅ Training complete! Best val_loss: {best_val_loss:.4f}, checkpoints in {checkpoint_dir}/")
+        if total_steps:
+            print(f"Throughput: {total_steps / total_seconds:.3f} steps/sec | "
+                  f"{total_steps * tokens_per_step / total_seconds:,.0f} tokens/sec | {world_size} processes")
+    dist.destroy_process_group()
+
+
+def scaling_report(process_counts, max_iters):
+    """Train for max_iters steps under torchrun with each process count and compare throughput"""
+    results = []
+    for nproc in process_counts:
+        # Throwaway checkpoints, so the report never overwrites a real training run
+        with tempfile.TemporaryDirectory() as checkpoint_dir:
+            output = subprocess.run(
+                [sys.executable, "-m", "torch.distributed.run", "--standalone", f"--nproc_per_node={nproc}",
+                 __file__, "--max-iters", str(max_iters), "--checkpoint-dir", checkpoint_dir],
+                capture_output=True, text=True, check=True
+            ).stdout
+        match = re.search(r"Throughput: ([\d.]+) steps/sec \| ([\d,]+) tokens/sec", output)
+        results.append((nproc, float(match.group(1)), float(match.group(2).replace(",", ""))))
+        print(f"{nproc} processes: {results[-1][1]:.3f} steps/sec, {results[-1][2]:,.0f} tokens/sec")
+
+    print(f"\n📊 Scaling report ({max_iters} steps, {config.effective_batch_size} sequences per process "
+          f"per step, {os.cpu_count()} CPUs)")
+    print(f"{'processes':>9} | {'steps/sec':>9} | {'tokens/sec':>10} | {'speedup':>7} | {'efficiency':>10}")
+    base_tokens_per_second = results[0][2] / results[0][0]
+    for nproc, steps_per_second, tokens_per_second in results:
+        speedup = tokens_per_second / base_tokens_per_second
+        print(f"{nproc:>9} | {steps_per_second:>9.3f} | {tokens_per_second:>10,.0f} | "
+              f"{speedup:>6.2f}x | {speedup / nproc:>9.0%}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Data-parallel training with torch.distributed (gloo)")
+    parser.add_argument("--max-iters", type=int, default=config.max_iters)
+    parser.add_argument("--checkpoint-dir", default="checkpoints")
+    parser.add_argument("--scaling-report", help="Comma-separated process counts to benchmark, e.g. 1,2,4")
+    args = parser.parse_args()
+
+    if args.scaling_report:
+        scaling_report([int(n) for n in args.scaling_report.split(",")], args.max_iters)
+    else:
+        train(args.max_iters, args.checkpoint_dir)
@@ -2,51 +2,57 @@ import torch
 import torch.nn as nn
 import torch.optim as optim
 from model import GPTMiniModel
-from prepare_dataset import get_batch
-from tokenizer import CharTokenizer
+from precision import autocast, grad_scaler
+from prepare_corpus import prepare_corpus
+from dataset import gradient_accumulation_steps, load_token_dataset
+from evaluate import BackgroundEvaluator, evaluate
+from bundle import bundle_path, save_bundle
+from checkpoint import (CheckpointWriter, config_differences, config_snapshot, load_training_checkpoint,
+                        rng_state, set_rng_state)
 import config
+import argparse
+import contextlib
 import os
+import time
 
-print("🚀 Starting training for ChatGPT Mini v2...")
+parser = argparse.ArgumentParser(description="Train ChatGPT Mini v2 on the conversation dataset")
+parser.add_argument("--resume", action="store_true", help="Continue the run saved in checkpoints/<model>_train.pt")
+parser.add_argument("--draft", action="store_true",
+                    help="Train the small draft model for speculative decoding (config.draft_*)")
+args = parser.parse_args()
+
+# The draft model shares the tokenizer and data pipeline and only differs in size
+MODEL_NAME = "mini_gpt_v2_draft" if args.draft else "mini_gpt_v2"
+if args.draft:
+    config.embed_dim, config.num_heads, config.num_layers = (
+        config.draft_embed_dim, config.draft_num_heads, config.draft_num_layers
+    )
+TRAINING_CHECKPOINT = f"checkpoints/{MODEL_NAME}_train.pt"
+
+print(f"🚀 Starting training for ChatGPT Mini v2{' (draft model)' if args.draft else ''}...")
 
 # Update the input file for conversation data
 def prepare_conversation_dataset():
     """Prepare the conversation dataset"""
-    with open("data/conversation_input.txt", "r", encoding="utf-8") as f:
-        text = f.read()
-    
-    print(f"Loaded conversation dataset with {len(text)} characters")
-    
-    # Initialize the tokenizer with conversation data
-    tokenizer = CharTokenizer(text)
+    # Stream the conversations through the tokenizer into token shards (also saves the tokenizer)
+    tokenizer = prepare_corpus("data/conversation_input.txt", "data/tokens_v2", "tokenizer_v2", train_fraction=0.9)
     
-    # Encode the entire text to integer tokens
-    data = torch.tensor(tokenizer.encode(text), dtype=torch.long)
+    manifest = load_token_dataset("data/tokens_v2").manifest
+    print(f"Loaded conversation dataset with {manifest['characters']} characters")
     
-    # Split into train and validation sets
-    n = int(0.9 * len(data))
-    train_data = data[:n]
-    val_data = data[n:]
-    
-    # Save the train and validation data
-    torch.save(train_data, "data/train_v2.pt")
-    torch.save(val_data, "data/val_v2.pt")
-    torch.save(tokenizer, "data/tokenizer_v2.pt")
-    
-    print(f"Dataset prepared with {len(train_data)} training tokens and {len(val_data)} validation tokens.")
+    train_tokens, val_tokens = manifest["tokens"]["train"], manifest["tokens"]["val"]
+    print(f"Dataset prepared with {train_tokens} training tokens and {val_tokens} validation tokens "
+          f"({manifest['characters'] / (train_tokens + val_tokens):.2f} characters per token).")
     return tokenizer
 
-# Function to get batch for v2
-def get_batch_v2(split):
-    """Modified get_batch function for v2 data"""
-    train_data = torch.load("data/train_v2.pt")
-    val_data = torch.load("data/val_v2.pt")
-    
-    data = train_data if split == 'train' else val_data
-    ix = torch.randint(len(data) - config.block_size, (config.batch_size,))
-    x = torch.stack([data[i:i + config.block_size] for i in ix])
-    y = torch.stack([data[i + 1:i + config.block_size + 1] for i in ix])
-    return x, y
+def record_validation(iteration, metrics, state_dict):
+    """Log a validation result and keep the weights it was measured on if they are the best so far"""
+    global best_val_loss
+    print(f"Step {iteration:5d} | Val Loss: {metrics['loss']:.4f} | Perplexity: {metrics['perplexity']:.2f} | "
+          f"{metrics['tokens']:,} tokens at {metrics['tokens_per_second']:,.0f} tokens/sec")
+    if metrics["loss"] < best_val_loss:
+        best_val_loss = metrics["loss"]
+        checkpoint_writer.save(state_dict, f"checkpoints/{MODEL_NAME}_best.pt")
 
 # Prepare conversation dataset
 tokenizer = prepare_conversation_dataset()
@@ -55,58 +61,129 @@ tokenizer = prepare_conversation_dataset()
 config.vocab_size = tokenizer.vocab_size
 
 print(f"Vocabulary size: {config.vocab_size}")
-print(f"Training device: {config.device}")
+print(f"Training device: {config.device} ({config.precision})")
+
+if config.seed is not None:
+    torch.manual_seed(config.seed)
 
 # Initialize the model
-model = GPTMiniModel(
+model_kwargs = dict(
     vocabulary_size=config.vocab_size,
     sequence_length=config.block_size,
     embedding_dim=config.embed_dim,
     number_of_heads=config.num_heads,
     number_of_layers=config.num_layers
-).to(config.device)
+)
+model = GPTMiniModel(**model_kwargs).to(config.device)
 
 print(f"Model initialized with {sum(p.numel() for p in model.parameters())} parameters")
 
 # Optimizer and loss
 optimizer = optim.AdamW(model.parameters(), lr=config.learning_rate)
+scaler = grad_scaler()  # Only scales the loss for fp16
+
+# Gradients of several micro-batches are accumulated into each optimizer step
+accumulation_steps = gradient_accumulation_steps()
+tokens_per_step = config.effective_batch_size * config.block_size
 
 # Create checkpoint directory if not exists
 os.makedirs("checkpoints", exist_ok=True)
 
+start_iteration = 0
+best_val_loss = float('inf')
+data_seed, data_position = torch.initial_seed(), 0  # Where the training batch stream starts
+if args.resume:
+    checkpoint = load_training_checkpoint(TRAINING_CHECKPOINT)
+    for name, (saved, current) in config_differences(checkpoint["config"]).items():
+        print(f"⚠️ config.{name} is {current!r} but was {saved!r} when the checkpoint was saved")
+    model.load_state_dict(checkpoint["model"])
+    optimizer.load_state_dict(checkpoint["optimizer"])
+    scaler.load_state_dict(checkpoint["scaler"])
+    start_iteration = checkpoint["iteration"] + 1
+    best_val_loss = checkpoint["best_val_loss"]
+    data_seed, data_position = checkpoint["data"]["seed"], checkpoint["data"]["position"]
+    # Restored last, so dropout continues exactly where it left off
+    set_rng_state(checkpoint["rng"])
+    print(f"↩️ Resuming from iteration {start_iteration} (best val loss {best_val_loss:.4f})")
+
 print("🚀 Training started...")
 model.train()
 
-best_val_loss = float('inf')
-
-for iteration in range(config.max_iters):
-    xb, yb = get_batch_v2('train')
-    xb, yb = xb.to(config.device), yb.to(config.device)
-
-    logits, loss = model(xb, yb)
-
-    optimizer.zero_grad()
-    loss.backward()
-    optimizer.step()
-
-    # Evaluation
-    if iteration % config.eval_interval == 0 or iteration == config.max_iters - 1:
-        model.eval()
-        with torch.no_grad():
-            val_x, val_y = get_batch_v2('val')
-            val_x, val_y = val_x.to(config.device), val_y.to(config.device)
-            _, val_loss = model(val_x, val_y)
-        model.train()
-
-        print(f"Step {iteration:5d} | Train Loss: {loss.item():.4f} | Val Loss: {val_loss.item():.4f}")
-        
-        # Save best model
-        if val_loss.item() < best_val_loss:
-            best_val_loss = val_loss.item()
-            torch.save(model.state_dict(), "checkpoints/mini_gpt_v2_best.pt")
-
-# Save final model
-torch.save(model.state_dict(), "checkpoints/mini_gpt_v2.pt")
+# Training batches are built by background workers while the model steps; checkpoints are
+# written by another background thread and validation optionally runs in another process
+train_dataset = load_token_dataset("data/tokens_v2")
+evaluator = contextlib.nullcontext()
+if config.eval_in_background:
+    evaluator = BackgroundEvaluator(model_kwargs, "data/tokens_v2", max_batches=config.eval_max_batches,
+                                    precision="fp32")
+pending_validations = {}  # Iteration -> weights submitted to the background evaluator
+with CheckpointWriter() as checkpoint_writer, evaluator, train_dataset.prefetch(
+        'train', pin_memory=config.device == 'cuda', seed=data_seed, skip_batches=data_position) as train_batches:
+    train_seconds, train_steps = 0.0, 0  # Optimizer steps since the last log line
+    for iteration in range(start_iteration, config.max_iters):
+        start = time.perf_counter()
+        optimizer.zero_grad()
+        loss = 0.0
+        for _ in range(accumulation_steps):
+            xb, yb = next(train_batches)  # Already on config.device
+
+            # Forward pass in config.precision; weights and optimizer state stay fp32
+            with autocast():
+                logits, micro_loss = model(xb, yb)
+
+            micro_loss = micro_loss / accumulation_steps
+            scaler.scale(micro_loss).backward()
+            loss += micro_loss.detach()
+        scaler.step(optimizer)
+        scaler.update()
+        train_seconds += time.perf_counter() - start
+        train_steps += 1
+
+        # Evaluation
+        if iteration % config.eval_interval == 0 or iteration == config.max_iters - 1:
+            data_stats = train_batches.stats()
+            print(f"Step {iteration:5d} | Train Loss: {loss.item():.4f} | "
+                  f"{train_steps * tokens_per_step / train_seconds:,.0f} tokens/sec "
+                  f"({train_seconds / train_steps * 1000:.0f} ms/step) | "
+                  f"Data queue: {data_stats['mean_queue_depth']:.1f}/{data_stats['max_queue_depth']} "
+                  f"({data_stats['starved_batches']} batches waited on)")
+            train_seconds, train_steps = 0.0, 0
+
+            # Validate over many windows; the best weights are saved as <model>_best.pt
+            if config.eval_in_background:
+                pending_validations[iteration] = evaluator.submit(iteration, model.state_dict())
+            else:
+                metrics = evaluate(model, train_dataset["val"], max_batches=config.eval_max_batches)
+                record_validation(iteration, metrics, model.state_dict())
+
+        if config.eval_in_background:
+            for evaluated_iteration, metrics in evaluator.poll():
+                record_validation(evaluated_iteration, metrics, pending_validations.pop(evaluated_iteration))
+
+        # Everything needed to continue this run from the next iteration
+        if (iteration + 1) % config.checkpoint_interval == 0 or iteration == config.max_iters - 1:
+            if config.eval_in_background:
+                # Finish outstanding validations so best_val_loss is up to date
+                for evaluated_iteration, metrics in evaluator.wait():
+                    record_validation(evaluated_iteration, metrics, pending_validations.pop(evaluated_iteration))
+            checkpoint_writer.save({
+                "model": model.state_dict(),
+                "optimizer": optimizer.state_dict(),
+                "scaler": scaler.state_dict(),
+                "iteration": iteration,
+                "best_val_loss": best_val_loss,
+                "rng": rng_state(),
+                "data": {"seed": train_batches.seed, "position": train_batches.position},
+                "config": config_snapshot(),
+            }, TRAINING_CHECKPOINT)
+
+    # Save final model
+    checkpoint_writer.save(model.state_dict(), f"checkpoints/{MODEL_NAME}.pt")
+
+# Single-file copies with the tokenizer and architecture, which chat entry points load fastest
+for name in (MODEL_NAME, f"{MODEL_NAME}_best"):
+    state_dict = torch.load(f"checkpoints/{name}.pt", map_location="cpu")
+    save_bundle(bundle_path(f"checkpoints/{name}.pt"), state_dict, tokenizer, model_kwargs)
 print("✅ Training complete!")
-print(f"Final model saved to checkpoints/mini_gpt_v2.pt")
-print(f"Best model (val_loss: {best_val_loss:.4f}) saved to checkpoints/mini_gpt_v2_best.pt")
+print(f"Final model saved to checkpoints/{MODEL_NAME}.pt")
+print(f"Best model (val_loss: {best_val_loss:.4f}) saved to checkpoints/{MODEL_NAME}_best.pt")